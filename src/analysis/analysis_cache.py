@@ -0,0 +1,76 @@
+import os
+from os import path
+import sys
+import cPickle as pickle
+
+import analysis_manifest
+
+
+# Analyses of a tunnel log are cached in a sidecar file next to the log,
+# which is valid as long as the path, size and mtime of the log (and of the
+# link trace it names, if any) are the same.
+# Entries of the cache are keyed by the analysis and its parameters, e.g.,
+# ('tunnel_graph', ms_per_bin, quantile_mode, sketch_error), and only hold
+# summaries of the log to keep the cache small: per-packet delays are only
+# cached once decimated to a bounded number of points.
+CACHE_SUFFIX = '.cache'
+
+# increase whenever the contents of cached entries change
+CACHE_VERSION = 5
+
+
+def cache_path(log_path):
+    return log_path + CACHE_SUFFIX
+
+
+def log_fingerprint(log_path):
+    stat = os.stat(log_path)
+    trace = analysis_manifest.trace_fingerprint(log_path)
+    return (path.abspath(log_path), stat.st_size, stat.st_mtime,
+            tuple(trace) if trace else None)
+
+
+def load_entries(log_path):
+    # return all cached entries, or {} if the cache is missing or stale
+    try:
+        fingerprint = log_fingerprint(log_path)
+        with open(cache_path(log_path), 'rb') as cache:
+            cached = pickle.load(cache)
+    except (EnvironmentError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, IndexError, ValueError):
+        return {}
+
+    if not isinstance(cached, dict):
+        return {}
+
+    if (cached.get('version') != CACHE_VERSION or
+            cached.get('log') != fingerprint):
+        return {}
+
+    return cached['entries']
+
+
+def load(log_path, key):
+    return load_entries(log_path).get(key)
+
+
+def save(log_path, entries):
+    """Add entries to the cache of the log at log_path, replacing old ones."""
+    cached_entries = load_entries(log_path)
+    cached_entries.update(entries)
+
+    cache = cache_path(log_path)
+    tmp_cache = '%s.%d' % (cache, os.getpid())
+
+    try:
+        with open(tmp_cache, 'wb') as tmp:
+            pickle.dump({'version': CACHE_VERSION,
+                         'log': log_fingerprint(log_path),
+                         'entries': cached_entries},
+                        tmp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_cache, cache)
+    except EnvironmentError as exception:
+        sys.stderr.write('Warning: failed to save %s: %s\n'
+                         % (cache, exception))
+        if path.isfile(tmp_cache):
+            os.remove(tmp_cache)
@@ -0,0 +1,76 @@
+import os
+from os import path
+import json
+
+import context
+from helpers import tunnel_log
+
+
+# The manifest of incremental analyses maps '<cc>_run<run_id>' to
+#   inputs: fingerprints of the logs of the run (and of the link traces they
+#           name) and the analysis options,
+#   outputs: files generated for the run,
+#   results: results of the run (None if it is invalid)
+MANIFEST_NAME = 'pantheon_analysis_manifest.json'
+
+
+def fingerprint(file_path):
+    # [size, mtime] of a file or None if it does not exist
+    if not path.isfile(file_path):
+        return None
+
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def trace_fingerprint(log_path):
+    # [path, size, mtime] of the link trace named in a text tunnel log, whose
+    # size and mtime are None if the trace is missing, or None if the log
+    # does not name a trace
+    if not path.isfile(log_path):
+        return None
+
+    link = tunnel_log.read_link_trace(log_path)
+    if link is None:
+        return None
+
+    trace_path = link[0]
+    return [trace_path] + (fingerprint(trace_path) or [None, None])
+
+
+def load(data_dir):
+    manifest_path = path.join(data_dir, MANIFEST_NAME)
+    if not path.isfile(manifest_path):
+        return {}
+
+    try:
+        with open(manifest_path) as manifest:
+            return json.load(manifest)
+    except ValueError:
+        return {}
+
+
+def save(data_dir, manifest):
+    manifest_path = path.join(data_dir, MANIFEST_NAME)
+    tmp_path = '%s.%d' % (manifest_path, os.getpid())
+
+    with open(tmp_path, 'w') as tmp:
+        json.dump(manifest, tmp, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+    os.rename(tmp_path, manifest_path)
+
+
+def load_results(results):
+    # JSON turned flow IDs in flow_data into strings
+    if results is None:
+        return None
+
+    flow_data = {}
+    for flow_id, data in results['flow_data'].iteritems():
+        if flow_id != 'all':
+            flow_id = int(flow_id)
+        flow_data[flow_id] = data
+
+    results = dict(results)
+    results['flow_data'] = flow_data
+    return results
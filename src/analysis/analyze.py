@@ -1,32 +1,17 @@
 #!/usr/bin/env python
 
-from os import path
-
 import arg_parser
-import context
-from helpers.subprocess_wrappers import check_call
+import pipeline
 
 
 def main():
     args = arg_parser.parse_analyze()
 
-    analysis_dir = path.join(context.src_dir, 'analysis')
-    plot = path.join(analysis_dir, 'plot.py')
-    report = path.join(analysis_dir, 'report.py')
-
-    plot_cmd = ['python2', plot]
-    report_cmd = ['python2', report]
-
-    for cmd in [plot_cmd, report_cmd]:
-        if args.data_dir:
-            cmd += ['--data-dir', args.data_dir]
-        if args.schemes:
-            cmd += ['--schemes', args.schemes]
-        if args.include_acklink:
-            cmd += ['--include-acklink']
-
-    check_call(plot_cmd)
-    check_call(report_cmd)
+    pipeline.run(args.data_dir, schemes=args.schemes,
+                 include_acklink=args.include_acklink,
+                 delay_quantiles=args.delay_quantiles,
+                 sketch_error=args.sketch_error, jobs=args.jobs,
+                 no_cache=args.no_cache, incremental=args.incremental)
 
 
 if __name__ == '__main__':
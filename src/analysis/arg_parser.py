@@ -1,6 +1,7 @@
 import sys
 from os import path
 import argparse
+import multiprocessing
 
 import context
 from helpers import utils
@@ -15,6 +16,35 @@ def verify_schemes(schemes):
             sys.exit('%s is not a scheme included in src/config.yml' % cc)
 
 
+def parse_quantile_args(parser):
+    parser.add_argument(
+        '--delay-quantiles', choices=['samples', 'exact', 'sketch'],
+        default='samples', help='how to compute per-packet delay '
+        'percentiles: keep all delays ("samples"), or count them per flow in '
+        'a sparse histogram at 0.001 ms resolution ("exact", same '
+        'percentiles as "samples") or a constant-memory sketch with bounded '
+        'relative error ("sketch"); delay graphs are decimated with the '
+        'latter two (default samples)')
+    parser.add_argument(
+        '--sketch-error', metavar='ERROR', type=float, default=0.01,
+        help='relative error bound of the delay sketch (default 0.01)')
+
+
+def parse_jobs_arg(parser):
+    parser.add_argument(
+        '--jobs', metavar='N', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of processes to analyze runs in parallel '
+        '(default number of CPUs)')
+
+
+def parse_incremental_arg(parser):
+    parser.add_argument(
+        '--incremental', action='store_true', help='only analyze runs whose '
+        'logs changed since the last incremental analysis, reusing the '
+        'results of other runs recorded in pantheon_analysis_manifest.json')
+
+
 def parse_tunnel_graph():
     parser = argparse.ArgumentParser(
         description='evaluate throughput and delay of a tunnel log and '
@@ -33,6 +63,22 @@ def parse_tunnel_graph():
     parser.add_argument(
         '--ms-per-bin', metavar='MS-PER-BIN', type=int, default=500,
         help='bin size in ms (default 500)')
+    parse_quantile_args(parser)
+    parse_cache_arg(parser)
+
+    args = parser.parse_args()
+    return args
+
+
+def parse_convert_tunnel_log():
+    parser = argparse.ArgumentParser(
+        description='convert a text tunnel log to the binary format, or a '
+        'binary tunnel log back to text')
+
+    parser.add_argument('input_log', metavar='INPUT-LOG',
+                        help='text or binary tunnel log')
+    parser.add_argument('output_log', metavar='OUTPUT-LOG',
+                        help='converted tunnel log to save as')
 
     args = parser.parse_args()
     return args
@@ -48,6 +94,13 @@ def parse_analyze_shared(parser):
         default=path.join(context.src_dir, 'experiments', 'data'),
         help='directory that contains logs and metadata '
         'of pantheon tests (default pantheon/experiments/data)')
+    parse_cache_arg(parser)
+
+
+def parse_cache_arg(parser):
+    parser.add_argument(
+        '--no-cache', action='store_true', help='do not reuse or save '
+        'analyses cached next to tunnel logs (in *.log.cache files)')
 
 
 def parse_plot():
@@ -60,11 +113,17 @@ def parse_plot():
     parser.add_argument(
         '--no-graphs', action='store_true', help='only append datalink '
         'statistics to stats files with no graphs generated')
+    parse_quantile_args(parser)
+    parse_jobs_arg(parser)
+    parse_incremental_arg(parser)
 
     args = parser.parse_args()
     if args.schemes is not None:
         verify_schemes(args.schemes)
 
+    if args.jobs < 1:
+        sys.exit('--jobs must be a positive integer')
+
     return args
 
 
@@ -90,11 +149,17 @@ def parse_analyze():
     parse_analyze_shared(parser)
     parser.add_argument('--include-acklink', action='store_true',
                         help='include acklink analysis')
+    parse_quantile_args(parser)
+    parse_jobs_arg(parser)
+    parse_incremental_arg(parser)
 
     args = parser.parse_args()
     if args.schemes is not None:
         verify_schemes(args.schemes)
 
+    if args.jobs < 1:
+        sys.exit('--jobs must be a positive integer')
+
     return args
 
 
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+import sys
+
+import arg_parser
+import context
+from helpers import tunnel_log
+
+
+def main():
+    args = arg_parser.parse_convert_tunnel_log()
+
+    if tunnel_log.is_binary(args.input_log):
+        tunnel_log.convert_to_text(args.input_log, args.output_log)
+        sys.stderr.write('Converted binary tunnel log %s to text log %s\n'
+                         % (args.input_log, args.output_log))
+    else:
+        tunnel_log.convert_to_binary(args.input_log, args.output_log)
+        sys.stderr.write('Converted text tunnel log %s to binary log %s\n'
+                         % (args.input_log, args.output_log))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import multiprocessing
+from os import path
+
+import context
+from helpers import utils
+from plot import Plot
+from report import Report
+
+
+STAGES = ['plot', 'report']
+
+
+def run(data_dir, stages=STAGES, schemes=None, include_acklink=False,
+        no_graphs=False, delay_quantiles='samples', sketch_error=0.01,
+        jobs=None, no_cache=False, incremental=False):
+    """
+    Analyze the tests in data_dir in this process by running the given
+    stages in order, where 'plot' is plot.py and 'report' is report.py.
+
+    Test metadata and src/config.yml are read once, and the performance data
+    of 'plot' is passed to 'report' in memory. Returns the performance data
+    and statistics of 'plot', or (None, None) if it is not run.
+    """
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('unknown analysis stage %s' % stage)
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    args = argparse.Namespace(
+        data_dir=data_dir, schemes=schemes, include_acklink=include_acklink,
+        no_graphs=no_graphs, delay_quantiles=delay_quantiles,
+        sketch_error=sketch_error, jobs=jobs, no_cache=no_cache,
+        incremental=incremental)
+
+    metadata_path = path.join(data_dir, 'pantheon_metadata.json')
+    meta = utils.load_test_metadata(metadata_path)
+    config = utils.parse_config()
+
+    perf_data = None
+    stats = None
+
+    for stage in stages:
+        if stage == 'plot':
+            perf_data, stats = Plot(args, meta, config).run()
+        elif stage == 'report':
+            Report(args, meta, config).run(perf_data)
+
+    return perf_data, stats
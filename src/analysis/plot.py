@@ -5,31 +5,44 @@ import sys
 import math
 import json
 import multiprocessing
-from multiprocessing.pool import ThreadPool
 import numpy as np
 import matplotlib_agg
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
 import arg_parser
+import analysis_manifest
 import tunnel_graph
 import context
 from helpers import utils
 
 
 class Plot(object):
-    def __init__(self, args):
+    def __init__(self, args, meta=None, config=None):
         self.data_dir = path.abspath(args.data_dir)
         self.include_acklink = args.include_acklink
         self.no_graphs = args.no_graphs
-
-        metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
-        meta = utils.load_test_metadata(metadata_path)
-        self.cc_schemes = utils.verify_schemes_with_meta(args.schemes, meta)
+        self.delay_quantiles = args.delay_quantiles
+        self.sketch_error = args.sketch_error
+        self.jobs = args.jobs
+        self.use_cache = not args.no_cache
+        self.incremental = args.incremental
+
+        if meta is None:
+            metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
+            meta = utils.load_test_metadata(metadata_path)
+        if config is None:
+            config = utils.parse_config()
+
+        self.config = config
+        self.cc_schemes = utils.verify_schemes_with_meta(
+            args.schemes, meta, self.config)
 
         self.run_times = meta['run_times']
         self.flows = meta['flows']
         self.runtime = meta['runtime']
+        # runtimes of runs that differ from the runtime (e.g., of a sweep)
+        self.run_runtimes = meta.get('run_runtimes', {})
         self.expt_title = self.generate_expt_title(meta)
 
     def generate_expt_title(self, meta):
@@ -66,43 +79,57 @@ class Plot(object):
 
         return expt_title
 
-    def parse_tunnel_log(self, cc, run_id):
+    def link_directions(self):
+        link_directions = ['datalink']
+        if self.include_acklink:
+            link_directions.append('acklink')
+
+        return link_directions
+
+    def tunnel_log_path(self, cc, link_t, run_id):
         log_prefix = cc
         if self.flows == 0:
             log_prefix += '_mm'
 
+        log_name = log_prefix + '_%s_run%s.log' % (link_t, run_id)
+        return path.join(self.data_dir, log_name)
+
+    def graph_paths(self, cc, link_t, run_id):
+        if self.no_graphs:
+            return None, None
+
+        tput_graph = cc + '_%s_throughput_run%s.png' % (link_t, run_id)
+        delay_graph = cc + '_%s_delay_run%s.png' % (link_t, run_id)
+        return (path.join(self.data_dir, tput_graph),
+                path.join(self.data_dir, delay_graph))
+
+    def run_runtime(self, run_id):
+        return self.run_runtimes.get(str(run_id), self.runtime)
+
+    def parse_tunnel_log(self, cc, run_id):
         error = False
         ret = None
 
-        link_directions = ['datalink']
-        if self.include_acklink:
-            link_directions.append('acklink')
-
-        for link_t in link_directions:
-            log_name = log_prefix + '_%s_run%s.log' % (link_t, run_id)
-            log_path = path.join(self.data_dir, log_name)
+        for link_t in self.link_directions():
+            log_path = self.tunnel_log_path(cc, link_t, run_id)
 
             if not path.isfile(log_path):
                 sys.stderr.write('Warning: %s does not exist\n' % log_path)
                 error = True
                 continue
 
-            if self.no_graphs:
-                tput_graph_path = None
-                delay_graph_path = None
-            else:
-                tput_graph = cc + '_%s_throughput_run%s.png' % (link_t, run_id)
-                tput_graph_path = path.join(self.data_dir, tput_graph)
-
-                delay_graph = cc + '_%s_delay_run%s.png' % (link_t, run_id)
-                delay_graph_path = path.join(self.data_dir, delay_graph)
+            tput_graph_path, delay_graph_path = self.graph_paths(
+                cc, link_t, run_id)
 
             sys.stderr.write('$ tunnel_graph %s\n' % log_path)
             try:
                 tunnel_results = tunnel_graph.TunnelGraph(
                     tunnel_log=log_path,
                     throughput_graph=tput_graph_path,
-                    delay_graph=delay_graph_path).run()
+                    delay_graph=delay_graph_path,
+                    quantile_mode=self.delay_quantiles,
+                    sketch_error=self.sketch_error,
+                    use_cache=self.use_cache).run()
             except Exception as exception:
                 sys.stderr.write('Error: %s\n' % exception)
                 sys.stderr.write('Warning: "tunnel_graph %s" failed but '
@@ -116,11 +143,12 @@ class Plot(object):
                 ret = tunnel_results
                 duration = tunnel_results['duration'] / 1000.0
 
-                if duration < 0.8 * self.runtime:
+                runtime = self.run_runtime(run_id)
+                if duration < 0.8 * runtime:
                     sys.stderr.write(
                         'Warning: "tunnel_graph %s" had duration %.2f seconds '
                         'but should have been around %s seconds. Ignoring this'
-                        ' run.\n' % (log_path, duration, self.runtime))
+                        ' run.\n' % (log_path, duration, runtime))
                     error = True
 
         if error:
@@ -128,9 +156,42 @@ class Plot(object):
 
         return ret
 
+    def stats_log_path(self, cc, run_id):
+        return path.join(self.data_dir, '%s_stats_run%s.log' % (cc, run_id))
+
+    def run_inputs(self, cc, run_id):
+        # fingerprints of everything that the analysis of a run depends on
+        inputs = {'options': [self.include_acklink, self.no_graphs,
+                              self.delay_quantiles, self.sketch_error,
+                              self.run_runtime(run_id)]}
+
+        for link_t in self.link_directions():
+            log_path = self.tunnel_log_path(cc, link_t, run_id)
+            inputs[link_t] = analysis_manifest.fingerprint(log_path)
+            inputs[link_t + '_trace'] = analysis_manifest.trace_fingerprint(
+                log_path)
+        inputs['stats'] = analysis_manifest.fingerprint(
+            self.stats_log_path(cc, run_id))
+
+        return inputs
+
+    def run_outputs(self, cc, run_id):
+        outputs = []
+        for link_t in self.link_directions():
+            for graph_path in self.graph_paths(cc, link_t, run_id):
+                if graph_path is not None and path.isfile(graph_path):
+                    outputs.append(graph_path)
+
+        return outputs
+
+    def is_up_to_date(self, cc, run_id, entry):
+        if entry is None or entry['inputs'] != self.run_inputs(cc, run_id):
+            return False
+
+        return all([path.isfile(output) for output in entry['outputs']])
+
     def update_stats_log(self, cc, run_id, stats):
-        stats_log_path = path.join(
-            self.data_dir, '%s_stats_run%s.log' % (cc, run_id))
+        stats_log_path = self.stats_log_path(cc, run_id)
 
         if not path.isfile(stats_log_path):
             sys.stderr.write('Warning: %s does not exist\n' % stats_log_path)
@@ -142,7 +203,8 @@ class Plot(object):
         with open(stats_log_path) as stats_log:
             for line in stats_log:
                 if any([x in line for x in [
-                        'Start at:', 'End at:', 'clock offset:']]):
+                        'Aborted:', 'Start at:', 'End at:',
+                        'clock offset:']]):
                     saved_lines += line
                 else:
                     continue
@@ -165,30 +227,64 @@ class Plot(object):
             perf_data[cc] = {}
             stats[cc] = {}
 
-        cc_id = 0
-        run_id = 1
-        pool = ThreadPool(processes=multiprocessing.cpu_count())
+        # only analyze runs whose logs changed in incremental mode
+        manifest = {}
+        if self.incremental:
+            manifest = analysis_manifest.load(self.data_dir)
+        reused = set()
+
+        # analyze runs in worker processes as parsing and plotting are
+        # CPU-bound; results are collected in the order of submission
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(processes=self.jobs)
+        else:
+            pool = None
 
-        while cc_id < len(self.cc_schemes):
-            cc = self.cc_schemes[cc_id]
-            perf_data[cc][run_id] = pool.apply_async(
-                self.parse_tunnel_log, args=(cc, run_id))
+        for cc in self.cc_schemes:
+            for run_id in xrange(1, 1 + self.run_times):
+                entry = manifest.get('%s_run%s' % (cc, run_id))
+                if self.incremental and self.is_up_to_date(cc, run_id, entry):
+                    perf_data[cc][run_id] = analysis_manifest.load_results(
+                        entry['results'])
+                    reused.add((cc, run_id))
+                elif pool is None:
+                    perf_data[cc][run_id] = self.parse_tunnel_log(cc, run_id)
+                else:
+                    perf_data[cc][run_id] = pool.apply_async(
+                        parse_tunnel_log_worker, args=(self, cc, run_id))
 
-            run_id += 1
-            if run_id > self.run_times:
-                run_id = 1
-                cc_id += 1
+        if pool is not None:
+            pool.close()
 
         for cc in self.cc_schemes:
             for run_id in xrange(1, 1 + self.run_times):
-                perf_data[cc][run_id] = perf_data[cc][run_id].get()
+                if (cc, run_id) not in reused:
+                    if pool is not None:
+                        perf_data[cc][run_id] = get_worker_result(
+                            perf_data[cc][run_id], cc, run_id)
+
+                    if perf_data[cc][run_id] is not None:
+                        self.update_stats_log(
+                            cc, run_id, perf_data[cc][run_id]['stats'])
+
+                    if self.incremental:
+                        manifest['%s_run%s' % (cc, run_id)] = {
+                            'inputs': self.run_inputs(cc, run_id),
+                            'outputs': self.run_outputs(cc, run_id),
+                            'results': perf_data[cc][run_id]}
 
                 if perf_data[cc][run_id] is None:
                     continue
 
-                stats_str = perf_data[cc][run_id]['stats']
-                self.update_stats_log(cc, run_id, stats_str)
-                stats[cc][run_id] = stats_str
+                stats[cc][run_id] = perf_data[cc][run_id]['stats']
+
+        if pool is not None:
+            pool.join()
+
+        if self.incremental:
+            analysis_manifest.save(self.data_dir, manifest)
+            sys.stderr.write('Reused the analysis of %d unchanged runs\n'
+                             % len(reused))
 
         sys.stderr.write('Appended datalink statistics to stats files in %s\n'
                          % self.data_dir)
@@ -239,7 +335,7 @@ class Plot(object):
         fig_raw, ax_raw = plt.subplots()
         fig_mean, ax_mean = plt.subplots()
 
-        schemes_config = utils.parse_config()['schemes']
+        schemes_config = self.config['schemes']
         for cc in data:
             if not data[cc]:
                 sys.stderr.write('No performance data for scheme %s\n' % cc)
@@ -347,6 +443,23 @@ class Plot(object):
         with open(perf_path, 'w') as fh:
             json.dump(data_for_json, fh)
 
+        return perf_data, stats_logs
+
+
+def parse_tunnel_log_worker(plot, cc, run_id):
+    # module-level function so that it can be pickled to worker processes
+    return plot.parse_tunnel_log(cc, run_id)
+
+
+def get_worker_result(async_result, cc, run_id):
+    try:
+        return async_result.get()
+    except Exception as exception:
+        sys.stderr.write('Error: %s\n' % exception)
+        sys.stderr.write('Warning: analyzing run %s of %s failed but '
+                         'continued to run.\n' % (run_id, cc))
+        return None
+
 
 def main():
     args = arg_parser.parse_plot()
@@ -4,13 +4,15 @@ import sys
 from os import path
 import math
 import time
+import numpy as np
 import matplotlib_agg
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
 import arg_parser
+import analysis_cache
 import context
-from helpers import utils
+from helpers import utils, tunnel_log
 
 
 class PlotThroughputTime(object):
@@ -18,6 +20,7 @@ class PlotThroughputTime(object):
         self.data_dir = path.abspath(args.data_dir)
         self.ms_per_bin = args.ms_per_bin
         self.amplify = args.amplify
+        self.use_cache = not args.no_cache
 
         metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
         meta = utils.load_test_metadata(metadata_path)
@@ -29,7 +32,71 @@ class PlotThroughputTime(object):
     def ms_to_bin(self, ts, flow_base_ts):
         return int((ts - flow_base_ts) / self.ms_per_bin)
 
+    def add_departure(self, flow_departures, ts, flow_base_ts, num_bits):
+        # departures before the first bin of the flow are not counted
+        bin_id = self.ms_to_bin(ts, flow_base_ts)
+        if bin_id >= 0:
+            old_value = flow_departures.get(bin_id, 0)
+            flow_departures[bin_id] = old_value + num_bits
+
+    def throughput_over_time(self, log):
+        # same as parsing a text log below but on the columns of a log
+        us_per_bin = 1000.0 * self.ms_per_bin
+        clock_time = {}  # data for x-axis
+        throughput = {}  # data for y-axis
+
+        is_arrival = log.event == tunnel_log.ARRIVAL
+        is_departure = log.event == tunnel_log.DEPARTURE
+
+        for flow_id in np.unique(log.flow[is_departure]).tolist():
+            # timestamp when the flow sent the first byte
+            flow_arrival_ts = log.ts[is_arrival & (log.flow == flow_id)]
+            if len(flow_arrival_ts) == 0:
+                continue
+            flow_base_ts = flow_arrival_ts[0]
+
+            # the first departure of each flow is not counted
+            flow_departures = np.flatnonzero(
+                is_departure & (log.flow == flow_id))[1:]
+            bins = ((log.ts[flow_departures] - flow_base_ts) /
+                    self.ms_per_bin).astype(np.int64)
+            num_bits = log.size[flow_departures] * 8
+
+            in_range = bins >= 0
+            bits_per_bin = np.bincount(bins[in_range],
+                                       weights=num_bits[in_range])
+            if len(bits_per_bin) == 0:
+                continue  # no throughput to plot
+
+            start_ts = flow_base_ts + log.init_ts + self.ms_per_bin / 2.0
+            bin_ids = np.arange(len(bits_per_bin))
+            clock_time[flow_id] = (
+                (start_ts + bin_ids * self.ms_per_bin) / 1000.0).tolist()
+            throughput[flow_id] = (bits_per_bin / us_per_bin).tolist()
+
+        return clock_time, throughput
+
     def parse_tunnel_log(self, tunnel_log_path):
+        if not self.use_cache:
+            return self.parse_uncached_log(tunnel_log_path)
+
+        # reuse the series cached by tunnel_graph.py in plot.py if available
+        over_time = analysis_cache.load(tunnel_log_path,
+                                        ('over_time', self.ms_per_bin))
+        if over_time is None:
+            over_time = self.parse_uncached_log(tunnel_log_path)
+
+        return over_time
+
+    def parse_uncached_log(self, tunnel_log_path):
+        if (tunnel_log.is_binary(tunnel_log_path) or
+                tunnel_log.can_map(tunnel_log_path)):
+            return self.throughput_over_time(tunnel_log.load(tunnel_log_path))
+
+        # fall back to parsing the log line by line
+        return self.parse_text_log(tunnel_log_path)
+
+    def parse_text_log(self, tunnel_log_path):
         tunlog = open(tunnel_log_path)
 
         # read init timestamp
@@ -41,6 +108,7 @@ class PlotThroughputTime(object):
 
         flow_base_ts = {}  # timestamp when each flow sent the first byte
         departures = {}  # number of bits leaving the tunnel within a bin
+        early_departures = {}  # (ts, bits) of departures before any arrival
 
         while True:
             line = tunlog.readline()
@@ -63,6 +131,11 @@ class PlotThroughputTime(object):
 
                 if flow_id not in flow_base_ts:
                     flow_base_ts[flow_id] = ts
+
+                    for early_ts, early_bits in early_departures.pop(
+                            flow_id, []):
+                        self.add_departure(departures[flow_id], early_ts, ts,
+                                           early_bits)
             elif event_type == '-':
                 if len(items) == 5:
                     flow_id = int(items[-1])
@@ -71,10 +144,12 @@ class PlotThroughputTime(object):
 
                 if flow_id not in departures:
                     departures[flow_id] = {}
+                elif flow_id in flow_base_ts:
+                    self.add_departure(departures[flow_id], ts,
+                                       flow_base_ts[flow_id], num_bits)
                 else:
-                    bin_id = self.ms_to_bin(ts, flow_base_ts[flow_id])
-                    old_value = departures[flow_id].get(bin_id, 0)
-                    departures[flow_id][bin_id] = old_value + num_bits
+                    early_departures.setdefault(flow_id, []).append(
+                        (ts, num_bits))
 
         tunlog.close()
 
@@ -83,6 +158,9 @@ class PlotThroughputTime(object):
         clock_time = {}  # data for x-axis
         throughput = {}  # data for y-axis
         for flow_id in departures:
+            if not departures[flow_id]:
+                continue  # no throughput to plot
+
             start_ts = flow_base_ts[flow_id] + init_ts + self.ms_per_bin / 2.0
             clock_time[flow_id] = []
             throughput[flow_id] = []
@@ -9,23 +9,31 @@ import uuid
 import numpy as np
 
 import arg_parser
+import analysis_cache
 import context
 from helpers import utils
 from helpers.subprocess_wrappers import check_call, check_output
 
 
 class Report(object):
-    def __init__(self, args):
+    def __init__(self, args, meta=None, config=None):
         self.data_dir = path.abspath(args.data_dir)
         self.include_acklink = args.include_acklink
+        self.use_cache = not args.no_cache
 
-        metadata_path = path.join(args.data_dir, 'pantheon_metadata.json')
-        self.meta = utils.load_test_metadata(metadata_path)
-        self.cc_schemes = utils.verify_schemes_with_meta(args.schemes, self.meta)
+        if meta is None:
+            metadata_path = path.join(args.data_dir, 'pantheon_metadata.json')
+            meta = utils.load_test_metadata(metadata_path)
+        if config is None:
+            config = utils.parse_config()
+
+        self.meta = meta
+        self.config = config
+        self.cc_schemes = utils.verify_schemes_with_meta(
+            args.schemes, self.meta, self.config)
 
         self.run_times = self.meta['run_times']
         self.flows = self.meta['flows']
-        self.config = utils.parse_config()
 
     def describe_metadata(self):
         desc = '\\centerline{\\textbf{\\large{Pantheon Report}}}\n'
@@ -165,7 +173,30 @@ class Report(object):
 
         return table
 
-    def summary_table(self):
+    def load_cached_results(self, cc, run_id, stats_log_path):
+        # results cached by tunnel_graph.py, provided that they are the
+        # statistics appended to the stats log by plot.py
+        log_prefix = cc
+        if self.flows == 0:
+            log_prefix += '_mm'
+
+        log_path = path.join(self.data_dir, '%s_datalink_run%s.log'
+                             % (log_prefix, run_id))
+        if not path.isfile(log_path):
+            return None
+
+        results = analysis_cache.load(log_path, 'results')
+        if results is None:
+            return None
+
+        with open(stats_log_path) as stats_log:
+            if ('# Datalink statistics\n' + results['stats'] not in
+                    stats_log.read()):
+                return None
+
+        return results
+
+    def summary_table(self, perf_data=None):
         data = {}
 
         re_tput = lambda x: re.match(r'Average throughput: (.*?) Mbit/s', x)
@@ -195,6 +226,27 @@ class Report(object):
                 if not path.isfile(stats_log_path):
                     continue
 
+                # use results passed in memory or cached if available
+                if perf_data is not None and cc in perf_data:
+                    results = perf_data[cc].get(run_id)
+                    if results is None:
+                        continue
+                elif self.use_cache:
+                    results = self.load_cached_results(
+                        cc, run_id, stats_log_path)
+                else:
+                    results = None
+
+                if results is not None:
+                    data[cc]['valid_runs'] += 1
+                    flow_stats = round_flow_stats(results['flow_data'])
+                    for flow_id in xrange(1, self.flows + 1):
+                        for data_t in flow_stats.get(flow_id, {}):
+                            data[cc][flow_id][data_t] += (
+                                flow_stats[flow_id][data_t])
+                    continue
+
+                # otherwise parse statistics from the stats log
                 stats_log = open(stats_log_path)
 
                 valid_run = False
@@ -235,7 +287,7 @@ class Report(object):
 
         return self.create_table(data)
 
-    def include_summary(self):
+    def include_summary(self, perf_data=None):
         raw_summary = path.join(self.data_dir, 'pantheon_summary.pdf')
         mean_summary = path.join(
             self.data_dir, 'pantheon_summary_mean.pdf')
@@ -261,7 +313,7 @@ class Report(object):
             '\\newpage\n\n'
             % (metadata_desc, mean_summary, raw_summary))
 
-        self.latex.write('%s\\newpage\n\n' % self.summary_table())
+        self.latex.write('%s\\newpage\n\n' % self.summary_table(perf_data))
 
     def include_runs(self):
         cc_id = 0
@@ -316,11 +368,11 @@ class Report(object):
 
         self.latex.write('\\end{document}')
 
-    def run(self):
+    def run(self, perf_data=None):
         report_uid = uuid.uuid4()
         latex_path = path.join(utils.tmp_dir, 'pantheon_report_%s.tex' % report_uid)
         self.latex = open(latex_path, 'w')
-        self.include_summary()
+        self.include_summary(perf_data)
         self.include_runs()
         self.latex.close()
 
@@ -336,6 +388,27 @@ class Report(object):
             'Saved pantheon_report.pdf in %s\n' % self.data_dir)
 
 
+def round_flow_stats(flow_data):
+    # per-flow statistics rounded in the same way as in stats logs
+    flow_stats = {}
+    for flow_id in flow_data:
+        if flow_id == 'all':
+            continue
+
+        flow_stats[flow_id] = {'tput': [], 'delay': [], 'loss': []}
+        if flow_data[flow_id]['tput'] is not None:
+            flow_stats[flow_id]['tput'].append(
+                float('%.2f' % flow_data[flow_id]['tput']))
+        if flow_data[flow_id]['delay'] is not None:
+            flow_stats[flow_id]['delay'].append(
+                float('%.3f' % flow_data[flow_id]['delay']))
+        if flow_data[flow_id]['loss'] is not None:
+            flow_stats[flow_id]['loss'].append(
+                float('%.2f' % (flow_data[flow_id]['loss'] * 100.0)))
+
+    return flow_stats
+
+
 def main():
     args = arg_parser.parse_report()
     Report(args).run()
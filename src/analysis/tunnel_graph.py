@@ -9,153 +9,270 @@ import matplotlib_agg
 import matplotlib.pyplot as plt
 
 import arg_parser
+import analysis_cache
+import context
+from helpers import tunnel_log, quantiles, link_trace
 
 
 class TunnelGraph(object):
+    # attributes set by parse_tunnel_log() and saved in the analysis cache;
+    # per-packet delays to plot are cached separately, and the delay stats
+    # of flows are not cached in 'samples' mode as they keep every delay
+    analysis_attrs = [
+        'flows', 'first_ts', 'avg_capacity', 'link_capacity', 'link_capacity_t',
+        'ingress_tput', 'egress_tput', 'ingress_t', 'egress_t',
+        'avg_ingress', 'avg_egress', 'percentile_delay', 'delay_stats',
+        'loss_rate', 'total_loss_rate', 'total_avg_egress', 'total_duration',
+        'total_percentile_delay', 'over_time']
+
     def __init__(self, tunnel_log, throughput_graph=None, delay_graph=None,
-                 ms_per_bin=500):
+                 ms_per_bin=500, quantile_mode='samples', sketch_error=0.01,
+                 use_cache=True):
         self.tunnel_log = tunnel_log
         self.throughput_graph = throughput_graph
         self.delay_graph = delay_graph
         self.ms_per_bin = ms_per_bin
 
+        # 'samples' keeps every per-packet delay; 'exact' and 'sketch' only
+        # keep a histogram or sketch of delays for each flow
+        self.quantile_mode = quantile_mode
+        self.sketch_error = sketch_error
+
+        # reuse and save analyses in a sidecar cache of the tunnel log
+        self.use_cache = use_cache
+
     def ms_to_bin(self, ts, first_ts):
-        return int((ts - first_ts) / self.ms_per_bin)
+        return ((ts - first_ts) / self.ms_per_bin).astype(np.int64)
 
     def bin_to_s(self, bin_id):
         return bin_id * self.ms_per_bin / 1000.0
 
-    def parse_tunnel_log(self):
-        tunlog = open(self.tunnel_log)
+    def new_delay_stats(self):
+        if self.quantile_mode == 'exact':
+            return quantiles.ExactHistogram()
+        elif self.quantile_mode == 'sketch':
+            return quantiles.LogSketch(self.sketch_error)
+        else:
+            return quantiles.Samples()
+
+    def new_events(self):
+        # accumulated statistics of arrivals, departures or opportunities
+        return {'first_ts': None, 'last_ts': None, 'bits': 0,
+                'bins': quantiles.CountStore()}
+
+    def add_events(self, events, ts, bins, num_bits):
+        if len(ts) == 0:
+            return
+
+        if events['first_ts'] is None:
+            events['first_ts'] = float(ts[0])
+        last_ts = float(ts.max())
+        if events['last_ts'] is None or last_ts > events['last_ts']:
+            events['last_ts'] = last_ts
+
+        events['bits'] += int(num_bits.sum())
+        events['bins'].add(bins, num_bits)
+
+    def binned_series(self, events):
+        # convert bits in consecutive bins to Mbit/s
+        us_per_bin = 1000.0 * self.ms_per_bin
+        bin_ids = events['bins'].keys()
+        return (events['bins'].counts / us_per_bin).tolist(), bin_ids
+
+    def over_time_series(self, init_ts, first_arrival_ts, bins):
+        # throughput of each flow over clock time as in plot_over_time.py:
+        # bins start at the first arrival of the flow and the bins before
+        # the last non-empty one are all included
+        us_per_bin = 1000.0 * self.ms_per_bin
+        clock_time = {}
+        throughput = {}
+
+        for flow_id in bins:
+            bits_per_bin = np.zeros(bins[flow_id].offset + len(bins[flow_id]))
+            bits_per_bin[bins[flow_id].offset:] = bins[flow_id].counts
+
+            start_ts = (first_arrival_ts[flow_id] + init_ts +
+                        self.ms_per_bin / 2.0)
+            bin_ids = np.arange(len(bits_per_bin))
+            clock_time[flow_id] = (
+                (start_ts + bin_ids * self.ms_per_bin) / 1000.0).tolist()
+            throughput[flow_id] = (bits_per_bin / us_per_bin).tolist()
+
+        return clock_time, throughput
+
+    def group_by_flow(self, mask, flow):
+        # group indices of events selected by mask by flow ID in a stable
+        # order so that the first index of each group comes first in the log
+        order = np.flatnonzero(mask)
+        order = order[np.argsort(flow[order], kind='mergesort')]
+
+        flow_ids, group_start = np.unique(flow[order], return_index=True)
+        group_end = np.append(group_start[1:], len(order))
+
+        for i, flow_id in enumerate(flow_ids.tolist()):
+            yield flow_id, order[group_start[i]:group_end[i]]
+
+    def read_link_trace(self):
+        # (trace timestamps, offset in ms) of the link named in the log
+        link = tunnel_log.read_link_trace(self.tunnel_log)
+        if link is None:
+            return None
+
+        trace_path, offset = link
+        try:
+            return link_trace.read_trace(trace_path), offset
+        except (IOError, ValueError) as exception:
+            sys.stderr.write('Warning: no link capacity from trace %s: %s\n'
+                             % (trace_path, exception))
+            return None
+
+    def add_trace_capacities(self, capacities, trace, first_ts, last_ts):
+        # opportunities of the link replaying the trace until the last event
+        timestamps, offset = trace
+        counts = link_trace.opportunities_per_ms(timestamps, last_ts - offset)
+
+        ms = np.flatnonzero(counts)
+        ts = ms + offset
+        self.add_events(capacities, ts, self.ms_to_bin(ts, first_ts),
+                        counts[ms] * link_trace.MTU * 8)
 
+    def parse_tunnel_log(self):
         self.flows = {}
         first_ts = None
-        capacities = {}
+        last_ts = None
+        init_ts = None
+
+        # capacity is computed from the link trace if the log names one
+        # instead of containing delivery opportunities
+        trace = self.read_link_trace()
 
+        capacities = self.new_events()
         arrivals = {}
         departures = {}
-        self.delays_t = {}
-        self.delays = {}
-
-        first_capacity = None
-        last_capacity = None
-        first_arrival = {}
-        last_arrival = {}
-        first_departure = {}
-        last_departure = {}
+        delay_stats = {}
+        delay_points = {}
+        over_time_bins = {}
 
         total_first_departure = None
         total_last_departure = None
-        total_arrivals = 0
-        total_departures = 0
 
-        while True:
-            line = tunlog.readline()
-            if not line:
-                break
-
-            if line.startswith('#'):
+        # accumulate statistics chunk by chunk so that memory does not grow
+        # with the length of the log unless per-packet delays are kept
+        for log in tunnel_log.iter_chunks(self.tunnel_log):
+            ts = log.ts
+            if len(ts) == 0:
                 continue
 
-            items = line.split()
-            ts = float(items[0])
-            event_type = items[1]
-            num_bits = int(items[2]) * 8
-
             if first_ts is None:
-                first_ts = ts
-
-            bin_id = self.ms_to_bin(ts, first_ts)
-
-            if event_type == '#':
-                capacities[bin_id] = capacities.get(bin_id, 0) + num_bits
-
-                if first_capacity is None:
-                    first_capacity = ts
-
-                if last_capacity is None or ts > last_capacity:
-                    last_capacity = ts
-            elif event_type == '+':
-                if len(items) == 4:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
-
+                first_ts = ts[0]
+                init_ts = log.init_ts
+
+                if trace is not None:
+                    # the first opportunity may precede the first packet
+                    first_ts = min(first_ts, trace[1] + trace[0][0])
+            last_ts = max(last_ts, ts.max())
+
+            bins = self.ms_to_bin(ts, first_ts)
+            num_bits = log.size * 8
+
+            is_capacity = log.event == tunnel_log.OPPORTUNITY
+            is_arrival = log.event == tunnel_log.ARRIVAL
+            is_departure = log.event == tunnel_log.DEPARTURE
+
+            # insert flow IDs in the order of first appearance in the log
+            is_packet = is_arrival | is_departure
+            flow_ids, first_index = np.unique(log.flow[is_packet],
+                                              return_index=True)
+            for flow_id in flow_ids[np.argsort(first_index)].tolist():
                 self.flows[flow_id] = True
 
-                if flow_id not in arrivals:
-                    arrivals[flow_id] = {}
-                    first_arrival[flow_id] = ts
-
-                if flow_id not in last_arrival:
-                    last_arrival[flow_id] = ts
-                else:
-                    if ts > last_arrival[flow_id]:
-                        last_arrival[flow_id] = ts
+            self.add_events(capacities, ts[is_capacity], bins[is_capacity],
+                            num_bits[is_capacity])
 
-                old_value = arrivals[flow_id].get(bin_id, 0)
-                arrivals[flow_id][bin_id] = old_value + num_bits
+            # update total variables
+            if is_departure.any():
+                departure_ts = ts[is_departure]
+                if total_first_departure is None:
+                    total_first_departure = float(departure_ts[0])
+                last_departure_ts = float(departure_ts.max())
+                if (total_last_departure is None or
+                        last_departure_ts > total_last_departure):
+                    total_last_departure = last_departure_ts
 
-                total_arrivals += num_bits
-            elif event_type == '-':
-                if len(items) == 5:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
+            for flow_id, indices in self.group_by_flow(is_arrival, log.flow):
+                if flow_id not in arrivals:
+                    arrivals[flow_id] = self.new_events()
+                self.add_events(arrivals[flow_id], ts[indices],
+                                bins[indices], num_bits[indices])
 
-                self.flows[flow_id] = True
+            for flow_id, indices in self.group_by_flow(is_departure,
+                                                       log.flow):
+                over_time_indices = indices
 
                 if flow_id not in departures:
-                    departures[flow_id] = {}
-                    first_departure[flow_id] = ts
-
-                if flow_id not in last_departure:
-                    last_departure[flow_id] = ts
+                    departures[flow_id] = self.new_events()
+                    over_time_bins[flow_id] = quantiles.CountStore()
+                    # plot_over_time.py does not count the first departure
+                    over_time_indices = indices[1:]
+                    delay_stats[flow_id] = self.new_delay_stats()
+                    if self.quantile_mode == 'samples':
+                        delay_points[flow_id] = quantiles.Samples()
+                    else:
+                        delay_points[flow_id] = quantiles.DecimatedSeries()
+                self.add_events(departures[flow_id], ts[indices],
+                                bins[indices], num_bits[indices])
+
+                # store delays of each flow to plot and to compute quantiles
+                delays = log.delay[indices]
+                delays_t = (ts[indices] - first_ts) / 1000.0
+                delay_stats[flow_id].add(delays)
+                if self.quantile_mode == 'samples':
+                    delay_points[flow_id].add(delays_t)
                 else:
-                    if ts > last_departure[flow_id]:
-                        last_departure[flow_id] = ts
-
-                old_value = departures[flow_id].get(bin_id, 0)
-                departures[flow_id][bin_id] = old_value + num_bits
+                    delay_points[flow_id].add(delays_t, delays)
 
-                total_departures += num_bits
-
-                # update total variables
-                if total_first_departure is None:
-                    total_first_departure = ts
-                if (total_last_departure is None or
-                        ts > total_last_departure):
-                    total_last_departure = ts
+                # bin departures since the first arrival of the flow
+                if flow_id in arrivals:
+                    arrival_bins = self.ms_to_bin(
+                        ts[over_time_indices], arrivals[flow_id]['first_ts'])
+                    in_range = arrival_bins >= 0
+                    over_time_bins[flow_id].add(
+                        arrival_bins[in_range],
+                        num_bits[over_time_indices][in_range])
 
-                # store delays in a list for each flow and sort later
-                delay = float(items[3])
-                if flow_id not in self.delays:
-                    self.delays[flow_id] = []
-                    self.delays_t[flow_id] = []
-                self.delays[flow_id].append(delay)
-                self.delays_t[flow_id].append((ts - first_ts) / 1000.0)
+        self.first_ts = first_ts
 
-        tunlog.close()
+        # per-packet delays to plot, decimated unless all delays are kept
+        self.delays_t = {}
+        self.delays = {}
+        for flow_id in departures:
+            if self.quantile_mode == 'samples':
+                self.delays[flow_id] = delay_stats[flow_id].values()
+                self.delays_t[flow_id] = delay_points[flow_id].values()
+            else:
+                self.delays[flow_id] = delay_points[flow_id].values
+                self.delays_t[flow_id] = delay_points[flow_id].t
 
-        us_per_bin = 1000.0 * self.ms_per_bin
+        if trace is not None and first_ts is not None:
+            self.add_trace_capacities(capacities, trace, first_ts, last_ts)
 
         self.avg_capacity = None
         self.link_capacity = []
         self.link_capacity_t = []
-        if capacities:
+        if capacities['first_ts'] is not None:
             # calculate average capacity
+            first_capacity = capacities['first_ts']
+            last_capacity = capacities['last_ts']
+
             if last_capacity == first_capacity:
                 self.avg_capacity = 0
             else:
                 delta = 1000.0 * (last_capacity - first_capacity)
-                self.avg_capacity = sum(capacities.values()) / delta
+                self.avg_capacity = capacities['bits'] / delta
 
             # transform capacities into a list
-            capacity_bins = capacities.keys()
-            for bin_id in xrange(min(capacity_bins), max(capacity_bins) + 1):
-                self.link_capacity.append(
-                    capacities.get(bin_id, 0) / us_per_bin)
-                self.link_capacity_t.append(self.bin_to_s(bin_id))
+            self.link_capacity, capacity_bins = self.binned_series(capacities)
+            self.link_capacity_t = self.bin_to_s(capacity_bins).tolist()
 
         # calculate ingress and egress throughput for each flow
         self.ingress_tput = {}
@@ -167,7 +284,9 @@ class TunnelGraph(object):
         self.percentile_delay = {}
         self.loss_rate = {}
 
-        total_delays = []
+        total_delay_stats = self.new_delay_stats()
+        total_arrivals = 0
+        total_departures = 0
 
         for flow_id in self.flows:
             self.ingress_tput[flow_id] = []
@@ -179,54 +298,52 @@ class TunnelGraph(object):
 
             if flow_id in arrivals:
                 # calculate average ingress and egress throughput
-                first_arrival_ts = first_arrival[flow_id]
-                last_arrival_ts = last_arrival[flow_id]
+                first_arrival_ts = arrivals[flow_id]['first_ts']
+                last_arrival_ts = arrivals[flow_id]['last_ts']
+                total_arrivals += arrivals[flow_id]['bits']
 
                 if last_arrival_ts == first_arrival_ts:
                     self.avg_ingress[flow_id] = 0
                 else:
                     delta = 1000.0 * (last_arrival_ts - first_arrival_ts)
-                    flow_arrivals = sum(arrivals[flow_id].values())
+                    flow_arrivals = arrivals[flow_id]['bits']
                     self.avg_ingress[flow_id] = flow_arrivals / delta
 
-                ingress_bins = arrivals[flow_id].keys()
-                for bin_id in xrange(min(ingress_bins), max(ingress_bins) + 1):
-                    self.ingress_tput[flow_id].append(
-                        arrivals[flow_id].get(bin_id, 0) / us_per_bin)
-                    self.ingress_t[flow_id].append(self.bin_to_s(bin_id))
+                self.ingress_tput[flow_id], ingress_bins = (
+                    self.binned_series(arrivals[flow_id]))
+                self.ingress_t[flow_id] = self.bin_to_s(ingress_bins).tolist()
 
             if flow_id in departures:
-                first_departure_ts = first_departure[flow_id]
-                last_departure_ts = last_departure[flow_id]
+                first_departure_ts = departures[flow_id]['first_ts']
+                last_departure_ts = departures[flow_id]['last_ts']
+                total_departures += departures[flow_id]['bits']
 
                 if last_departure_ts == first_departure_ts:
                     self.avg_egress[flow_id] = 0
                 else:
                     delta = 1000.0 * (last_departure_ts - first_departure_ts)
-                    flow_departures = sum(departures[flow_id].values())
+                    flow_departures = departures[flow_id]['bits']
                     self.avg_egress[flow_id] = flow_departures / delta
 
-                egress_bins = departures[flow_id].keys()
+                egress_tput, egress_bins = self.binned_series(
+                    departures[flow_id])
 
-                self.egress_tput[flow_id].append(0.0)
-                self.egress_t[flow_id].append(self.bin_to_s(min(egress_bins)))
-
-                for bin_id in xrange(min(egress_bins), max(egress_bins) + 1):
-                    self.egress_tput[flow_id].append(
-                        departures[flow_id].get(bin_id, 0) / us_per_bin)
-                    self.egress_t[flow_id].append(self.bin_to_s(bin_id + 1))
+                self.egress_tput[flow_id] = [0.0] + egress_tput
+                self.egress_t[flow_id] = (
+                    [self.bin_to_s(int(egress_bins[0]))] +
+                    self.bin_to_s(egress_bins + 1).tolist())
 
             # calculate 95th percentile per-packet one-way delay
             self.percentile_delay[flow_id] = None
-            if flow_id in self.delays:
-                self.percentile_delay[flow_id] = np.percentile(
-                    self.delays[flow_id], 95, interpolation='nearest')
-                total_delays += self.delays[flow_id]
+            if flow_id in delay_stats:
+                self.percentile_delay[flow_id] = (
+                    delay_stats[flow_id].quantile(95))
+                total_delay_stats.merge(delay_stats[flow_id])
 
             # calculate loss rate for each flow
             if flow_id in arrivals and flow_id in departures:
-                flow_arrivals = sum(arrivals[flow_id].values())
-                flow_departures = sum(departures[flow_id].values())
+                flow_arrivals = arrivals[flow_id]['bits']
+                flow_departures = departures[flow_id]['bits']
 
                 self.loss_rate[flow_id] = None
                 if flow_arrivals > 0:
@@ -247,10 +364,78 @@ class TunnelGraph(object):
             self.total_avg_egress = total_departures / (
                 1000.0 * self.total_duration)
 
-        self.total_percentile_delay = None
-        if total_delays:
-            self.total_percentile_delay = np.percentile(
-                total_delays, 95, interpolation='nearest')
+        self.total_percentile_delay = total_delay_stats.quantile(95)
+
+        # histograms or sketches of delays to compute other percentiles
+        self.delay_stats = None
+        if self.quantile_mode != 'samples':
+            self.delay_stats = {'all': total_delay_stats}
+            self.delay_stats.update(delay_stats)
+
+        # throughput over clock time to plot with plot_over_time.py
+        self.over_time = None
+        if init_ts is not None:
+            first_arrival_ts = {}
+            for flow_id in over_time_bins.keys():
+                # skip flows with no throughput to plot
+                if flow_id in arrivals and len(over_time_bins[flow_id]) > 0:
+                    first_arrival_ts[flow_id] = arrivals[flow_id]['first_ts']
+                else:
+                    del over_time_bins[flow_id]
+
+            self.over_time = self.over_time_series(
+                init_ts, first_arrival_ts, over_time_bins)
+
+    def cache_key(self):
+        return ('tunnel_graph', self.ms_per_bin, self.quantile_mode,
+                self.sketch_error)
+
+    def delays_cache_key(self):
+        return ('delays',) + self.cache_key()
+
+    def read_delays(self):
+        # read only the per-packet delays of each flow from the log to plot
+        # them along with a cached analysis in 'samples' mode
+        delays = {}
+        delays_t = {}
+        for log in tunnel_log.iter_chunks(self.tunnel_log):
+            is_departure = log.event == tunnel_log.DEPARTURE
+            for flow_id, indices in self.group_by_flow(is_departure,
+                                                       log.flow):
+                if flow_id not in delays:
+                    delays[flow_id] = quantiles.Samples()
+                    delays_t[flow_id] = quantiles.Samples()
+                delays[flow_id].add(log.delay[indices])
+                delays_t[flow_id].add(
+                    (log.ts[indices] - self.first_ts) / 1000.0)
+
+        self.delays = {}
+        self.delays_t = {}
+        for flow_id in delays:
+            self.delays[flow_id] = delays[flow_id].values()
+            self.delays_t[flow_id] = delays_t[flow_id].values()
+
+    def load_cache(self):
+        entries = analysis_cache.load_entries(self.tunnel_log)
+        analysis = entries.get(self.cache_key())
+        if analysis is None:
+            return False
+
+        delays = None
+        if self.delay_graph and self.quantile_mode != 'samples':
+            delays = entries.get(self.delays_cache_key())
+            if delays is None:
+                return False
+
+        for attr in self.analysis_attrs:
+            setattr(self, attr, analysis[attr])
+
+        if delays is not None:
+            self.delays, self.delays_t = delays
+        elif self.delay_graph:
+            # every delay is plotted in 'samples' mode, too many to cache
+            self.read_delays()
+        return True
 
     def flip(self, items, ncol):
         return list(itertools.chain(*[items[i::ncol] for i in range(ncol)]))
@@ -319,7 +504,7 @@ class TunnelGraph(object):
             color = colors[color_i]
             if flow_id in self.delays and flow_id in self.delays_t:
                 empty_graph = False
-                max_delay = max(max_delay, max(self.delays_t[flow_id]))
+                max_delay = max(max_delay, self.delays_t[flow_id].max())
 
                 ax.scatter(self.delays_t[flow_id], self.delays[flow_id], s=1,
                            color=color, marker='.',
@@ -394,7 +579,9 @@ class TunnelGraph(object):
         return ret
 
     def run(self):
-        self.parse_tunnel_log()
+        cached = self.use_cache and self.load_cache()
+        if not cached:
+            self.parse_tunnel_log()
 
         if self.throughput_graph:
             self.plot_throughput_graph()
@@ -426,6 +613,21 @@ class TunnelGraph(object):
 
         tunnel_results['flow_data'] = flow_data
 
+        if self.use_cache and not cached:
+            analysis = {}
+            for attr in self.analysis_attrs:
+                analysis[attr] = getattr(self, attr)
+
+            entries = {self.cache_key(): analysis,
+                       'results': tunnel_results}
+            if self.over_time is not None:
+                entries[('over_time', self.ms_per_bin)] = self.over_time
+            if self.quantile_mode != 'samples':
+                # the delays to plot are decimated to a bounded size
+                entries[self.delays_cache_key()] = (self.delays,
+                                                    self.delays_t)
+            analysis_cache.save(self.tunnel_log, entries)
+
         return tunnel_results
 
 
@@ -436,7 +638,10 @@ def main():
         tunnel_log=args.tunnel_log,
         throughput_graph=args.throughput_graph,
         delay_graph=args.delay_graph,
-        ms_per_bin=args.ms_per_bin)
+        ms_per_bin=args.ms_per_bin,
+        quantile_mode=args.delay_quantiles,
+        sketch_error=args.sketch_error,
+        use_cache=not args.no_cache)
     tunnel_results = tunnel_graph.run()
 
     sys.stderr.write(tunnel_results['stats'])
@@ -4,7 +4,8 @@ import yaml
 import argparse
 
 import context
-from helpers import utils
+import sweep
+from helpers import utils, link_trace
 
 
 def verify_schemes(schemes):
@@ -85,8 +86,9 @@ def parse_test_shared(local, remote, config_args):
             '-t', '--runtime', type=int, default=30,
             help='total runtime in seconds (default 30)')
         mode.add_argument(
-            '--interval', type=int, default=0,
-            help='interval in seconds between two flows (default 0)')
+            '--interval', type=float, default=0,
+            help='interval in seconds between two flows, with millisecond '
+            'resolution (default 0)')
         mode.add_argument(
             '--do_log', action='store_true', 
             help='do we log the running infomation generated by mm-link and mm-tunnel?'
@@ -97,6 +99,33 @@ def parse_test_shared(local, remote, config_args):
                            help='test all schemes specified in src/config.yml')
             group.add_argument('--schemes', metavar='"SCHEME1 SCHEME2..."',
                                help='test a space-separated list of schemes')
+            group.add_argument(
+                '--sweep', metavar='"SCHEME{PARAM=VALUES;...}"',
+                help='sweep the params of a scheme by successive halving, '
+                'where VALUES are comma-separated values or a range LOW..HIGH')
+
+        mode.add_argument(
+            '--sweep-sampler', choices=sweep.SAMPLERS, default='lhs',
+            help='sample configs of --sweep from all combinations of values '
+            '(grid), at random, or by Latin hypercube sampling (default lhs)')
+        mode.add_argument(
+            '--sweep-samples', metavar='N', type=int, default=16,
+            help='number of configs of --sweep to sample (default 16)')
+        mode.add_argument(
+            '--sweep-rounds', metavar='N', type=int, default=3,
+            help='rounds of successive halving, the last of which runs for '
+            '--runtime (default 3)')
+        mode.add_argument(
+            '--sweep-eta', metavar='ETA', type=int, default=2,
+            help='keep the best 1/ETA of configs after each round and run '
+            'them ETA times longer (default 2)')
+        mode.add_argument(
+            '--sweep-metric', choices=sweep.METRICS, default='power',
+            help='score configs by throughput, 95th percentile delay or '
+            'throughput/delay (default power)')
+        mode.add_argument(
+            '--sweep-seed', metavar='SEED', type=int, default=0,
+            help='seed to sample configs (default 0)')
 
         mode.add_argument('--run-times', metavar='TIMES', type=int, default=1,
                           help='run times of each scheme (default 1)')
@@ -104,6 +133,18 @@ def parse_test_shared(local, remote, config_args):
                           help='run ID to start with')
         mode.add_argument('--random-order', action='store_true',
                           help='test schemes in random order')
+        mode.add_argument(
+            '--retries', metavar='TIMES', type=int, default=0,
+            help='times to retry a failed run (default 0)')
+        mode.add_argument(
+            '--retry-backoff', metavar='SEC', type=float, default=10,
+            help='seconds to wait before the first retry of a run, doubled '
+            'before each further retry (default 10)')
+        mode.add_argument(
+            '--resume', action='store_true',
+            help='resume the sweep in --data-dir where it stopped, skipping '
+            'runs in its manifest whose logs are unchanged and merging its '
+            'metadata')
         mode.add_argument(
             '--data-dir', metavar='DIR',
             default=path.join(context.src_dir, 'experiments', 'data'),
@@ -115,6 +156,50 @@ def parse_test_shared(local, remote, config_args):
         mode.add_argument('--extra-sender-args',
                           metavar='--arg1=val1 --arg2=val2...', default='',
                           help='extra arguments to pass to sender wrapper')
+        mode.add_argument(
+            '--reuse-tunnel-managers', action='store_true',
+            help='keep tunnel managers (and their ssh connections and '
+            'mahimahi shells) running across tests, only resetting their '
+            'tunnels after each test')
+        mode.add_argument(
+            '--binary-logs', action='store_true',
+            help='save datalink and acklink logs in the binary tunnel log '
+            'format, which is faster to analyze')
+        mode.add_argument(
+            '--live-stats', action='store_true',
+            help='tail datalink logs while each test runs and save rolling '
+            'throughput, delay and loss of each flow as JSON lines in '
+            '<cc>_live_stats_run<id>.jsonl (requires --do_log)')
+        mode.add_argument(
+            '--live-interval', metavar='SEC', type=float, default=1,
+            help='interval between two live statistics (default 1)')
+        mode.add_argument(
+            '--live-window', metavar='SEC', type=float, default=5,
+            help='window of rolling throughput and delay (default 5)')
+        mode.add_argument(
+            '--live-min-tput', metavar='MBPS', type=float,
+            help='abort a test once its total live throughput falls below '
+            'MBPS (implies --live-stats)')
+        mode.add_argument(
+            '--live-grace', metavar='SEC', type=float, default=10,
+            help='seconds after flows start before --live-min-tput applies '
+            '(default 10)')
+        mode.add_argument(
+            '--abort-idle', metavar='SEC', type=float,
+            help='abort a test once no datalink bytes leave the tunnels for '
+            'SEC seconds (requires --do_log)')
+        mode.add_argument(
+            '--abort-exited', action='store_true',
+            help='abort a test as soon as a tunnel, a tunnel manager or a '
+            'scheme run without tunnels exits before the runtime ends')
+        mode.add_argument(
+            '--abort-unconnected', metavar='SEC', type=float,
+            help='abort a test if its tunnels are not connected within SEC '
+            'seconds instead of running tunnel clients up to 3 times')
+        mode.add_argument(
+            '--reschedule', metavar='TIMES', type=int, default=1,
+            help='times to run a test again right away after it is aborted '
+            'by --abort-* or --live-min-tput (default 1)')
 
 
 def parse_test_local(local):
@@ -128,6 +213,15 @@ def parse_test_local(local):
         default=path.join(context.src_dir, 'experiments', '12mbps.trace'),
         help='downlink trace (from receiver to sender) to pass to mm-link '
         '(default pantheon/test/12mbps.trace)')
+    local.add_argument(
+        '--uplink-schedule', metavar='SCHEDULE',
+        help='rate schedule in Mbit/s (YAML, see src/helpers/link_trace.py) '
+        'to compile into the uplink trace instead of --uplink-trace, e.g. '
+        '"{type: ramp, from: 12, to: 48, duration: 10}"')
+    local.add_argument(
+        '--downlink-schedule', metavar='SCHEDULE',
+        help='rate schedule in Mbit/s to compile into the downlink trace '
+        'instead of --downlink-trace')
     local.add_argument(
         '--prepend-mm-cmds', metavar='"CMD1 CMD2..."',
         help='mahimahi shells to run outside of mm-link')
@@ -139,6 +233,17 @@ def parse_test_local(local):
         help='extra arguments to pass to mm-link when running locally. Note '
         'that uplink (downlink) always represents the link from sender to '
         'receiver (from receiver to sender)')
+    local.add_argument(
+        '--parallel', metavar='N', type=int, default=1,
+        help='run up to N tests at once, each in its own mahimahi shells '
+        '(default 1)')
+    local.add_argument(
+        '--pin-cpus', action='store_true',
+        help='pin each of the tests running at once to its own set of CPUs')
+    local.add_argument(
+        '--cpus-per-run', metavar='N', type=int,
+        help='number of CPUs to pin each test to with --pin-cpus '
+        '(default number of CPUs divided by --parallel)')
 
 
 def parse_test_remote(remote):
@@ -163,6 +268,10 @@ def parse_test_remote(remote):
     remote.add_argument(
         '--ntp-addr', metavar='HOST',
         help='address of an NTP server to query clock offset')
+    remote.add_argument(
+        '--compact-remote-logs', action='store_true',
+        help='compact tunnel logs on the remote side into compressed binary '
+        'logs before downloading them (requires NumPy on the remote side)')
     remote.add_argument(
         '--local-desc', metavar='DESC',
         help='extra description of the local side')
@@ -171,6 +280,23 @@ def parse_test_remote(remote):
         help='extra description of the remote side')
 
 
+def verify_flow_starts(args, runtime, runtime_desc):
+    if args.flows > 0 and args.interval > 0:
+        if (args.flows - 1) * args.interval > runtime:
+            sys.exit('interval time between flows is too long to be '
+                     'fit in %s' % runtime_desc)
+
+    test_config = getattr(args, 'test_config', None)
+    if test_config is not None:
+        for flow in test_config['flows']:
+            offset = flow.get('start-offset', 0)
+            if not isinstance(offset, (int, float)):
+                sys.exit('start-offset of a flow must be a number of seconds')
+            if offset < 0 or offset > runtime:
+                sys.exit('start-offset of a flow must be between 0 and %s'
+                         % runtime_desc)
+
+
 def verify_test_args(args):
     if args.flows == 0:
         prepend = getattr(args, 'prepend_mm_cmds', None)
@@ -186,10 +312,70 @@ def verify_test_args(args):
         sys.exit('flow cannot be negative')
     if args.interval < 0:
         sys.exit('interval cannot be negative')
-    if args.flows > 0 and args.interval > 0:
-        if (args.flows - 1) * args.interval > args.runtime:
-            sys.exit('interval time between flows is too long to be '
-                     'fit in runtime')
+    verify_flow_starts(args, args.runtime, 'runtime')
+
+    if args.live_min_tput is not None or args.abort_idle is not None:
+        args.live_stats = True
+    if args.live_stats:
+        if not args.do_log or args.flows == 0:
+            sys.exit('--live-stats, --live-min-tput and --abort-idle require '
+                     '--do_log and pantheon tunnels')
+        if args.live_interval <= 0 or args.live_window <= 0:
+            sys.exit('--live-interval and --live-window must be positive')
+    for timeout in [args.abort_idle, args.abort_unconnected]:
+        if timeout is not None and timeout <= 0:
+            sys.exit('--abort-idle and --abort-unconnected must be positive')
+    if args.reschedule < 0:
+        sys.exit('--reschedule cannot be negative')
+    if args.retries < 0 or args.retry_backoff < 0:
+        sys.exit('--retries and --retry-backoff cannot be negative')
+
+    if getattr(args, 'sweep', None) is not None:
+        try:
+            scheme, space = sweep.parse_space(args.sweep)
+            if args.sweep_sampler == 'grid':
+                sweep.sample_configs(scheme, space, args.sweep_samples,
+                                     'grid')
+        except ValueError as exception:
+            sys.exit('invalid sweep: %s' % exception)
+
+        if not args.do_log or args.flows == 0:
+            sys.exit('--sweep requires --do_log and pantheon tunnels')
+        if args.sweep_samples < 1 or args.sweep_rounds < 1:
+            sys.exit('--sweep-samples and --sweep-rounds must be positive')
+        if args.sweep_eta < 2:
+            sys.exit('--sweep-eta must be at least 2')
+        verify_schemes(scheme)
+
+        # the runs of the first round are the shortest ones
+        verify_flow_starts(args, sweep.round_runtime(
+            args.runtime, 0, args.sweep_rounds, args.sweep_eta),
+            'the runtime of the first sweep round')
+
+    if args.mode == 'local':
+        for schedule in [args.uplink_schedule, args.downlink_schedule]:
+            if schedule is not None:
+                try:
+                    link_trace.parse_schedule(schedule)
+                except ValueError as exception:
+                    sys.exit('invalid rate schedule: %s' % exception)
+
+        if args.parallel < 1:
+            sys.exit('--parallel must be a positive integer')
+
+        # mm-link opens its logs, which are different in each test, once
+        # it starts, so mahimahi shells cannot be reused with --do_log
+        if args.reuse_tunnel_managers and args.do_log and args.flows > 0:
+            sys.stderr.write('Warning: --reuse-tunnel-managers has no effect '
+                             'on local tests with --do_log, as mm-link logs '
+                             'to different files in each test\n')
+            args.reuse_tunnel_managers = False
+        if args.cpus_per_run is not None:
+            if not args.pin_cpus:
+                sys.exit('--cpus-per-run requires --pin-cpus')
+            if args.cpus_per_run < 1:
+                sys.exit('--cpus-per-run must be a positive integer')
+
 
 def parse_test_config(test_config, local, remote):
     # Check config file has atleast a test-name and a description of flows
@@ -251,6 +437,8 @@ def parse_test():
     if args.schemes is not None:
         verify_schemes(args.schemes)
         args.test_config = None
+    elif getattr(args, 'sweep', None) is not None:
+        args.test_config = None
     elif not args.all:
         assert(test_config is not None)
         schemes = ' '.join([flow['scheme'] for flow in test_config['flows']])
@@ -0,0 +1,280 @@
+import os
+import json
+import math
+import time
+import pipes
+import threading
+import Queue
+from subprocess import PIPE
+from collections import deque
+
+import numpy as np
+
+import context
+import merge_tunnel_logs
+from helpers import utils
+from helpers.subprocess_wrappers import Popen
+
+
+# packets that have not left the tunnel this long after the latest
+# departure of their flow are counted as lost
+LOSS_TIMEOUT = 1000  # ms
+
+# tails of logs exit on their own this long after the test should end, in
+# case they cannot be killed (e.g., on the remote side once ssh is killed)
+TAIL_SLACK = 30  # seconds
+
+
+class LogTail(object):
+    """
+    Follow a local or remote (over ssh_cmd) ingress or egress log as it is
+    written, putting (key, line) of every line into the queue lines. The
+    tail exits after timeout seconds unless it is None.
+    """
+
+    def __init__(self, key, log_path, lines, ssh_cmd=None, timeout=None):
+        # the log may not exist yet when the tunnel is starting
+        cmd = ['tail', '-n', '+1', '-F', log_path]
+        if timeout is not None:
+            cmd = ['timeout', str(int(math.ceil(timeout)))] + cmd
+        if ssh_cmd is not None:
+            cmd = ssh_cmd + [' '.join(map(pipes.quote, cmd))]
+
+        with open(os.devnull, 'w') as devnull:
+            self.proc = Popen(cmd, stdout=PIPE, stderr=devnull)
+
+        self.reader = threading.Thread(target=self.read,
+                                       args=(key, lines))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read(self, key, lines):
+        for line in iter(self.proc.stdout.readline, ''):
+            lines.put((key, line))
+
+    def close(self):
+        utils.kill_proc_tree(self.proc)
+
+
+class LiveFlow(object):
+    """
+    Pair packets of a flow that enter (egress log) and leave (ingress log)
+    the tunnel incrementally, as merge_single() in merge_tunnel_logs.py does
+    for complete logs, keeping the departures of the last window ms.
+    """
+
+    def __init__(self, window, send_ofst=None, recv_ofst=None):
+        self.window = window
+        self.init_ts = {'send': None, 'recv': None}
+        self.ofst = {'send': send_ofst or 0, 'recv': recv_ofst or 0}
+
+        self.sent = {}  # uid -> (ts, size) of packets in flight
+        self.early = {}  # uid -> (ts, size) of departures read before entry
+        self.departures = deque()  # (ts, bits, delay) in the window
+
+        self.last_departure = None
+        self.received = 0
+        self.lost = 0
+
+    def add_line(self, side, line):
+        if line.startswith('#'):
+            if self.init_ts[side] is None:
+                self.init_ts[side] = (float(line.rsplit(':', 1)[-1]) +
+                                      self.ofst[side])
+            return
+
+        if self.init_ts[side] is None:
+            return
+
+        try:
+            (ts, uid, size) = merge_tunnel_logs.parse_line(line)
+        except ValueError:
+            return  # a line that is still being written
+        ts += self.init_ts[side]
+
+        if side == 'send':
+            if uid in self.early:
+                self.add_departure(ts, self.early.pop(uid))
+            else:
+                self.sent[uid] = (ts, size)
+        elif uid in self.sent:
+            send_ts, _ = self.sent.pop(uid)
+            self.add_departure(send_ts, (ts, size))
+        else:
+            self.early[uid] = (ts, size)
+
+    def add_departure(self, send_ts, departure):
+        (recv_ts, recv_size) = departure
+        self.departures.append((recv_ts, recv_size * 8, recv_ts - send_ts))
+        self.received += 1
+
+        if self.last_departure is None or recv_ts > self.last_departure:
+            self.last_departure = recv_ts
+
+    def expire(self, now):
+        # drop departures out of the window and packets given up on
+        while self.departures and self.departures[0][0] <= now - self.window:
+            self.departures.popleft()
+
+        if self.last_departure is not None:
+            lost = [uid for uid, (ts, _) in self.sent.iteritems()
+                    if ts < self.last_departure - LOSS_TIMEOUT]
+            for uid in lost:
+                del self.sent[uid]
+            self.lost += len(lost)
+
+            # departures whose entries never show up in the egress log
+            for uid in [uid for uid, (ts, _) in self.early.iteritems()
+                        if ts < self.last_departure - LOSS_TIMEOUT]:
+                del self.early[uid]
+
+    def stats(self, now):
+        self.expire(now)
+
+        bits = sum([d[1] for d in self.departures])
+        stats = {'tput': bits / (1000.0 * self.window),  # Mbit/s
+                 'delay_p50': None, 'delay_p95': None, 'loss': None}
+
+        if self.departures:
+            delays = np.array([d[2] for d in self.departures])
+            stats['delay_p50'] = float(np.percentile(delays, 50))
+            stats['delay_p95'] = float(np.percentile(delays, 95))
+
+        if self.received + self.lost > 0:
+            stats['loss'] = float(self.lost) / (self.received + self.lost)
+
+        return stats
+
+
+class LiveMonitor(object):
+    """
+    Tail the datalink ingress and egress logs of flows while a test runs and
+    append rolling statistics of each flow as JSON lines to stats_path
+    every interval seconds. abort_event is set once no bytes leave the
+    tunnels for max_idle seconds, or once the total throughput falls below
+    min_tput (Mbit/s) after grace seconds, unless they are None. Logs are
+    tailed for at most max_runtime + TAIL_SLACK seconds unless max_runtime
+    is None.
+
+    logs maps flow IDs to dicts of
+      send, recv: egress and ingress log paths,
+      send_ssh, recv_ssh: ssh commands to reach remote logs (or None),
+      send_ofst, recv_ofst: clock offsets in ms of the logs (or None).
+    """
+
+    def __init__(self, logs, stats_path, window=5, interval=1,
+                 min_tput=None, grace=10, max_idle=None, max_runtime=None):
+        self.logs = logs
+        self.stats_path = stats_path
+        self.window = window
+        self.interval = interval
+        self.min_tput = min_tput
+        self.grace = grace
+        self.max_idle = max_idle
+
+        self.tail_timeout = None
+        if max_runtime is not None:
+            self.tail_timeout = max_runtime + TAIL_SLACK
+
+        self.lines = Queue.Queue()
+        self.tails = []
+        self.flows = {}
+
+        self.abort_event = threading.Event()
+        self.abort_reason = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        for flow_id, log in self.logs.iteritems():
+            self.flows[flow_id] = LiveFlow(
+                1000.0 * self.window, log.get('send_ofst'),
+                log.get('recv_ofst'))
+
+            for side in ['send', 'recv']:
+                self.tails.append(LogTail(
+                    (flow_id, side), log[side], self.lines,
+                    log.get(side + '_ssh'), self.tail_timeout))
+
+        self.start_time = utils.monotonic_time()
+        self.start_ts = time.time() * 1000
+        self.stats_file = open(self.stats_path, 'w')
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_lines(self):
+        while True:
+            try:
+                (flow_id, side), line = self.lines.get_nowait()
+            except Queue.Empty:
+                return
+
+            self.flows[flow_id].add_line(side, line)
+
+    def write(self, record):
+        self.stats_file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.stats_file.flush()
+
+    def check(self, now, elapsed, stats):
+        # return the reason to abort the test or None
+        if self.max_idle is not None:
+            last_departure = max([self.start_ts] + [
+                f.last_departure for f in self.flows.itervalues()
+                if f.last_departure is not None])
+            if now - last_departure > 1000.0 * self.max_idle:
+                return ('no datalink bytes left the tunnels for %s s'
+                        % self.max_idle)
+
+        if self.min_tput is None or elapsed < self.grace:
+            return None
+
+        total_tput = sum([s['tput'] for s in stats.itervalues()])
+        if total_tput < self.min_tput:
+            return ('total throughput %.2f Mbit/s in the last %s s is below '
+                    '%s Mbit/s' % (total_tput, self.window, self.min_tput))
+
+        return None
+
+    def run(self):
+        next_time = self.start_time + self.interval
+
+        while not self.stop_event.is_set():
+            utils.sleep_until(next_time)
+            next_time += self.interval
+
+            self.read_lines()
+
+            now = time.time() * 1000
+            elapsed = utils.monotonic_time() - self.start_time
+            stats = {}
+            for flow_id, flow in self.flows.iteritems():
+                stats[flow_id] = flow.stats(now)
+
+            record = {'ts': round(now / 1000.0, 3),
+                      'elapsed': round(elapsed, 3), 'flows': stats}
+
+            reason = self.check(now, elapsed, stats)
+            if reason is not None:
+                record['abort'] = reason
+            self.write(record)
+
+            if reason is not None:
+                self.abort_reason = reason
+                self.abort_event.set()
+                break
+
+    def wait(self, timeout):
+        # wait for at most timeout seconds, returning True if aborted
+        self.abort_event.wait(max(0, timeout))
+        return self.abort_event.is_set()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.stats_file.close()
+
+        for tail in self.tails:
+            tail.close()
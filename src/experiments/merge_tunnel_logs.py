@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import argparse
 import heapq
+import sqlite3
+import zipfile
+import tempfile
+import itertools
+from collections import OrderedDict, deque
+
+import numpy as np
+
+import context
+from helpers import tunnel_log
 
 
 def parse_arguments():
@@ -29,6 +40,23 @@ def parse_arguments():
     single_parser.add_argument(
         '-e-clock-offset', metavar='MS', type=float,
         help='clock offset on the end where egress log is saved')
+    single_parser.add_argument(
+        '--streaming', action='store_true',
+        help='pair packets in a single pass over the logs, keeping only '
+        'packets in flight in memory instead of all packets sent')
+    single_parser.add_argument(
+        '--window', metavar='PACKETS', type=int, default=100000,
+        help='max number of packets in flight to keep in memory in '
+        'streaming mode; older ones are spilled to disk (default 100000)')
+
+    # subparser for compact mode
+    compact_parser = subparsers.add_parser(
+        'compact', help='compact ingress or egress logs of tunnels into '
+        'compressed binary logs (LOG%s) that single mode reads as well'
+        % COMPACT_SUFFIX)
+    compact_parser.add_argument(
+        'raw_logs', metavar='LOG', nargs='+',
+        help='ingress or egress logs of tunnels')
 
     # subparser for multiple mode
     multiple_parser = subparsers.add_parser(
@@ -36,45 +64,290 @@ def parse_arguments():
     multiple_parser.add_argument(
         '--link-log', action='store', metavar='LINK-LOG', dest='link_log',
         help='uplink or downlink log generated by mm-link')
+    multiple_parser.add_argument(
+        '--link-trace', action='store', metavar='TRACE', dest='link_trace',
+        help='mahimahi trace of the link to name in the output log instead '
+        'of merging delivery opportunities from LINK-LOG, which is then '
+        'only read for its initial timestamp (text output logs only)')
     multiple_parser.add_argument(
         'tunnel_logs', metavar='TUNNEL-LOG', nargs='+',
         help='one or more tunnel logs generated by single mode')
     multiple_parser.add_argument(
         '-o', action='store', metavar='OUTPUT-LOG', dest='output_log',
         required=True, help='output log after merging')
+    multiple_parser.add_argument(
+        '--binary', action='store_true',
+        help='save the output log in the binary tunnel log format')
 
     return parser.parse_args()
 
 
+# suffix of compact ingress and egress logs, which are NumPy .npz files of
+#   init_ts: initial timestamp (empty if the raw log is empty),
+#   ts_delta_us: differences between timestamps in microseconds, or
+#   ts: timestamps in ms if they have a finer resolution than 0.001 ms,
+#   uid, size: other columns of packets
+COMPACT_SUFFIX = '.npz'
+COMPACT_MAGIC = 'PK\x03\x04'
+COMPACT_SLICE = 65536  # packets
+
+
 def parse_line(line):
     (ts, uid, size) = line.split('-')
     return (float(ts), int(uid), int(size))
 
 
-def single_mode(args):
-    recv_log = open(args.ingress_log)
-    send_log = open(args.egress_log)
-    output_log = open(args.output_log, 'w')
+def compact_raw_log(raw_log_path, compact_log_path):
+    init_ts = []
+    ts = []
+    uid = []
+    size = []
+
+    with open(raw_log_path) as raw_log:
+        line = raw_log.readline()
+        if line:
+            init_ts.append(float(line.rsplit(':', 1)[-1]))
+
+        for line in raw_log:
+            (pkt_ts, pkt_uid, pkt_size) = parse_line(line)
+            ts.append(pkt_ts)
+            uid.append(pkt_uid)
+            size.append(pkt_size)
+
+    columns = {'init_ts': np.array(init_ts, dtype=np.float64),
+               'uid': np.array(uid, dtype=np.uint64),
+               'size': np.array(size, dtype=np.uint32)}
+
+    # deltas of timestamps compress much better, but are only stored if
+    # the exact timestamps parsed from the raw log can be restored
+    ts = np.array(ts, dtype=np.float64)
+    ts_us = np.rint(ts * 1000).astype(np.int64)
+    if np.array_equal(ts_us / 1000.0, ts):
+        columns['ts_delta_us'] = np.ediff1d(ts_us, to_begin=ts_us[:1])
+    else:
+        columns['ts'] = ts
+
+    with open(compact_log_path, 'wb') as compact_log:
+        np.savez_compressed(compact_log, **columns)
+
+
+def iter_text_packets(raw_log):
+    with raw_log:
+        for line in raw_log:
+            yield parse_line(line)
+
 
-    # retrieve initial timestamp of sender from the first line
-    line = send_log.readline()
+def iter_compact_column(compact, name):
+    # read a column of a compact log in slices instead of all at once
+    with compact.open(name + '.npy') as npy:
+        version = np.lib.format.read_magic(npy)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(npy)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(npy)
+
+        remaining = shape[0]
+        while remaining > 0:
+            count = min(remaining, COMPACT_SLICE)
+            yield np.frombuffer(npy.read(count * dtype.itemsize), dtype=dtype)
+            remaining -= count
+
+
+def iter_compact_packets(compact_log_path):
+    compact = zipfile.ZipFile(compact_log_path)
+
+    try:
+        has_deltas = 'ts_delta_us.npy' in compact.namelist()
+        ts_column = iter_compact_column(
+            compact, 'ts_delta_us' if has_deltas else 'ts')
+
+        last_ts_us = 0
+        for ts, uid, size in itertools.izip(
+                ts_column, iter_compact_column(compact, 'uid'),
+                iter_compact_column(compact, 'size')):
+            if has_deltas:
+                ts_us = np.cumsum(ts) + last_ts_us
+                last_ts_us = ts_us[-1]
+                ts = ts_us / 1000.0
+
+            for packet in itertools.izip(ts.tolist(), uid.tolist(),
+                                         size.tolist()):
+                yield packet
+    finally:
+        compact.close()
+
+
+def read_raw_log(log_path):
+    """
+    Return the initial timestamp (None if the log is empty) and an iterator
+    over (ts, uid, size) of packets in the ingress or egress log at
+    log_path, which is either a raw text log or a compact log. Compact logs
+    are read COMPACT_SLICE packets at a time.
+    """
+    with open(log_path, 'rb') as log:
+        is_compact = log.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC
+
+    if is_compact:
+        compact = np.load(log_path)
+        try:
+            init_ts = compact['init_ts'].tolist()
+        finally:
+            compact.close()
+
+        packets = iter_compact_packets(log_path)
+        if not init_ts:
+            return None, packets
+        return init_ts[0], packets
+
+    # the first line has the initial timestamp
+    raw_log = open(log_path)
+    line = raw_log.readline()
     if not line:
+        return None, iter_text_packets(raw_log)
+
+    return float(line.rsplit(':', 1)[-1]), iter_text_packets(raw_log)
+
+
+class InFlightPackets(object):
+    """
+    Packets that entered the tunnel but have not been paired with their
+    departures yet.
+
+    The egress log send_log is read only once: by the merge through
+    next_sent(), or ahead of it by pop() to find the packet of a departure
+    the merge has not reached yet (e.g., due to clock offsets), in which
+    case packets read ahead are buffered until next_sent() returns them. As
+    packets leave the tunnel in nearly the same order as they enter it,
+    only a few packets are in flight at a time. At most `window` packets in
+    flight and `window` packets read ahead are kept in memory; older ones
+    (e.g., lost or heavily reordered packets) are spilled to a temporary
+    SQLite database on disk.
+    """
+
+    def __init__(self, send_log, send_cal, window):
+        if window < 1:
+            sys.exit('Warning: window must be a positive integer\n')
+
+        self.send_log = send_log
+        self.send_cal = send_cal
+        self.window = window
+
+        self.packets = OrderedDict()
+        self.read_ahead = deque()
+        self.spilled_ahead = 0  # oldest packets read ahead are spilled
+        self.next_ahead_id = 0
+        self.spill = None
+        self.spill_path = None
+
+    def open_spill(self):
+        if self.spill is not None:
+            return
+
+        fd, self.spill_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.spill = sqlite3.connect(self.spill_path)
+        self.spill.execute('CREATE TABLE packets '
+                           '(uid INTEGER PRIMARY KEY, ts REAL, size INTEGER)')
+        self.spill.execute('CREATE TABLE read_ahead (id INTEGER PRIMARY KEY, '
+                           'ts REAL, uid INTEGER, size INTEGER)')
+
+    def spill_oldest(self):
+        self.open_spill()
+
+        uid, (ts, size) = self.packets.popitem(last=False)
+        self.spill.execute('INSERT OR REPLACE INTO packets VALUES (?, ?, ?)',
+                           (uid, ts, size))
+
+    def read_next(self):
+        packet = next(self.send_log, None)
+        if packet is None:
+            return None
+
+        (send_ts, send_uid, send_size) = packet
+        self.packets[send_uid] = (send_ts + self.send_cal, send_size)
+        if len(self.packets) > self.window:
+            self.spill_oldest()
+
+        return packet
+
+    def add_read_ahead(self, packet):
+        self.read_ahead.append(packet)
+        if len(self.read_ahead) <= self.window:
+            return
+
+        # spilled packets are older than those in memory, so they are
+        # returned first in the order they were read
+        self.open_spill()
+        self.spill.execute('INSERT INTO read_ahead VALUES (?, ?, ?, ?)',
+                           (self.next_ahead_id,) + self.read_ahead.popleft())
+        self.next_ahead_id += 1
+        self.spilled_ahead += 1
+
+    def next_sent(self):
+        # return the next (ts, uid, size) of the egress log, or None
+        if self.spilled_ahead > 0:
+            row = self.spill.execute(
+                'SELECT id, ts, uid, size FROM read_ahead '
+                'ORDER BY id LIMIT 1').fetchone()
+            self.spill.execute('DELETE FROM read_ahead WHERE id = ?',
+                               (row[0],))
+            self.spilled_ahead -= 1
+            return tuple(row[1:])
+
+        if self.read_ahead:
+            return self.read_ahead.popleft()
+
+        return self.read_next()
+
+    def pop(self, uid):
+        # return (ts, size) of the packet with uid, or None if not found
+        if uid in self.packets:
+            return self.packets.pop(uid)
+
+        if self.spill is not None:
+            row = self.spill.execute(
+                'SELECT ts, size FROM packets WHERE uid = ?', (uid,)).fetchone()
+            if row is not None:
+                self.spill.execute('DELETE FROM packets WHERE uid = ?', (uid,))
+                return row
+
+        # read ahead in the egress log
+        while True:
+            packet = self.read_next()
+            if packet is None:
+                return None
+
+            self.add_read_ahead(packet)
+            if packet[1] == uid:
+                return self.packets.pop(uid)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.remove(self.spill_path)
+
+
+def merge_single(ingress_log, egress_log, output_log, i_clock_offset=None,
+                 e_clock_offset=None, streaming=False, window=100000):
+    output_log = open(output_log, 'w')
+
+    # retrieve initial timestamp of sender
+    send_init_ts, send_log = read_raw_log(egress_log)
+    if send_init_ts is None:
         sys.exit('Warning: egress log is empty\n')
 
-    send_init_ts = float(line.rsplit(':', 1)[-1])
-    if args.e_clock_offset is not None:
-        send_init_ts += args.e_clock_offset
+    if e_clock_offset is not None:
+        send_init_ts += e_clock_offset
 
     min_init_ts = send_init_ts
 
-    # retrieve initial timestamp of receiver from the first line
-    line = recv_log.readline()
-    if not line:
+    # retrieve initial timestamp of receiver
+    recv_init_ts, recv_log = read_raw_log(ingress_log)
+    if recv_init_ts is None:
         sys.exit('Warning: ingress log is empty\n')
 
-    recv_init_ts = float(line.rsplit(':', 1)[-1])
-    if args.i_clock_offset is not None:
-        recv_init_ts += args.i_clock_offset
+    if i_clock_offset is not None:
+        recv_init_ts += i_clock_offset
 
     if recv_init_ts < min_init_ts:
         min_init_ts = recv_init_ts
@@ -85,23 +358,24 @@ def single_mode(args):
     send_cal = send_init_ts - min_init_ts
     recv_cal = recv_init_ts - min_init_ts
 
-    # construct a hash table using uid as keys
-    send_pkts = {}
-    for line in send_log:
-        (send_ts, send_uid, send_size) = parse_line(line)
-        send_pkts[send_uid] = (send_ts + send_cal, send_size)
-
-    send_log.seek(0)
-    send_log.readline()
+    if streaming:
+        send_pkts = InFlightPackets(send_log, send_cal, window)
+        next_sent = send_pkts.next_sent
+    else:
+        # construct a hash table using uid as keys
+        send_pkts = {}
+        for (send_ts, send_uid, send_size) in read_raw_log(egress_log)[1]:
+            send_pkts[send_uid] = (send_ts + send_cal, send_size)
+        next_sent = lambda: next(send_log, None)
 
     # merge two sorted logs into one
-    send_l = send_log.readline()
+    send_l = next_sent()
     if send_l:
-        (send_ts, send_uid, send_size) = parse_line(send_l)
+        (send_ts, send_uid, send_size) = send_l
 
-    recv_l = recv_log.readline()
+    recv_l = next(recv_log, None)
     if recv_l:
-        (recv_ts, recv_uid, recv_size) = parse_line(recv_l)
+        (recv_ts, recv_uid, recv_size) = recv_l
 
     while send_l or recv_l:
         if send_l:
@@ -111,12 +385,17 @@ def single_mode(args):
 
         if (send_l and recv_l and send_ts_cal <= recv_ts_cal) or not recv_l:
             output_log.write('%.3f + %s\n' % (send_ts_cal, send_size))
-            send_l = send_log.readline()
+            send_l = next_sent()
             if send_l:
-                (send_ts, send_uid, send_size) = parse_line(send_l)
+                (send_ts, send_uid, send_size) = send_l
         elif (send_l and recv_l and send_ts_cal > recv_ts_cal) or not send_l:
-            if recv_uid in send_pkts:
-                (paired_send_ts, paired_send_size) = send_pkts[recv_uid]
+            if streaming:
+                paired = send_pkts.pop(recv_uid)
+            else:
+                paired = send_pkts.get(recv_uid)
+
+            if paired is not None:
+                (paired_send_ts, paired_send_size) = paired
                 # inconsistent packet size
                 if paired_send_size != recv_size:
                     sys.exit(
@@ -131,10 +410,12 @@ def single_mode(args):
             delay = recv_ts_cal - paired_send_ts
             output_log.write('%.3f - %s %.3f\n'
                              % (recv_ts_cal, recv_size, delay))
-            recv_l = recv_log.readline()
+            recv_l = next(recv_log, None)
             if recv_l:
-                (recv_ts, recv_uid, recv_size) = parse_line(recv_l)
+                (recv_ts, recv_uid, recv_size) = recv_l
 
+    if streaming:
+        send_pkts.close()
     recv_log.close()
     send_log.close()
     output_log.close()
@@ -172,18 +453,33 @@ def push_to_heap(heap, index, log_file, init_ts_delta):
     return line
 
 
-def multiple_mode(args):
+def write_binary_event(output_log, index, line):
+    items = line.split()
+    event = tunnel_log.EVENT_SYMBOLS[items[1]]
+
+    delay = 0.0
+    if event == tunnel_log.DEPARTURE:
+        delay = float(items[3])
+
+    # flow ids start from 1 and the link log has no flow id
+    output_log.write_event(float(items[0]), event, int(items[2]),
+                           delay, index + 1)
+
+
+def merge_multiple(tunnel_logs, output_log, link_log=None, binary=False,
+                   link_trace=None):
+    # binary logs cannot name the link trace in their headers
+    if binary:
+        link_trace = None
+
     # open log files
-    link_log = None
-    if args.link_log:
-        link_log = open(args.link_log)
+    if link_log:
+        link_log = open(link_log)
 
     tun_logs = []
-    for tun_log_name in args.tunnel_logs:
+    for tun_log_name in tunnel_logs:
         tun_logs.append(open(tun_log_name))
 
-    output_log = open(args.output_log, 'w')
-
     # maintain a min heap to merge sorted logs
     heap = []
     if link_log:
@@ -225,7 +521,20 @@ def multiple_mode(args):
     for i in xrange(len(init_ts_delta)):
         init_ts_delta[i] -= min_init_ts
 
-    output_log.write('# init timestamp: %.3f\n' % min_init_ts)
+    if binary:
+        output_log = tunnel_log.BinaryWriter(
+            output_log, float('%.3f' % min_init_ts), len(tun_logs))
+    else:
+        output_log = open(output_log, 'w')
+        output_log.write('# init timestamp: %.3f\n' % min_init_ts)
+
+    if link_trace:
+        # capacity is computed from the trace by tunnel_graph.py
+        output_log.write('# link trace: %s\n' % os.path.abspath(link_trace))
+        if link_log:
+            output_log.write('# link offset: %.3f\n' % link_init_ts_delta)
+            link_log.close()
+            link_log = None
 
     # build the min heap
     if link_log:
@@ -244,11 +553,14 @@ def multiple_mode(args):
     while heap:
         (ts, index, line) = heapq.heappop(heap)
 
-        # append flow ids to arrival and departure events
-        if index != -1:
-            line += ' %s' % (index + 1)
+        if binary:
+            write_binary_event(output_log, index, line)
+        else:
+            # append flow ids to arrival and departure events
+            if index != -1:
+                line += ' %s' % (index + 1)
 
-        output_log.write(line + '\n')
+            output_log.write(line + '\n')
 
         if index == -1:
             push_to_heap(heap, index, link_log, link_init_ts_delta)
@@ -263,13 +575,38 @@ def multiple_mode(args):
     output_log.close()
 
 
+def merge(mode, **kwargs):
+    """
+    Run merge_single() if mode is 'single' or merge_multiple() otherwise,
+    returning False instead of exiting on errors so that merges can run in
+    the same process as the caller or in a worker process.
+    """
+    try:
+        if mode == 'single':
+            merge_single(**kwargs)
+        else:
+            merge_multiple(**kwargs)
+    except SystemExit as exception:
+        if exception.code:
+            sys.stderr.write('%s\n' % exception.code)
+        return False
+
+    return True
+
+
 def main():
     args = parse_arguments()
 
     if args.mode == 'single':
-        single_mode(args)
+        merge_single(args.ingress_log, args.egress_log, args.output_log,
+                     args.i_clock_offset, args.e_clock_offset,
+                     args.streaming, args.window)
+    elif args.mode == 'compact':
+        for raw_log in args.raw_logs:
+            compact_raw_log(raw_log, raw_log + COMPACT_SUFFIX)
     else:
-        multiple_mode(args)
+        merge_multiple(args.tunnel_logs, args.output_log, args.link_log,
+                       args.binary, args.link_trace)
 
 
 if __name__ == '__main__':
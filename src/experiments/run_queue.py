@@ -0,0 +1,188 @@
+import os
+from os import path
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+
+# The run queue of a data directory lists the runs of a sweep in the order
+# they are run, mapping '<cc>_run<run_id>' to
+#   state: pending, running, done or failed,
+#   attempts: number of times the run has been started,
+#   next_try: time (seconds since the epoch) before which it is not retried,
+#   error: why the last attempt failed (None if it did not)
+QUEUE_NAME = 'pantheon_run_queue.json'
+STATES = ['pending', 'running', 'done', 'failed']
+
+# The manifest of finished runs is append-only, with a JSON line of
+#   run: '<cc>_run<run_id>',
+#   finished: time the run was finished,
+#   logs: maps names of the logs of the run in the data directory to their
+#         SHA-1 checksums (None for logs that are rewritten by analysis)
+# for each run that is done. The last line of a run wins.
+MANIFEST_NAME = 'pantheon_run_manifest.jsonl'
+
+
+def run_key(cc, run_id):
+    return '%s_run%d' % (cc, run_id)
+
+
+def checksum(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def append_finished(data_dir, key, finished, log_names, unchecked_names=()):
+    entry = {'run': key, 'finished': finished, 'logs': {}}
+    for log_name in log_names:
+        entry['logs'][log_name] = checksum(path.join(data_dir, log_name))
+    for log_name in unchecked_names:
+        entry['logs'][log_name] = None
+
+    # a single write of a line, so that lines of runs finished in parallel
+    # and lines of resumed sweeps are never interleaved
+    with open(path.join(data_dir, MANIFEST_NAME), 'a') as manifest:
+        manifest.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def load_finished(data_dir):
+    # map keys of runs to their last entries in the manifest, skipping
+    # a line that was being written in a crash
+    manifest_path = path.join(data_dir, MANIFEST_NAME)
+    if not path.isfile(manifest_path):
+        return {}
+
+    finished = {}
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            finished[entry['run']] = entry
+
+    return finished
+
+
+def verify_finished(data_dir, entry):
+    # check that the logs of a finished run are saved and unchanged
+    for log_name, log_checksum in entry['logs'].iteritems():
+        log_path = path.join(data_dir, log_name)
+        if not path.isfile(log_path):
+            return False
+        if log_checksum is not None and checksum(log_path) != log_checksum:
+            return False
+
+    return True
+
+
+class RunQueue(object):
+    """
+    Persistent queue of the runs of tests in data_dir. A failed run is
+    retried at most `retries` times, waiting backoff * 2^(n - 1) seconds
+    before the n-th retry. The queue is saved after every change so that a
+    sweep can be resumed after a crash.
+    """
+
+    def __init__(self, data_dir, retries=0, backoff=10):
+        self.queue_path = path.join(data_dir, QUEUE_NAME)
+        self.retries = retries
+        self.backoff = backoff
+        self.runs = OrderedDict()
+
+    def load(self):
+        if not path.isfile(self.queue_path):
+            return
+
+        try:
+            with open(self.queue_path) as queue:
+                runs = json.load(queue, object_pairs_hook=OrderedDict)
+        except ValueError:
+            return
+
+        self.runs = OrderedDict([(key, run) for key, run in runs.iteritems()
+                                 if run.get('state') in STATES])
+
+    def save(self):
+        tmp_path = '%s.%d' % (self.queue_path, os.getpid())
+
+        with open(tmp_path, 'w') as tmp:
+            json.dump(self.runs, tmp, indent=2, separators=(',', ': '))
+        os.rename(tmp_path, self.queue_path)
+
+    def reset(self, keys, is_done=None):
+        """
+        Queue the runs of keys, in the order of the loaded queue first so
+        that a resumed sweep runs in the same order (e.g., with
+        --random-order). Runs for which is_done(key) is true are done, while
+        others are pending with fresh retries.
+        """
+        keys = ([key for key in self.runs if key in keys] +
+                [key for key in keys if key not in self.runs])
+
+        runs = OrderedDict()
+        for key in keys:
+            if is_done is not None and is_done(key):
+                runs[key] = {'state': 'done', 'attempts': 0,
+                             'next_try': 0, 'error': None}
+                if key in self.runs:
+                    runs[key]['attempts'] = self.runs[key]['attempts']
+            else:
+                runs[key] = {'state': 'pending', 'attempts': 0,
+                             'next_try': 0, 'error': None}
+
+        self.runs = runs
+        self.save()
+
+    def state(self, key):
+        return self.runs[key]['state']
+
+    def pending(self):
+        return [key for key, run in self.runs.iteritems()
+                if run['state'] == 'pending']
+
+    def is_finished(self):
+        return all([run['state'] in ['done', 'failed']
+                    for run in self.runs.itervalues()])
+
+    def next_ready(self):
+        """
+        Return (key, wait) of the next pending run to start, where wait is
+        the number of seconds until it is ready, or (None, None) if no run
+        is pending.
+        """
+        pending = self.pending()
+        if not pending:
+            return None, None
+
+        now = time.time()
+        key = min(pending, key=lambda k: max(self.runs[k]['next_try'], now))
+        return key, max(0, self.runs[key]['next_try'] - now)
+
+    def start(self, key):
+        run = self.runs[key]
+        run['state'] = 'running'
+        run['attempts'] += 1
+        self.save()
+
+    def finish(self, key, success, error=None):
+        # mark a run as done or failed, or queue it again to retry later
+        run = self.runs[key]
+        run['error'] = None if success else (error or 'test failed')
+
+        if success:
+            run['state'] = 'done'
+        elif run['attempts'] <= self.retries:
+            run['state'] = 'pending'
+            run['next_try'] = (time.time() +
+                               self.backoff * 2 ** (run['attempts'] - 1))
+        else:
+            run['state'] = 'failed'
+
+        self.save()
+        return run['state']
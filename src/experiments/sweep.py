@@ -0,0 +1,166 @@
+import math
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+import context
+from helpers import tunnel_log, quantiles
+
+
+SAMPLERS = ['grid', 'random', 'lhs']
+METRICS = ['power', 'tput', 'delay']
+
+
+def parse_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def parse_space(sweep):
+    """
+    Parse a sweep "scheme{param1=VALUES;param2=VALUES...}" as in
+    utils.parse_schemes(), except that VALUES may also be a numeric range
+    "LOW..HIGH" (integers only if both bounds are integers).
+
+    Return (scheme, space), where space is an OrderedDict mapping each param
+    to either a list of values (strings) or a (low, high) range. Raise
+    ValueError if the sweep is invalid.
+    """
+    if '{' not in sweep or not sweep.endswith('}'):
+        raise ValueError('sweep must be "scheme{param=VALUES;...}": %s'
+                         % sweep)
+
+    scheme = sweep[:sweep.index('{')]
+    space = OrderedDict()
+    for setting in sweep[sweep.index('{') + 1:-1].split(';'):
+        if '=' not in setting:
+            raise ValueError('invalid setting %s in sweep' % setting)
+
+        param, values = setting.split('=', 1)
+        if param in space:
+            raise ValueError('duplicate setting %s in sweep' % param)
+
+        if '..' in values:
+            try:
+                low, high = [parse_value(v) for v in values.split('..')]
+            except ValueError:
+                raise ValueError('invalid range %s of %s' % (values, param))
+            if low > high:
+                raise ValueError('empty range %s of %s' % (values, param))
+            space[param] = (low, high)
+        else:
+            space[param] = values.split(',')
+
+    return scheme, space
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%g' % value
+    return str(value)
+
+
+def sample_value(values, u):
+    # the value of a list or range at quantile u in [0, 1)
+    if isinstance(values, list):
+        return values[min(int(u * len(values)), len(values) - 1)]
+
+    low, high = values
+    if isinstance(low, int) and isinstance(high, int):
+        return format_value(min(low + int(u * (high - low + 1)), high))
+    return format_value(low + u * (high - low))
+
+
+def sample_configs(scheme, space, num_samples, sampler='lhs', seed=0):
+    """
+    Return an OrderedDict mapping the names of sampled configs of scheme,
+    e.g. "scheme{10;0.5}" as in utils.parse_schemes(), to their params.
+
+    'grid' takes all combinations of values as utils.parse_schemes() does,
+    'random' samples num_samples configs uniformly, and 'lhs' (Latin
+    hypercube sampling) samples them so that each param takes values from
+    num_samples equal strata of its values. Duplicate configs (e.g., of
+    lists with few values) are only kept once.
+    """
+    params = space.keys()
+
+    if sampler == 'grid':
+        if any([not isinstance(v, list) for v in space.values()]):
+            raise ValueError('grid sweeps cannot have ranges')
+        combos = itertools.product(*space.values())
+    else:
+        rng = np.random.RandomState(seed)
+        points = rng.uniform(size=(num_samples, len(params)))
+        if sampler == 'lhs':
+            for i in xrange(len(params)):
+                strata = rng.permutation(num_samples)
+                points[:, i] = (strata + points[:, i]) / num_samples
+
+        combos = [[sample_value(space[param], u)
+                   for param, u in itertools.izip(params, row)]
+                  for row in points]
+
+    configs = OrderedDict()
+    for combo in combos:
+        name = '{}{{{}}}'.format(scheme, ';'.join(combo))
+        configs[name] = dict(itertools.izip(params, combo))
+
+    return configs
+
+
+def round_runtime(runtime, round_id, num_rounds, eta):
+    # runtimes grow by eta in each round up to runtime in the last one
+    return max(1, int(math.ceil(
+        float(runtime) / eta ** (num_rounds - 1 - round_id))))
+
+
+def score_run(log_path, metric='power'):
+    """
+    Score the datalink log of a run by its total average throughput
+    (Mbit/s) and 95th percentile one-way delay (ms), as computed by
+    tunnel_graph.py (the delay is exact, as with --delay-quantiles exact):
+    'tput' is the throughput, 'delay' is the negated delay and 'power' is
+    throughput / delay. Return None if the log cannot be read or has no
+    departures.
+    """
+    total_bits = 0
+    first_ts = None
+    last_ts = float('-inf')
+    delays = quantiles.ExactHistogram()
+
+    try:
+        for log in tunnel_log.iter_chunks(log_path):
+            is_departure = log.event == tunnel_log.DEPARTURE
+            if not is_departure.any():
+                continue
+
+            ts = log.ts[is_departure]
+            if first_ts is None:
+                first_ts = float(ts[0])
+            last_ts = max(last_ts, float(ts.max()))
+
+            total_bits += int(log.size[is_departure].sum()) * 8
+            delays.add(log.delay[is_departure])
+    except (IOError, ValueError):
+        return None
+
+    if first_ts is None or last_ts == first_ts:
+        return None
+
+    tput = total_bits / (1000.0 * (last_ts - first_ts))
+    delay = delays.quantile(95)
+
+    if metric == 'tput':
+        return tput
+    if metric == 'delay':
+        return -delay
+    return tput / max(delay, 1e-3)
+
+
+def select_best(scores, num):
+    # names of the num configs with the highest scores, skipping failures
+    scored = [name for name in scores if scores[name] is not None]
+    return sorted(scored, key=lambda name: -scores[name])[:num]
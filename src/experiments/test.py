@@ -3,18 +3,25 @@
 import os
 from os import path
 import copy
+import shutil
 import sys
 import time
 import uuid
 import random
-import signal
 import traceback
+import multiprocessing
+import Queue
 from subprocess import PIPE
 from collections import namedtuple, OrderedDict
 
 import arg_parser
 import context
-from helpers import utils, kernel_ctl
+import merge_tunnel_logs
+import tunnel_manager
+import live_monitor
+import run_queue
+import sweep
+from helpers import utils, kernel_ctl, link_trace
 from helpers.subprocess_wrappers import Popen, call
 
 
@@ -26,7 +33,7 @@ Flow = namedtuple('Flow', ['cc', # replace self.cc
 
 
 class Test(object):
-    def __init__(self, args, run_id, cc):
+    def __init__(self, args, run_id, cc, tunnel_managers=None):
         self.mode = args.mode
         self.run_id = run_id
         # We keep two versions of `cc`:
@@ -37,6 +44,24 @@ class Test(object):
         self.do_log = args.do_log
         self.data_dir = path.abspath(args.data_dir)
         self.extra_sender_args = args.extra_sender_args
+        self.binary_logs = args.binary_logs
+
+        # rolling statistics of flows while the test runs (see
+        # live_monitor.py)
+        self.live_stats = args.live_stats
+        self.live_interval = args.live_interval
+        self.live_window = args.live_window
+        self.live_min_tput = args.live_min_tput
+        self.live_grace = args.live_grace
+        self.live_monitor = None
+
+        # health rules that abort the test early, and the reasons why the
+        # test and its earlier attempts were aborted
+        self.abort_idle = args.abort_idle
+        self.abort_exited = args.abort_exited
+        self.abort_unconnected = args.abort_unconnected
+        self.abort_reason = None
+        self.previous_aborts = []
 
         # shared arguments between local and remote modes
         self.flows = args.flows
@@ -44,12 +69,24 @@ class Test(object):
         self.interval = args.interval
         self.run_times = args.run_times
 
+        # start time of each flow in seconds relative to the first one
+        self.flow_start_offsets = [i * self.interval
+                                   for i in xrange(self.flows)]
+        self.flow_starts = []
+
         # used for cleanup
         self.proc_first = None
         self.proc_second = None
         self.ts_manager = None
         self.tc_manager = None
 
+        # TunnelManagerPool to reuse tunnel managers from (None to start new
+        # tunnel managers and halt them after the test)
+        self.tunnel_managers = tunnel_managers
+
+        # tunnel manager and port of the side that runs first in each flow
+        self.first_sides = {}
+
         self.test_start_time = None
         self.test_end_time = None
 
@@ -76,6 +113,7 @@ class Test(object):
             self.remote_desc = args.remote_desc
 
             self.ntp_addr = args.ntp_addr
+            self.compact_remote_logs = args.compact_remote_logs
             self.local_ofst = None
             self.remote_ofst = None
 
@@ -87,6 +125,11 @@ class Test(object):
             self.test_config = args.test_config
 
         if self.test_config is not None:
+            # flows may start at their own offsets from the first flow
+            for i, flow in enumerate(self.test_config['flows']):
+                if 'start-offset' in flow:
+                    self.flow_start_offsets[i] = float(flow['start-offset'])
+
             # Parameterized schemes are not supported when using a test config,
             # so `cc` and `cc_base` are always equal.
             self.cc = self.cc_base = self.test_config['test-name']
@@ -207,7 +250,7 @@ class Test(object):
             self.run_first = None
             self.run_second = None
 
-        # wait for 3 seconds until run_first is ready
+        # wait for at most 3 seconds until run_first is ready
         self.run_first_setup_time = 3
 
         # setup output logs
@@ -239,9 +282,13 @@ class Test(object):
         sys.stderr.write('Running %s %s...\n' % (self.cc, self.run_first))
         self.proc_first = Popen(cmd, preexec_fn=os.setsid)
 
-        # sleep just in case the process isn't quite listening yet
-        # the cleaner approach might be to try to verify the socket is open
-        time.sleep(self.run_first_setup_time)
+        # wait until the process is listening on the port
+        if not utils.wait_for_port(self.proc_first.pid, int(port),
+                                   self.run_first_setup_time):
+            sys.stderr.write('Warning: %s %s is not listening on port %s '
+                             'after %s seconds\n' % (
+                                 self.cc, self.run_first, port,
+                                 self.run_first_setup_time))
 
         self.test_start_time = utils.utc_time()
         # run the other side specified by self.run_second
@@ -251,22 +298,24 @@ class Test(object):
         sys.stderr.write('Running %s %s...\n' % (self.cc, self.run_second))
         self.proc_second = Popen(sh_cmd, shell=True, preexec_fn=os.setsid)
 
-        signal.signal(signal.SIGALRM, utils.timeout_handler)
-        signal.alarm(self.runtime)
-
         try:
-            self.proc_first.wait()
-            self.proc_second.wait()
-        except utils.TimeoutError:
-            pass
-        else:
-            signal.alarm(0)
-            sys.stderr.write('Warning: test exited before time limit\n')
+            if utils.wait_for_procs([self.proc_first, self.proc_second],
+                                    self.runtime):
+                sys.stderr.write('Warning: test exited before time limit\n')
+                if self.abort_exited:
+                    self.abort('%s exited before time limit' % self.cc)
+                    return False
         finally:
             self.test_end_time = utils.utc_time()
 
         return True
 
+    def start_tunnel_manager(self, cmd, name, prompt):
+        if self.tunnel_managers is not None:
+            return self.tunnel_managers.get(cmd, name, prompt)
+
+        return start_tunnel_manager(cmd, name, prompt)
+
     def run_tunnel_managers(self):
         # run tunnel server manager
         if self.mode == 'remote':
@@ -278,23 +327,11 @@ class Test(object):
         else:
             ts_manager_cmd = ['python', self.tunnel_manager]
 
-        sys.stderr.write('[tunnel server manager (tsm)] ')
-        self.ts_manager = Popen(ts_manager_cmd, stdin=PIPE, stdout=PIPE,
-                                preexec_fn=os.setsid)
+        self.ts_manager = self.start_tunnel_manager(
+            ts_manager_cmd, 'tunnel server manager', 'tsm')
         ts_manager = self.ts_manager
-
-        while True:
-            running = ts_manager.stdout.readline()
-            if 'tunnel manager is running' in running:
-                sys.stderr.write(running)
-                break
-            if not running:
-                sys.stderr.write('WARNING: tunnel server manager terminated '
-                                 'unexpectedly\n')
-                return None, None
-
-        ts_manager.stdin.write('prompt [tsm]\n')
-        ts_manager.stdin.flush()
+        if ts_manager is None:
+            return None, None
 
         # run tunnel client manager
         if self.mode == 'remote':
@@ -306,29 +343,13 @@ class Test(object):
         else:
             tc_manager_cmd = self.mm_cmd + ['python', self.tunnel_manager]
 
-        sys.stderr.write('[tunnel client manager (tcm)] ')
-        # NB: using `preexec_fn=os.setsid` creates a new process group, so that
-        # it is easy to kill all associated child processes afterwards.
-        self.tc_manager = Popen(tc_manager_cmd, stdin=PIPE, stdout=PIPE,
-                                preexec_fn=os.setsid)
+        self.tc_manager = self.start_tunnel_manager(
+            tc_manager_cmd, 'tunnel client manager', 'tcm')
         tc_manager = self.tc_manager
 
-        while True:
-            running = tc_manager.stdout.readline()
-            if 'tunnel manager is running' in running:
-                sys.stderr.write(running)
-                break
-            if not running:
-                sys.stderr.write('WARNING: tunnel client manager terminated '
-                                 'unexpectedly\n')
-                return ts_manager, None
-
-        tc_manager.stdin.write('prompt [tcm]\n')
-        tc_manager.stdin.flush()
-
         return ts_manager, tc_manager
 
-    def run_tunnel_server(self, tun_id, ts_manager):
+    def get_tunnel_server_cmd(self, tun_id):
         ts_cmd = 'mm-tunnelserver'
         if self.server_side == self.sender_side:
             if(self.do_log):
@@ -349,19 +370,30 @@ class Test(object):
                 if self.local_if is not None:
                     ts_cmd += ' --interface=' + self.local_if
 
-        ts_cmd = 'tunnel %s %s\n' % (tun_id, ts_cmd)
-        ts_manager.stdin.write(ts_cmd)
-        ts_manager.stdin.flush()
+        return 'tunnel %s %s' % (tun_id, ts_cmd)
+
+    def run_tunnel_servers(self, ts_manager):
+        # run the tunnel servers of all flows at once
+        readlines = {}
+        for tun_id in xrange(1, self.flows + 1):
+            ts_manager.send(self.get_tunnel_server_cmd(tun_id),
+                            wait_reply=False)
+
+            # read the command to run tunnel client
+            readlines[tun_id] = ts_manager.send('tunnel %s readline' % tun_id)
+
+        cmds_to_run_tc = {}
+        for tun_id in xrange(1, self.flows + 1):
+            status, cmd_to_run_tc = ts_manager.recv(readlines[tun_id])
+            if status != 'ok':
+                sys.stderr.write('Unable to run tunnel server %s\n' % tun_id)
+                return None
 
-        # read the command to run tunnel client
-        readline_cmd = 'tunnel %s readline\n' % tun_id
-        ts_manager.stdin.write(readline_cmd)
-        ts_manager.stdin.flush()
+            cmds_to_run_tc[tun_id] = cmd_to_run_tc.split()
 
-        cmd_to_run_tc = ts_manager.stdout.readline().split()
-        return cmd_to_run_tc
+        return cmds_to_run_tc
 
-    def run_tunnel_client(self, tun_id, tc_manager, cmd_to_run_tc):
+    def get_tunnel_client_cmd(self, tun_id, cmd_to_run_tc):
         if self.mode == 'local':
             cmd_to_run_tc[1] = '$MAHIMAHI_BASE'
         else:
@@ -391,44 +423,65 @@ class Test(object):
                 if self.remote_if is not None:
                     tc_cmd += ' --interface=' + self.remote_if
 
-        tc_cmd = 'tunnel %s %s\n' % (tun_id, tc_cmd)
-        readline_cmd = 'tunnel %s readline\n' % tun_id
+        return 'tunnel %s %s' % (tun_id, tc_cmd)
+
+    def run_tunnel_clients(self, tc_manager, cmds_to_run_tc):
+        # run the tunnel clients of all flows at once and wait until all of
+        # them are connected
+        tc_cmds = {}
+        for tun_id in xrange(1, self.flows + 1):
+            tc_cmds[tun_id] = self.get_tunnel_client_cmd(
+                tun_id, cmds_to_run_tc[tun_id])
 
-        # re-run tunnel client after 20s timeout for at most 3 times
+        # re-run tunnel clients after 20s timeout for at most 3 times, or
+        # give up after the timeout of --abort-unconnected
         max_run = 3
-        curr_run = 0
-        got_connection = ''
-        while 'got connection' not in got_connection:
-            curr_run += 1
-            if curr_run > max_run:
-                sys.stderr.write('Unable to establish tunnel\n')
-                return False
+        timeout = 20
+        if self.abort_unconnected is not None:
+            max_run = 1
+            timeout = self.abort_unconnected
+
+        unconnected = range(1, self.flows + 1)
+        for _ in xrange(max_run):
+            # the timeout applies to the whole attempt, however many lines
+            # the tunnel clients print before they are connected
+            deadline = utils.monotonic_time() + timeout
+
+            readlines = {}
+            for tun_id in unconnected:
+                tc_manager.send(tc_cmds[tun_id], wait_reply=False)
+                readlines[tun_id] = tc_manager.send(
+                    'tunnel %s readline %s' % (tun_id, timeout))
+
+            for tun_id in list(unconnected):
+                status, got_connection = tc_manager.recv(readlines[tun_id])
+                while status == 'ok' and 'got connection' not in got_connection:
+                    remaining = deadline - utils.monotonic_time()
+                    if remaining <= 0:
+                        status = 'timeout'
+                        break
+
+                    status, got_connection = tc_manager.call(
+                        'tunnel %s readline %.3f' % (tun_id, remaining))
 
-            tc_manager.stdin.write(tc_cmd)
-            tc_manager.stdin.flush()
-            while True:
-                tc_manager.stdin.write(readline_cmd)
-                tc_manager.stdin.flush()
-
-                signal.signal(signal.SIGALRM, utils.timeout_handler)
-                signal.alarm(20)
-
-                try:
-                    got_connection = tc_manager.stdout.readline()
-                    sys.stderr.write('Tunnel is connected\n')
-                except utils.TimeoutError:
-                    sys.stderr.write('Tunnel connection timeout\n')
-                    break
-                except IOError:
+                if status == 'ok':
+                    sys.stderr.write('Tunnel %s is connected\n' % tun_id)
+                    unconnected.remove(tun_id)
+                elif status == 'timeout':
+                    sys.stderr.write('Tunnel %s connection timeout\n' % tun_id)
+                else:
                     sys.stderr.write('Tunnel client failed to connect to '
                                      'tunnel server\n')
                     return False
-                else:
-                    signal.alarm(0)
-                    if 'got connection' in got_connection:
-                        break
 
-        return True
+            if not unconnected:
+                return True
+
+        sys.stderr.write('Unable to establish tunnel\n')
+        if self.abort_unconnected is not None:
+            self.abort('tunnel never connected within %s seconds'
+                       % self.abort_unconnected)
+        return False
 
     def run_first_side(self, tun_id, send_manager, recv_manager,
                        send_pri_ip, recv_pri_ip):
@@ -450,8 +503,8 @@ class Test(object):
             second_cmd = 'tunnel %s python %s sender %s %s --extra_args=%s\n' % (
                 tun_id, second_src, recv_pri_ip, port, extra_args)
 
-            recv_manager.stdin.write(first_cmd)
-            recv_manager.stdin.flush()
+            recv_manager.send(first_cmd, wait_reply=False)
+            self.first_sides[tun_id] = (recv_manager, port)
         elif self.run_first == 'sender':  # self.run_first == 'sender'
             if self.mode == 'remote':
                 if self.sender_side == 'local':
@@ -466,8 +519,8 @@ class Test(object):
             second_cmd = 'tunnel %s python %s receiver %s %s\n' % (
                 tun_id, second_src, send_pri_ip, port)
 
-            send_manager.stdin.write(first_cmd)
-            send_manager.stdin.flush()
+            send_manager.send(first_cmd, wait_reply=False)
+            self.first_sides[tun_id] = (send_manager, port)
 
         # get run_first and run_second from the flow object
         else:
@@ -491,8 +544,8 @@ class Test(object):
                 second_cmd = 'tunnel %s python %s sender %s %s\n' % (
                     tun_id, second_src, recv_pri_ip, port)
 
-                recv_manager.stdin.write(first_cmd)
-                recv_manager.stdin.flush()
+                recv_manager.send(first_cmd, wait_reply=False)
+                self.first_sides[tun_id] = (recv_manager, port)
             else:  # flow.run_first == 'sender'
                 if self.mode == 'remote':
                     if self.sender_side == 'local':
@@ -507,45 +560,158 @@ class Test(object):
                 second_cmd = 'tunnel %s python %s receiver %s %s\n' % (
                     tun_id, second_src, send_pri_ip, port)
 
-                send_manager.stdin.write(first_cmd)
-                send_manager.stdin.flush()
+                send_manager.send(first_cmd, wait_reply=False)
+                self.first_sides[tun_id] = (send_manager, port)
 
         return second_cmd
 
+    def wait_for_first_sides(self):
+        # wait until the side that runs first in each flow is listening on
+        # its port, for at most self.run_first_setup_time seconds in total
+        waits = {}
+        for tun_id in sorted(self.first_sides):
+            manager, port = self.first_sides[tun_id]
+            waits[tun_id] = manager.send('tunnel %s wait %s %s' % (
+                tun_id, port, self.run_first_setup_time))
+
+        for tun_id in sorted(self.first_sides):
+            manager, port = self.first_sides[tun_id]
+            status, _ = manager.recv(waits[tun_id])
+
+            if status != 'ok':
+                sys.stderr.write('Warning: flow %s is not listening on port %s'
+                                 ' after %s seconds\n' % (
+                                     tun_id, port, self.run_first_setup_time))
+
+    def start_live_monitor(self):
+        # tail datalink logs where they are written: the egress log on the
+        # sender side and the ingress log on the receiver side
+        if self.mode == 'remote':
+            remote_ssh = self.r['ssh_cmd']
+            if self.sender_side == 'remote':
+                send_ssh, recv_ssh = remote_ssh, None
+                send_ofst, recv_ofst = self.remote_ofst, self.local_ofst
+            else:
+                send_ssh, recv_ssh = None, remote_ssh
+                send_ofst, recv_ofst = self.local_ofst, self.remote_ofst
+
+            if self.remote_ofst is None or self.local_ofst is None:
+                send_ofst = recv_ofst = None
+        else:
+            send_ssh = recv_ssh = send_ofst = recv_ofst = None
+
+        logs = {}
+        for tun_id in xrange(1, self.flows + 1):
+            logs[tun_id] = {'send': self.datalink_egress_logs[tun_id],
+                            'recv': self.datalink_ingress_logs[tun_id],
+                            'send_ssh': send_ssh, 'recv_ssh': recv_ssh,
+                            'send_ofst': send_ofst, 'recv_ofst': recv_ofst}
+
+        stats_path = path.join(self.data_dir, '%s_live_stats_run%d.jsonl'
+                               % (self.cc, self.run_id))
+        self.live_monitor = live_monitor.LiveMonitor(
+            logs, stats_path, self.live_window, self.live_interval,
+            self.live_min_tput, self.live_grace, self.abort_idle,
+            max_runtime=self.runtime)
+        self.live_monitor.start()
+
+    def abort(self, reason):
+        sys.stderr.write('Aborting test: %s\n' % reason)
+        self.abort_reason = reason
+
+    def find_exited(self):
+        # return why a tunnel manager or a tunnel exited early or None
+        managers = [(self.ts_manager, 'tunnel server'),
+                    (self.tc_manager, 'tunnel client')]
+        for manager, name in managers:
+            if manager.poll() is not None:
+                return '%s manager exited before time limit' % name
+
+        polls = []
+        for manager, name in managers:
+            for tun_id in xrange(1, self.flows + 1):
+                req_id = manager.send('tunnel %s poll' % tun_id)
+                polls.append((manager, name, tun_id, req_id))
+
+        for manager, name, tun_id, req_id in polls:
+            status, output = manager.recv(req_id)
+            if status != 'ok' or output.startswith('exited'):
+                return '%s %s exited before time limit' % (name, tun_id)
+
+        return None
+
+    def wait_until(self, deadline):
+        # wait until deadline, checking the health rules every 0.5 seconds;
+        # return False if the test is aborted
+        while True:
+            remaining = deadline - utils.monotonic_time()
+            if remaining <= 0:
+                return True
+
+            if self.live_monitor is None:
+                utils.sleep_until(utils.monotonic_time() +
+                                  min(remaining, 0.5))
+            elif self.live_monitor.wait(min(remaining, 0.5)):
+                self.abort(self.live_monitor.abort_reason)
+                return False
+
+            if self.abort_exited:
+                reason = self.find_exited()
+                if reason is not None:
+                    self.abort(reason)
+                    return False
+
     def run_second_side(self, send_manager, recv_manager, second_cmds):
-        time.sleep(self.run_first_setup_time)
+        self.wait_for_first_sides()
+
+        if self.live_stats:
+            self.start_live_monitor()
+        try:
+            return self.run_flows(send_manager, recv_manager, second_cmds)
+        finally:
+            if self.live_monitor is not None:
+                self.live_monitor.stop()
 
-        start_time = time.time()
+    def run_flows(self, send_manager, recv_manager, second_cmds):
+        start_time = utils.monotonic_time()
         self.test_start_time = utils.utc_time()
 
-        # start each flow self.interval seconds after the previous one
-        for i in xrange(len(second_cmds)):
-            if i != 0:
-                time.sleep(self.interval)
+        # start each flow at its offset from the start, on deadlines so that
+        # delays in starting flows do not add up
+        order = sorted(xrange(len(second_cmds)),
+                       key=lambda i: self.flow_start_offsets[i])
+        for i in order:
+            utils.sleep_until(start_time + self.flow_start_offsets[i])
             second_cmd = second_cmds[i]
 
             if self.run_first == 'receiver':
-                send_manager.stdin.write(second_cmd)
-                send_manager.stdin.flush()
+                send_manager.send(second_cmd, wait_reply=False)
             elif self.run_first == 'sender':
-                recv_manager.stdin.write(second_cmd)
-                recv_manager.stdin.flush()
+                recv_manager.send(second_cmd, wait_reply=False)
             else:
                 assert(hasattr(self, 'flow_objs'))
-                flow = self.flow_objs[i]
+                flow = self.flow_objs[i + 1]
                 if flow.run_first == 'receiver':
-                    send_manager.stdin.write(second_cmd)
-                    send_manager.stdin.flush()
+                    send_manager.send(second_cmd, wait_reply=False)
                 elif flow.run_first == 'sender':
-                    recv_manager.stdin.write(second_cmd)
-                    recv_manager.stdin.flush()
-
-        elapsed_time = time.time() - start_time
+                    recv_manager.send(second_cmd, wait_reply=False)
+
+            # record when the flow actually started (in ms since the epoch,
+            # as initial timestamps of logs) and its lag in ms behind offset
+            self.flow_starts.append({
+                'flow': i + 1,
+                'offset': self.flow_start_offsets[i],
+                'start_ts': round(time.time() * 1000, 3),
+                'lag': round((utils.monotonic_time() - start_time -
+                              self.flow_start_offsets[i]) * 1000, 3)})
+
+        elapsed_time = utils.monotonic_time() - start_time
         if elapsed_time > self.runtime:
             sys.stderr.write('Interval time between flows is too long')
             return False
 
-        time.sleep(self.runtime - elapsed_time)
+        if not self.wait_until(start_time + self.runtime):
+            return False
         self.test_end_time = utils.utc_time()
 
         return True
@@ -567,16 +733,18 @@ class Test(object):
             send_manager = tc_manager
             recv_manager = ts_manager
 
+        # run tunnel servers and clients of all flows
+        cmds_to_run_tc = self.run_tunnel_servers(ts_manager)
+        if cmds_to_run_tc is None:
+            return False
+
+        if not self.run_tunnel_clients(tc_manager, cmds_to_run_tc):
+            return False
+
         # run every flow
         second_cmds = []
         for tun_id in xrange(1, self.flows + 1):
-            # run tunnel server for tunnel tun_id
-            cmd_to_run_tc = self.run_tunnel_server(tun_id, ts_manager)
-
-            # run tunnel client for tunnel tun_id
-            if not self.run_tunnel_client(tun_id, tc_manager, cmd_to_run_tc):
-                return False
-
+            cmd_to_run_tc = cmds_to_run_tc[tun_id]
             tc_pri_ip = cmd_to_run_tc[3]  # tunnel client private IP
             ts_pri_ip = cmd_to_run_tc[4]  # tunnel server private IP
 
@@ -596,11 +764,13 @@ class Test(object):
         if not self.run_second_side(send_manager, recv_manager, second_cmds):
             return False
 
-        # stop all the running flows and quit tunnel managers
-        ts_manager.stdin.write('halt\n')
-        ts_manager.stdin.flush()
-        tc_manager.stdin.write('halt\n')
-        tc_manager.stdin.flush()
+        # stop all the running flows and quit tunnel managers, or keep
+        # them running for the next test
+        if self.tunnel_managers is not None:
+            self.tunnel_managers.reset()
+        else:
+            ts_manager.send('halt', wait_reply=False)
+            tc_manager.send('halt', wait_reply=False)
 
         # process tunnel logs
         if(self.do_log):
@@ -608,37 +778,37 @@ class Test(object):
 
         return True
 
-    def download_tunnel_logs(self, tun_id):
+    def download_tunnel_logs(self):
         assert(self.mode == 'remote')
 
-        # download logs from remote side
-        cmd = 'scp -C %s:' % self.r['host_addr']
-        cmd += '%(remote_log)s %(local_log)s'
-
-        # function to get a corresponding local path from a remote path
-        f = lambda p: path.join(utils.tmp_dir, path.basename(p))
-
+        # download the logs of all flows from remote side at once
         if self.sender_side == 'remote':
-            local_log = f(self.datalink_egress_logs[tun_id])
-            call(cmd % {'remote_log': self.datalink_egress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.datalink_egress_logs[tun_id] = local_log
-
-            local_log = f(self.acklink_ingress_logs[tun_id])
-            call(cmd % {'remote_log': self.acklink_ingress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.acklink_ingress_logs[tun_id] = local_log
+            remote_logs = [self.datalink_egress_logs, self.acklink_ingress_logs]
         else:
-            local_log = f(self.datalink_ingress_logs[tun_id])
-            call(cmd % {'remote_log': self.datalink_ingress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.datalink_ingress_logs[tun_id] = local_log
-
-            local_log = f(self.acklink_egress_logs[tun_id])
-            call(cmd % {'remote_log': self.acklink_egress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.acklink_egress_logs[tun_id] = local_log
+            remote_logs = [self.datalink_ingress_logs, self.acklink_egress_logs]
+
+        tun_ids = range(1, self.flows + 1)
+        remote_paths = [logs[tun_id] for logs in remote_logs
+                        for tun_id in tun_ids]
+
+        if self.compact_remote_logs:
+            # compact the logs on remote side, which merge_tunnel_logs.py
+            # reads as well, so that less data is transferred
+            merge_src = path.join(self.r['src_dir'], 'experiments',
+                                  'merge_tunnel_logs.py')
+            cmd = self.r['ssh_cmd'] + ['python', merge_src, 'compact']
+            if call(cmd + remote_paths) == 0:
+                remote_paths = [p + merge_tunnel_logs.COMPACT_SUFFIX
+                                for p in remote_paths]
+            else:
+                sys.stderr.write('Warning: failed to compact logs on remote '
+                                 'side => downloading raw logs\n')
+        local_paths = iter(utils.download_files(
+            self.r, remote_paths, utils.tmp_dir))
 
+        for logs in remote_logs:
+            for tun_id in tun_ids:
+                logs[tun_id] = next(local_paths)
 
     def process_tunnel_logs(self):
         datalink_tun_logs = []
@@ -660,61 +830,88 @@ class Test(object):
                     data_e_ofst = self.local_ofst
                     ack_i_ofst = self.local_ofst
 
-        merge_tunnel_logs = path.join(context.src_dir, 'experiments',
-                                      'merge_tunnel_logs.py')
-
-        for tun_id in xrange(1, self.flows + 1):
-            if self.mode == 'remote':
-                self.download_tunnel_logs(tun_id)
-
-            uid = uuid.uuid4()
-            datalink_tun_log = path.join(
-                utils.tmp_dir, '%s_flow%s_uid%s.log.merged'
-                % (self.datalink_name, tun_id, uid))
-            acklink_tun_log = path.join(
-                utils.tmp_dir, '%s_flow%s_uid%s.log.merged'
-                % (self.acklink_name, tun_id, uid))
-
-            cmd = [merge_tunnel_logs, 'single',
-                   '-i', self.datalink_ingress_logs[tun_id],
-                   '-e', self.datalink_egress_logs[tun_id],
-                   '-o', datalink_tun_log]
-            if apply_ofst:
-                cmd += ['-i-clock-offset', data_i_ofst,
-                        '-e-clock-offset', data_e_ofst]
-            call(cmd)
-
-            cmd = [merge_tunnel_logs, 'single',
-                   '-i', self.acklink_ingress_logs[tun_id],
-                   '-e', self.acklink_egress_logs[tun_id],
-                   '-o', acklink_tun_log]
-            if apply_ofst:
-                cmd += ['-i-clock-offset', ack_i_ofst,
-                        '-e-clock-offset', ack_e_ofst]
-            call(cmd)
-
-            datalink_tun_logs.append(datalink_tun_log)
-            acklink_tun_logs.append(acklink_tun_log)
-
-        cmd = [merge_tunnel_logs, 'multiple', '-o', self.datalink_log]
-        if self.mode == 'local':
-            cmd += ['--link-log', self.mm_datalink_log]
-        cmd += datalink_tun_logs
-        call(cmd)
+        if self.mode == 'remote':
+            self.download_tunnel_logs()
 
-        cmd = [merge_tunnel_logs, 'multiple', '-o', self.acklink_log]
-        if self.mode == 'local':
-            cmd += ['--link-log', self.mm_acklink_log]
-        cmd += acklink_tun_logs
-        call(cmd)
+        # merge logs in worker processes, each flow's datalink and acklink
+        # logs in parallel first and then the logs of all flows
+        pool = multiprocessing.Pool(
+            processes=min(multiprocessing.cpu_count(), 2 * self.flows))
+        # the pool is terminated even if a merge raises
+        try:
+            merges = []
+
+            for tun_id in xrange(1, self.flows + 1):
+                uid = uuid.uuid4()
+                datalink_tun_log = path.join(
+                    utils.tmp_dir, '%s_flow%s_uid%s.log.merged'
+                    % (self.datalink_name, tun_id, uid))
+                acklink_tun_log = path.join(
+                    utils.tmp_dir, '%s_flow%s_uid%s.log.merged'
+                    % (self.acklink_name, tun_id, uid))
+
+                kwargs = {'ingress_log': self.datalink_ingress_logs[tun_id],
+                          'egress_log': self.datalink_egress_logs[tun_id],
+                          'output_log': datalink_tun_log}
+                if apply_ofst:
+                    kwargs['i_clock_offset'] = float(data_i_ofst)
+                    kwargs['e_clock_offset'] = float(data_e_ofst)
+                merges.append(
+                    pool.apply_async(merge_worker, ('single', kwargs)))
+
+                kwargs = {'ingress_log': self.acklink_ingress_logs[tun_id],
+                          'egress_log': self.acklink_egress_logs[tun_id],
+                          'output_log': acklink_tun_log}
+                if apply_ofst:
+                    kwargs['i_clock_offset'] = float(ack_i_ofst)
+                    kwargs['e_clock_offset'] = float(ack_e_ofst)
+                merges.append(
+                    pool.apply_async(merge_worker, ('single', kwargs)))
+
+                datalink_tun_logs.append(datalink_tun_log)
+                acklink_tun_logs.append(acklink_tun_log)
+
+            for merge in merges:
+                merge.get()
+            merges = []
+
+            datalink_kwargs = {'tunnel_logs': datalink_tun_logs,
+                               'output_log': self.datalink_log,
+                               'binary': self.binary_logs}
+            acklink_kwargs = {'tunnel_logs': acklink_tun_logs,
+                              'output_log': self.acklink_log,
+                              'binary': self.binary_logs}
+            if self.mode == 'local':
+                # mm-link logs are only read for their initial timestamps as
+                # link capacity is computed from the traces
+                datalink_kwargs['link_log'] = self.mm_datalink_log
+                acklink_kwargs['link_log'] = self.mm_acklink_log
+                datalink_kwargs['link_trace'] = self.datalink_trace
+                acklink_kwargs['link_trace'] = self.acklink_trace
+
+            for kwargs in [datalink_kwargs, acklink_kwargs]:
+                merges.append(
+                    pool.apply_async(merge_worker, ('multiple', kwargs)))
+
+            for merge in merges:
+                merge.get()
+        finally:
+            pool.terminate()
+            pool.join()
 
     def run_congestion_control(self):
         if self.flows > 0:
+            success = False
             try:
-                return self.run_with_tunnel()
+                success = self.run_with_tunnel()
+                return success
             finally:
-                utils.kill_proc_group(self.ts_manager)
-                utils.kill_proc_group(self.tc_manager)
+                if self.tunnel_managers is None:
+                    utils.kill_proc_group(self.ts_manager)
+                    utils.kill_proc_group(self.tc_manager)
+                elif not success:
+                    # tunnel managers may be in any state after an error
+                    self.tunnel_managers.close()
         else:
             # test without pantheon tunnel when self.flows = 0
             try:
@@ -728,6 +925,14 @@ class Test(object):
             self.data_dir, '%s_stats_run%s.log' % (self.cc, self.run_id))
         stats = open(stats_log, 'w')
 
+        # save why this test and its earlier attempts were aborted
+        aborts = list(self.previous_aborts)
+        if self.abort_reason is not None:
+            aborts.append(self.abort_reason)
+        for reason in aborts:
+            sys.stderr.write('Aborted: %s\n' % reason)
+            stats.write('Aborted: %s\n' % reason)
+
         # save start time and end time of test
         if self.test_start_time is not None and self.test_end_time is not None:
             test_run_duration = (
@@ -750,6 +955,20 @@ class Test(object):
 
         stats.close()
 
+    def record_flow_starts(self):
+        # save the start times of flows in metadata to align flows in
+        # analysis, under the same '<cc>_run<run_id>' keys as logs
+        if not self.flow_starts:
+            return
+
+        metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
+        key = '%s_run%d' % (self.cc, self.run_id)
+        flow_starts = sorted(self.flow_starts, key=lambda f: f['flow'])
+
+        def add_flow_starts(meta):
+            meta.setdefault('flow_starts', {})[key] = flow_starts
+        utils.update_test_metadata(metadata_path, add_flow_starts)
+
     # run congestion control test
     def run(self):
         msg = 'Testing scheme %s for experiment run %d/%d...' % (
@@ -763,19 +982,160 @@ class Test(object):
         if not self.run_congestion_control():
             sys.stderr.write('Error in testing scheme %s with run ID %d\n' %
                              (self.cc, self.run_id))
-            return
+            if self.abort_reason is not None:
+                self.record_time_stats()
+            return False
 
         # write runtimes and clock offsets to file
         self.record_time_stats()
+        self.record_flow_starts()
 
         sys.stderr.write('Done testing %s\n' % self.cc)
+        return True
+
+
+def run_test(test_args, run_id, cc, tunnel_managers=None):
+    # run a test, and run it again right away if a health rule aborted it
+    previous_aborts = []
+    while True:
+        test = Test(test_args, run_id, cc, tunnel_managers)
+        test.previous_aborts = previous_aborts
+        success = test.run()
+        if success or test.abort_reason is None:
+            return success
+
+        previous_aborts = previous_aborts + [test.abort_reason]
+        if len(previous_aborts) > test_args.reschedule:
+            return False
+
+        sys.stderr.write('Rescheduling %s for run %d (attempt %d)\n' % (
+            test.cc, run_id, len(previous_aborts) + 1))
+
+
+def start_tunnel_manager(cmd, name, prompt):
+    sys.stderr.write('[%s (%s)] ' % (name, prompt))
+    # NB: using `preexec_fn=os.setsid` creates a new process group, so that
+    # it is easy to kill all associated child processes afterwards.
+    manager = Popen(cmd, stdin=PIPE, stdout=PIPE, preexec_fn=os.setsid)
+
+    while True:
+        running = manager.stdout.readline()
+        if 'tunnel manager is running' in running:
+            sys.stderr.write(running)
+            break
+        if not running:
+            sys.stderr.write('WARNING: %s terminated unexpectedly\n' % name)
+            utils.kill_proc_group(manager)
+            return None
+
+    manager = tunnel_manager.TunnelManagerClient(manager)
+    manager.send('prompt [%s]' % prompt, wait_reply=False)
+
+    return manager
+
+
+class TunnelManagerPool(object):
+    """
+    Tunnel managers kept running across tests along with their ssh
+    connections and mahimahi shells, whose tunnels are reset instead of
+    halted after each test. A tunnel manager is restarted if the command to
+    run it changes or if it is no longer running.
+    """
+
+    def __init__(self):
+        self.managers = {}  # prompt -> (command, tunnel manager)
+
+    def get(self, cmd, name, prompt):
+        if prompt in self.managers:
+            old_cmd, manager = self.managers[prompt]
+            if old_cmd == cmd and manager.poll() is None:
+                sys.stderr.write('[%s (%s)] reusing tunnel manager\n'
+                                 % (name, prompt))
+                return manager
+
+            self.stop(prompt)
+
+        manager = start_tunnel_manager(cmd, name, prompt)
+        if manager is not None:
+            self.managers[prompt] = (cmd, manager)
+
+        return manager
+
+    def reset(self):
+        # kill the tunnels of all tunnel managers, or stop the tunnel
+        # managers that fail to do so
+        for prompt in self.managers.keys():
+            _, manager = self.managers[prompt]
+
+            try:
+                status, _ = manager.call('reset')
+            except IOError:
+                status = 'eof'
+
+            if status != 'ok':
+                sys.stderr.write('Warning: failed to reset tunnels of [%s]\n'
+                                 % prompt)
+                self.stop(prompt)
+
+    def stop(self, prompt):
+        _, manager = self.managers.pop(prompt)
+
+        try:
+            manager.send('halt', wait_reply=False)
+        except IOError:
+            pass
+
+        utils.kill_proc_group(manager)
+
+    def close(self):
+        for prompt in self.managers.keys():
+            self.stop(prompt)
+
+
+def merge_worker(mode, kwargs):
+    # merge errors are reported but do not stop the test, as with
+    # running merge_tunnel_logs.py
+    try:
+        return merge_tunnel_logs.merge(mode, **kwargs)
+    except Exception:
+        traceback.print_exc()
+        return False
+
+
+def copy_to_data_dir(trace_path, data_dir):
+    # text tunnel logs name the trace of their link, so keep it next to them
+    # in case the cache of traces is cleared
+    data_trace_path = path.join(data_dir, path.basename(trace_path))
+    if not path.isfile(data_trace_path):
+        tmp_path = '%s.%d' % (data_trace_path, os.getpid())
+        shutil.copyfile(trace_path, tmp_path)
+        os.rename(tmp_path, data_trace_path)
+
+    return data_trace_path
+
+
+def compile_link_traces(args):
+    # compile rate schedules into mahimahi traces, or reuse cached ones
+    if args.uplink_schedule is not None:
+        args.uplink_trace = copy_to_data_dir(
+            link_trace.compile_trace(args.uplink_schedule), args.data_dir)
+    if args.downlink_schedule is not None:
+        args.downlink_trace = copy_to_data_dir(
+            link_trace.compile_trace(args.downlink_schedule), args.data_dir)
 
 
 def run_tests(args):
+    if args.mode == 'local':
+        compile_link_traces(args)
+
     # check and get git summary
     git_summary = utils.get_git_summary(args.mode,
                                         getattr(args, 'remote_path', None))
 
+    if getattr(args, 'sweep', None) is not None:
+        run_sweep(args, git_summary)
+        return
+
     # get cc_schemes
     cc_schemes = OrderedDict()
     if args.all:
@@ -802,18 +1162,326 @@ def run_tests(args):
     meta['cc_schemes'] = sorted(cc_schemes)
     meta['git_summary'] = git_summary
 
+    # merge into the metadata of the sweep being resumed
     metadata_path = path.join(args.data_dir, 'pantheon_metadata.json')
-    utils.save_test_metadata(meta, metadata_path)
+    utils.save_test_metadata(meta, metadata_path, merge=args.resume)
 
     # run tests
+    tests = OrderedDict()
     for run_id in xrange(args.start_run_id,
                          args.start_run_id + args.run_times):
         if not hasattr(args, 'test_config') or args.test_config is None:
             for cc, params in cc_schemes.iteritems():
-                test_args = get_cc_args(args, params)
-                Test(test_args, run_id, cc).run()
+                tests[run_queue.run_key(cc, run_id)] = (
+                    run_id, cc, get_cc_args(args, params))
         else:
-            Test(args, run_id, None).run()
+            test_name = args.test_config['test-name']
+            tests[run_queue.run_key(test_name, run_id)] = (run_id, None, args)
+
+    run_queued_tests(args, tests, metadata_path)
+
+
+def run_queued_tests(args, tests, metadata_path):
+    # queue the runs in the data directory; if resumed, in the order of the
+    # earlier sweep and skipping the runs in its manifest whose logs are
+    # unchanged
+    queue = run_queue.RunQueue(args.data_dir, args.retries,
+                               args.retry_backoff)
+    is_done = None
+    if args.resume:
+        queue.load()
+        finished = run_queue.load_finished(args.data_dir)
+        is_done = lambda key: (key in finished and run_queue.verify_finished(
+            args.data_dir, finished[key]))
+    queue.reset(tests.keys(), is_done)
+
+    skipped = len(tests) - len(queue.pending())
+    if skipped:
+        sys.stderr.write('Skipping %d runs that are already done\n' % skipped)
+
+    if args.mode == 'local' and args.parallel > 1:
+        run_tests_in_parallel(args, queue, tests, metadata_path)
+    else:
+        run_tests_in_order(args, queue, tests)
+
+    failed = [key for key in tests if queue.state(key) == 'failed']
+    if failed:
+        sys.stderr.write('Warning: runs failed after all retries: %s\n'
+                         % ' '.join(failed))
+
+
+def finish_run(args, queue, key, success, error=None):
+    """
+    Mark a run as finished in the queue, and append it to the manifest of
+    finished runs along with checksums of its logs if it is done. A run
+    that did not save all its logs failed.
+    """
+    cc, run = key.rsplit('_', 1)
+
+    # stats logs are rewritten by analysis, so they are not checksummed
+    log_names = []
+    if args.do_log and args.flows > 0:
+        log_names = ['%s_datalink_%s.log' % (cc, run),
+                     '%s_acklink_%s.log' % (cc, run)]
+    unchecked_names = ['%s_stats_%s.log' % (cc, run)]
+
+    if success:
+        for log_name in log_names + unchecked_names:
+            if not path.isfile(path.join(args.data_dir, log_name)):
+                success = False
+                error = '%s is missing' % log_name
+
+    if queue.finish(key, success, error) == 'done':
+        run_queue.append_finished(args.data_dir, key, utils.utc_time(),
+                                  log_names, unchecked_names)
+
+
+def format_error():
+    # print the traceback of the exception being handled and return its
+    # last line (e.g., "IOError: ...") to record in the run queue
+    error = traceback.format_exc()
+    sys.stderr.write(error)
+    return error.strip().splitlines()[-1]
+
+
+def wait_for_retry(key, wait):
+    if wait > 0:
+        sys.stderr.write('Retrying %s in %.1f seconds\n' % (key, wait))
+        time.sleep(wait)
+
+
+def run_tests_in_order(args, queue, tests):
+    tunnel_managers = None
+    if args.reuse_tunnel_managers:
+        tunnel_managers = TunnelManagerPool()
+
+    try:
+        while True:
+            key, wait = queue.next_ready()
+            if key is None:
+                break
+            wait_for_retry(key, wait)
+
+            run_id, cc, test_args = tests[key]
+            queue.start(key)
+            try:
+                success = run_test(test_args, run_id, cc, tunnel_managers)
+                error = None
+            except Exception:
+                # retry the run as a parallel slot does
+                success = False
+                error = format_error()
+
+                if tunnel_managers is not None:
+                    tunnel_managers.close()
+
+            finish_run(args, queue, key, success, error)
+    finally:
+        if tunnel_managers is not None:
+            tunnel_managers.close()
+
+
+def get_cpu_slots(args):
+    # disjoint lists of CPUs to pin the tests running at once to
+    if not args.pin_cpus:
+        return [None] * args.parallel
+
+    num_cpus = multiprocessing.cpu_count()
+    cpus_per_run = args.cpus_per_run
+    if cpus_per_run is None:
+        cpus_per_run = num_cpus // args.parallel
+
+    if cpus_per_run < 1 or cpus_per_run * args.parallel > num_cpus:
+        sys.exit('Cannot pin %d tests to %s CPUs each with %d CPUs' %
+                 (args.parallel, cpus_per_run, num_cpus))
+
+    return [range(slot * cpus_per_run, (slot + 1) * cpus_per_run)
+            for slot in xrange(args.parallel)]
+
+
+def run_test_slot(slot, cpus, test_queue, result_queue,
+                  reuse_tunnel_managers=False):
+    # run tests one at a time in a slot, i.e., a process that is pinned to
+    # cpus (if not None) along with the processes of the tests it runs
+    if cpus is not None:
+        cmd = ['taskset', '-pc', ','.join(map(str, cpus)), str(os.getpid())]
+        with open(os.devnull, 'w') as devnull:
+            if call(cmd, stdout=devnull) != 0:
+                sys.stderr.write('Warning: failed to pin slot %d to CPUs %s\n'
+                                 % (slot, cmd[2]))
+
+    # each slot keeps tunnel managers of its own
+    tunnel_managers = None
+    if reuse_tunnel_managers:
+        tunnel_managers = TunnelManagerPool()
+
+    while True:
+        test = test_queue.get()
+        if test is None:
+            break
+
+        key, run_id, cc, test_args = test
+        try:
+            success = run_test(test_args, run_id, cc, tunnel_managers)
+            error = None
+        except:  # intended to catch all exceptions
+            success = False
+            error = format_error()
+
+            if tunnel_managers is not None:
+                tunnel_managers.close()
+
+        result_queue.put((key, slot, success, error))
+
+    if tunnel_managers is not None:
+        tunnel_managers.close()
+
+
+def run_tests_in_parallel(args, queue, tests, metadata_path):
+    cpu_slots = get_cpu_slots(args)
+
+    test_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+
+    slots = []
+    for slot, cpus in enumerate(cpu_slots):
+        proc = multiprocessing.Process(
+            target=run_test_slot,
+            args=(slot, cpus, test_queue, result_queue,
+                  args.reuse_tunnel_managers))
+        proc.start()
+        slots.append(proc)
+
+    # hand runs that are ready to idle slots until every run is finished,
+    # queueing failed runs again to retry them later
+    running = set()
+    assignments = []
+    errors = {}
+    while True:
+        while len(running) < len(slots):
+            key, wait = queue.next_ready()
+            if key is None or wait > 0:
+                break
+
+            run_id, cc, test_args = tests[key]
+            queue.start(key)
+            test_queue.put((key, run_id, cc, test_args))
+            running.add(key)
+
+        if not running:
+            key, wait = queue.next_ready()
+            if key is None:
+                break
+            wait_for_retry(key, wait)
+            continue
+
+        try:
+            key, slot, success, error = result_queue.get(timeout=1)
+        except Queue.Empty:
+            if not any([proc.is_alive() for proc in slots]):
+                break
+            continue
+
+        running.discard(key)
+        if error is not None:
+            errors[key] = error
+        finish_run(args, queue, key, success,
+                   error and error.strip().splitlines()[-1])
+
+        # record which slot and CPUs each test ran on
+        run_id, cc, _ = tests[key]
+        assignments.append({'run_id': run_id, 'cc': cc, 'slot': slot,
+                            'cpus': cpu_slots[slot], 'success': success,
+                            'attempt': queue.runs[key]['attempts']})
+
+    for _ in slots:
+        test_queue.put(None)
+    for proc in slots:
+        proc.join()
+
+    def add_assignments(meta):
+        meta.setdefault('parallel_runs', []).extend(assignments)
+    utils.update_test_metadata(metadata_path, add_assignments)
+
+    # report errors of the runs that did not succeed in the end
+    failed_errors = []
+    for key in tests:
+        if key in running:
+            failed_errors.append('test %s did not finish' % key)
+        elif queue.state(key) != 'done' and key in errors:
+            failed_errors.append(errors[key])
+
+    if failed_errors:
+        raise RuntimeError('errors in tests running in parallel:\n%s'
+                           % '\n'.join(failed_errors))
+
+
+def run_sweep(args, git_summary):
+    """
+    Sweep the params of a scheme (see sweep.py) by successive halving: run
+    all sampled configs for a short runtime first, then keep the best
+    1/eta of them by their scores and run them again eta times longer, up
+    to --runtime in the last round. Round i runs with run ID i.
+    """
+    scheme, space = sweep.parse_space(args.sweep)
+    configs = sweep.sample_configs(scheme, space, args.sweep_samples,
+                                   args.sweep_sampler, args.sweep_seed)
+
+    runtimes = [sweep.round_runtime(args.runtime, round_id,
+                                    args.sweep_rounds, args.sweep_eta)
+                for round_id in xrange(args.sweep_rounds)]
+
+    meta = vars(args).copy()
+    meta['cc_schemes'] = sorted(configs)
+    meta['run_times'] = args.sweep_rounds
+    # runs are shorter than --runtime before the last round
+    meta['run_runtimes'] = dict((str(round_id + 1), runtime)
+                                for round_id, runtime in enumerate(runtimes))
+    meta['git_summary'] = git_summary
+
+    metadata_path = path.join(args.data_dir, 'pantheon_metadata.json')
+    utils.save_test_metadata(meta, metadata_path, merge=args.resume)
+
+    names = configs.keys()
+    rounds = []
+    for round_id in xrange(args.sweep_rounds):
+        round_args = copy.copy(args)
+        round_args.runtime = runtimes[round_id]
+        run_id = round_id + 1
+
+        sys.stderr.write('Sweep round %d/%d: %d configs for %d seconds\n' % (
+            run_id, args.sweep_rounds, len(names), round_args.runtime))
+
+        tests = OrderedDict()
+        for cc in names:
+            tests[run_queue.run_key(cc, run_id)] = (
+                run_id, cc, get_cc_args(round_args, configs[cc]))
+        run_queued_tests(round_args, tests, metadata_path)
+
+        scores = OrderedDict()
+        for cc in names:
+            scores[cc] = sweep.score_run(
+                path.join(args.data_dir, '%s_datalink_run%d.log'
+                          % (cc, run_id)), args.sweep_metric)
+            sys.stderr.write('  %s: %s\n' % (cc, scores[cc]))
+
+        rounds.append({'run_id': run_id, 'runtime': round_args.runtime,
+                       'scores': scores})
+
+        names = sweep.select_best(scores, max(1, len(names) // args.sweep_eta))
+        if not names:
+            sys.stderr.write('Warning: no config of the sweep succeeded\n')
+            break
+
+    # record the sampled configs, the scores of each round and the best one
+    def add_sweep(meta):
+        meta['sweep_results'] = {
+            'configs': configs, 'metric': args.sweep_metric,
+            'rounds': rounds, 'best': names[0] if names else None}
+    utils.update_test_metadata(metadata_path, add_sweep)
+
+    if names:
+        sys.stderr.write('Best config of the sweep: %s\n' % names[0])
 
 
 def get_cc_args(args, params):
@@ -836,7 +1504,7 @@ def get_cc_args(args, params):
                 # can use the type of the default setting value to cast the
                 # string `val` into the desired type.
                 cast_func = type(getattr(args, param))
-                setattr(args, param, cast_func(param))
+                setattr(args, param, cast_func(val))
             else:
                 # This must be an indirect parameter passed through `--extra-sender-args`:
                 # modify this string to use the desired value instead of current one.
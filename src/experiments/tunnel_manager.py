@@ -3,113 +3,347 @@
 import os
 from os import path
 import sys
+import time
 import signal
+import threading
+import Queue
 from subprocess import Popen, PIPE
 
 import context
 from helpers import utils
 
 
-def main():
-    prompt = ''
-    procs = {}
+# Commands are either plain text lines, which are run one at a time, or
+# framed requests "@ID COMMAND" with a unique integer ID. Every framed request
+# is replied to with "@ID STATUS [OUTPUT]", where STATUS is one of ok, error,
+# timeout and eof. Commands that block (readline and wait) run in background
+# threads when framed, so their replies may arrive in any order.
+STATUSES = ['ok', 'error', 'timeout', 'eof']
+BLOCKING_CMDS = ['readline', 'wait']
 
-    # register SIGINT and SIGTERM events to clean up gracefully before quit
-    def stop_signal_handler(signum, frame):
-        for tun_id in procs:
-            utils.kill_proc_group(procs[tun_id])
 
-        sys.exit('tunnel_manager: caught signal %s and cleaned up\n' % signum)
+class CommandError(Exception):
+    pass
 
-    signal.signal(signal.SIGINT, stop_signal_handler)
-    signal.signal(signal.SIGTERM, stop_signal_handler)
 
-    sys.stdout.write('tunnel manager is running\n')
-    sys.stdout.flush()
+def read_tunnel_lines(proc, lines):
+    # read lines from stdout of a tunnel in the background
+    for line in iter(proc.stdout.readline, ''):
+        lines.put(line)
+    lines.put('')  # EOF
+
+
+class TunnelManager(object):
+    def __init__(self):
+        self.prompt = ''
+        self.procs = {}
+        self.lines = {}  # tun_id -> lines read from stdout of the tunnel
+        self.output_lock = threading.Lock()
+
+    def write(self, output):
+        with self.output_lock:
+            sys.stdout.write(output)
+            sys.stdout.flush()
+
+    def kill_tunnels(self):
+        for tun_id in self.procs:
+            utils.kill_proc_group(self.procs[tun_id])
+
+    def exit(self, message=None):
+        # exit without waiting for threads blocked on reading tunnels
+        if message:
+            sys.stderr.write(message)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1 if message else 0)
 
-    while True:
-        input_cmd = sys.stdin.readline().strip()
+    def get_proc(self, tun_id):
+        if tun_id not in self.procs:
+            raise CommandError('run tunnel client or server first')
 
-        if not input_cmd:
-            # This may only happen if the parent process has died.
-            sys.stderr.write('tunnel manager\'s parent process must have died '
-                             '=> halting\n')
-            input_cmd = 'halt'
+        return self.procs[tun_id]
 
-        # print all the commands fed into tunnel manager
-        if prompt:
-            sys.stderr.write(prompt + ' ')
-        sys.stderr.write(input_cmd + '\n')
-        cmd = input_cmd.split()
+    def run_tunnel(self, tun_id, cmd_to_run):
+        # expand env variables (e.g., MAHIMAHI_BASE)
+        cmd_to_run = path.expandvars(cmd_to_run).split()
 
-        # manage I/O of multiple tunnels
-        if cmd[0] == 'tunnel':
-            if len(cmd) < 3:
-                sys.stderr.write('error: usage: tunnel ID CMD...\n')
+        # expand home directory
+        for i in xrange(len(cmd_to_run)):
+            if ('--ingress-log' in cmd_to_run[i] or
+                '--egress-log' in cmd_to_run[i]):
+                t = cmd_to_run[i].split('=')
+                cmd_to_run[i] = t[0] + '=' + path.expanduser(t[1])
+
+        # e.g., a tunnel client that failed to connect and is run again
+        if tun_id in self.procs:
+            utils.kill_proc_tree(self.procs[tun_id])
+
+        self.procs[tun_id] = Popen(cmd_to_run, stdin=PIPE,
+#                                  stdout=PIPE, preexec_fn=os.setsid)
+                                   stdout=PIPE)
+
+        self.lines[tun_id] = Queue.Queue()
+        reader = threading.Thread(target=read_tunnel_lines,
+                                  args=(self.procs[tun_id],
+                                        self.lines[tun_id]))
+        reader.daemon = True
+        reader.start()
+
+    def readline(self, tun_id, timeout=None):
+        self.get_proc(tun_id)
+        lines = self.lines[tun_id]
+
+        # wait in short slices so that signals are handled meanwhile
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = 0.1
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return 'timeout', ''
+
+            try:
+                line = lines.get(True, wait)
+                break
+            except Queue.Empty:
                 continue
 
+        if not line:
+            lines.put('')  # every following readline hits EOF as well
+            return 'eof', ''
+
+        return 'ok', line.rstrip('\n')
+
+    def run_tunnel_cmd(self, cmd):
+        # run "tunnel ID CMD..." and return (STATUS, OUTPUT)
+        if len(cmd) < 3:
+            raise CommandError('usage: tunnel ID CMD...')
+
+        try:
+            tun_id = int(cmd[1])
+        except ValueError:
+            raise CommandError('usage: tunnel ID CMD...')
+
+        cmd_to_run = ' '.join(cmd[2:])
+
+        if cmd[2] == 'mm-tunnelclient' or cmd[2] == 'mm-tunnelserver':
+            self.run_tunnel(tun_id, cmd_to_run)
+        elif cmd[2] == 'python':  # run python scripts inside tunnel
+            proc = self.get_proc(tun_id)
+            proc.stdin.write(cmd_to_run + '\n')
+            proc.stdin.flush()
+        elif cmd[2] == 'readline':  # readline from stdout of tunnel
+            if len(cmd) not in [3, 4]:
+                raise CommandError('usage: tunnel ID readline [TIMEOUT]')
+
             try:
-                tun_id = int(cmd[1])
+                timeout = float(cmd[3]) if len(cmd) == 4 else None
             except ValueError:
-                sys.stderr.write('error: usage: tunnel ID CMD...\n')
-                continue
+                raise CommandError('usage: tunnel ID readline [TIMEOUT]')
 
-            cmd_to_run = ' '.join(cmd[2:])
-
-            if cmd[2] == 'mm-tunnelclient' or cmd[2] == 'mm-tunnelserver':
-                # expand env variables (e.g., MAHIMAHI_BASE)
-                cmd_to_run = path.expandvars(cmd_to_run).split()
-
-                # expand home directory
-                for i in xrange(len(cmd_to_run)):
-                    if ('--ingress-log' in cmd_to_run[i] or
-                        '--egress-log' in cmd_to_run[i]):
-                        t = cmd_to_run[i].split('=')
-                        cmd_to_run[i] = t[0] + '=' + path.expanduser(t[1])
-
-                procs[tun_id] = Popen(cmd_to_run, stdin=PIPE,
-#                                     stdout=PIPE, preexec_fn=os.setsid)
-                                      stdout=PIPE)
-            elif cmd[2] == 'python':  # run python scripts inside tunnel
-                if tun_id not in procs:
-                    sys.stderr.write(
-                        'error: run tunnel client or server first\n')
-
-                procs[tun_id].stdin.write(cmd_to_run + '\n')
-                procs[tun_id].stdin.flush()
-            elif cmd[2] == 'readline':  # readline from stdout of tunnel
-                if len(cmd) != 3:
-                    sys.stderr.write('error: usage: tunnel ID readline\n')
-                    continue
+            return self.readline(tun_id, timeout)
+        elif cmd[2] == 'poll':  # check if the tunnel is still running
+            if len(cmd) != 3:
+                raise CommandError('usage: tunnel ID poll')
+
+            returncode = self.get_proc(tun_id).poll()
+            if returncode is None:
+                return 'ok', 'running'
+            return 'ok', 'exited %s' % returncode
+        elif cmd[2] == 'wait':  # wait until a port is ready in tunnel
+            if len(cmd) != 5:
+                raise CommandError('usage: tunnel ID wait PORT TIMEOUT')
+
+            try:
+                port = int(cmd[3])
+                timeout = float(cmd[4])
+            except ValueError:
+                raise CommandError('usage: tunnel ID wait PORT TIMEOUT')
+
+            if utils.wait_for_port(self.get_proc(tun_id).pid, port, timeout):
+                return 'ok', 'ready'
+            return 'timeout', ''
+        else:
+            raise CommandError('unknown command after "tunnel ID": %s'
+                               % cmd_to_run)
+
+        return 'ok', ''
+
+    def run_cmd(self, cmd):
+        # run a command and return (STATUS, OUTPUT)
+        try:
+            if cmd[0] == 'tunnel':  # manage I/O of multiple tunnels
+                return self.run_tunnel_cmd(cmd)
+            elif cmd[0] == 'prompt':  # set prompt in front of commands
+                if len(cmd) != 2:
+                    raise CommandError('usage: prompt PROMPT')
 
-                if tun_id not in procs:
-                    sys.stderr.write(
-                        'error: run tunnel client or server first\n')
+                self.prompt = cmd[1].strip()
+            elif cmd[0] == 'reset':  # terminate all tunnel processes only
+                if len(cmd) != 1:
+                    raise CommandError('usage: reset')
 
-                sys.stdout.write(procs[tun_id].stdout.readline())
-                sys.stdout.flush()
+                # tunnel processes share the process group of tunnel manager
+                for tun_id in self.procs:
+                    utils.kill_proc_tree(self.procs[tun_id])
+                self.procs.clear()
+                self.lines.clear()
+
+                return 'ok', 'tunnels are reset'
             else:
-                sys.stderr.write('unknown command after "tunnel ID": %s\n'
-                                 % cmd_to_run)
-                continue
-        elif cmd[0] == 'prompt':  # set prompt in front of commands to print
-            if len(cmd) != 2:
-                sys.stderr.write('error: usage: prompt PROMPT\n')
-                continue
+                raise CommandError('unknown command: %s' % ' '.join(cmd))
+        except CommandError as exception:
+            return 'error', str(exception)
+
+        return 'ok', ''
+
+    def reply(self, req_id, cmd):
+        status, output = self.run_cmd(cmd)
+        if status == 'error':
+            sys.stderr.write('error: %s\n' % output)
+
+        if output:
+            self.write('@%s %s %s\n' % (req_id, status, output))
+        else:
+            self.write('@%s %s\n' % (req_id, status))
 
-            prompt = cmd[1].strip()
-        elif cmd[0] == 'halt':  # terminate all tunnel processes and quit
+    def run_framed(self, req_id, cmd):
+        if cmd[0] == 'halt':  # terminate all tunnel processes and quit
+            self.write('@%s ok\n' % req_id)
+            self.kill_tunnels()
+            self.exit()
+
+        if cmd[0] == 'tunnel' and len(cmd) > 2 and cmd[2] in BLOCKING_CMDS:
+            # reply in the background to run the next requests meanwhile
+            replier = threading.Thread(target=self.reply, args=(req_id, cmd))
+            replier.daemon = True
+            replier.start()
+        else:
+            self.reply(req_id, cmd)
+
+    def run_plain(self, cmd):
+        if cmd[0] == 'halt':  # terminate all tunnel processes and quit
             if len(cmd) != 1:
                 sys.stderr.write('error: usage: halt\n')
+                return
+
+            self.kill_tunnels()
+            self.exit()
+
+        status, output = self.run_cmd(cmd)
+        if status == 'error':
+            sys.stderr.write('error: %s\n' % output)
+        elif status == 'timeout':
+            self.write('timeout\n')
+        elif output:
+            self.write(output + '\n')
+
+    def run(self):
+        sys.stdout.write('tunnel manager is running\n')
+        sys.stdout.flush()
+
+        while True:
+            input_cmd = sys.stdin.readline().strip()
+
+            if not input_cmd:
+                # This may only happen if the parent process has died.
+                sys.stderr.write('tunnel manager\'s parent process must have '
+                                 'died => halting\n')
+                input_cmd = 'halt'
+
+            # print all the commands fed into tunnel manager
+            if self.prompt:
+                sys.stderr.write(self.prompt + ' ')
+            sys.stderr.write(input_cmd + '\n')
+            cmd = input_cmd.split()
+
+            if cmd[0].startswith('@'):
+                if len(cmd) < 2:
+                    sys.stderr.write('error: usage: @ID COMMAND\n')
+                    continue
+
+                self.run_framed(cmd[0][1:], cmd[1:])
+            else:
+                self.run_plain(cmd)
+
+
+class TunnelManagerClient(object):
+    """
+    Send framed requests to a running tunnel manager (a Popen object with
+    stdin and stdout pipes), so that many requests can be sent before
+    waiting for their replies.
+    """
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.pid = proc.pid
+
+        self.next_id = 1
+        self.replies = {}  # replies read before they are waited for
+        self.ignored = set()  # requests whose replies are not waited for
+
+    def poll(self):
+        return self.proc.poll()
+
+    def send(self, cmd, wait_reply=True):
+        req_id = self.next_id
+        self.next_id += 1
+
+        self.proc.stdin.write('@%d %s\n' % (req_id, cmd.strip()))
+        self.proc.stdin.flush()
+
+        if not wait_reply:
+            self.ignored.add(req_id)
+        return req_id
+
+    def recv(self, req_id):
+        # return (STATUS, OUTPUT) of request req_id, or ('eof', '') if the
+        # tunnel manager has exited
+        while req_id not in self.replies:
+            line = self.proc.stdout.readline()
+            if not line:
+                return 'eof', ''
+
+            # skip lines that are not replies "@ID STATUS [OUTPUT]", e.g.,
+            # stray output of tunnels
+            reply = line.rstrip('\n').split(' ', 2)
+            if (len(reply) < 2 or not reply[0].startswith('@') or
+                    not reply[0][1:].isdigit() or reply[1] not in STATUSES):
+                sys.stderr.write('Warning: unexpected output from tunnel '
+                                 'manager: %s' % line)
                 continue
 
-            for tun_id in procs:
-                utils.kill_proc_group(procs[tun_id])
+            reply_id = int(reply[0][1:])
+            output = reply[2] if len(reply) == 3 else ''
 
-            sys.exit(0)
-        else:
-            sys.stderr.write('unknown command: %s\n' % input_cmd)
-            continue
+            if reply_id in self.ignored:
+                self.ignored.discard(reply_id)
+                if reply[1] == 'error':
+                    sys.stderr.write('Warning: tunnel manager: %s\n' % output)
+                continue
+
+            self.replies[reply_id] = (reply[1], output)
+
+        return self.replies.pop(req_id)
+
+    def call(self, cmd):
+        return self.recv(self.send(cmd))
+
+
+def main():
+    manager = TunnelManager()
+
+    # register SIGINT and SIGTERM events to clean up gracefully before quit
+    def stop_signal_handler(signum, frame):
+        manager.kill_tunnels()
+
+        manager.exit('tunnel_manager: caught signal %s and cleaned up\n'
+                     % signum)
+
+    signal.signal(signal.SIGINT, stop_signal_handler)
+    signal.signal(signal.SIGTERM, stop_signal_handler)
+
+    manager.run()
 
 
 if __name__ == '__main__':
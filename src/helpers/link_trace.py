@@ -0,0 +1,226 @@
+import os
+from os import path
+import json
+import hashlib
+
+import numpy as np
+import yaml
+
+import context
+
+
+# mahimahi traces list the times in ms of delivery opportunities, each of
+# which delivers one MTU-sized packet; a trace repeats after its last line
+MTU = 1500  # bytes
+BYTES_PER_MS_PER_MBPS = 1e6 / 8 / 1000
+
+# Rate schedules are YAML or JSON segments in Mbit/s, or lists of segments
+# played one after another, e.g.
+#   {type: constant, rate: 12, duration: 1}
+#   {type: step, rates: [12, 24, 6], duration: 5}  (seconds per step)
+#   {type: ramp, from: 12, to: 48, duration: 10}
+#   {type: random-walk, start: 12, step: 2, min: 1, max: 48,
+#    interval: 0.1, duration: 30, seed: 0}
+SEGMENT_FIELDS = {
+    'constant': {'rate': None, 'duration': 1},
+    'step': {'rates': None, 'duration': None},
+    'ramp': {'from': None, 'to': None, 'duration': None},
+    'random-walk': {'start': None, 'step': None, 'min': None, 'max': None,
+                    'interval': 1, 'duration': None, 'seed': 0},
+}
+RATE_FIELDS = ['rate', 'rates', 'from', 'to', 'start', 'min', 'max']
+
+# compiled traces are cached by the hash of their normalized schedules
+TRACE_CACHE_DIR = path.join(context.base_dir, 'tmp', 'traces')
+
+# increase whenever compiled traces of the same schedule change
+TRACE_VERSION = 2
+
+
+def normalize_segment(segment):
+    if not isinstance(segment, dict) or segment.get('type') not in \
+            SEGMENT_FIELDS:
+        raise ValueError('segment type must be one of %s: %s' % (
+            ', '.join(sorted(SEGMENT_FIELDS)), segment))
+
+    fields = SEGMENT_FIELDS[segment['type']]
+    for key in segment:
+        if key != 'type' and key not in fields:
+            raise ValueError('unknown field %s in %s segment' %
+                             (key, segment['type']))
+
+    normalized = {'type': segment['type']}
+    for key, default in fields.iteritems():
+        value = segment.get(key, default)
+        if value is None:
+            raise ValueError('missing field %s in %s segment' %
+                             (key, segment['type']))
+
+        try:
+            if key == 'rates':
+                value = [float(rate) for rate in value]
+            elif key == 'seed':
+                value = int(value)
+            else:
+                value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError('invalid %s in %s segment: %s' %
+                             (key, segment['type'], value))
+        normalized[key] = value
+
+    if normalized['duration'] <= 0:
+        raise ValueError('duration of a segment must be positive')
+    for key in RATE_FIELDS:
+        rates = normalized.get(key, [])
+        if any([rate < 0 for rate in np.ravel(rates)]):
+            raise ValueError('%s in %s segment cannot be negative' %
+                             (key, segment['type']))
+    if normalized['type'] == 'step' and not normalized['rates']:
+        raise ValueError('rates of a step segment cannot be empty')
+    if (normalized['type'] == 'random-walk' and
+            normalized['min'] > normalized['max']):
+        raise ValueError('min of a random-walk segment exceeds its max')
+
+    return normalized
+
+
+def parse_schedule(schedule):
+    """
+    Return the normalized list of segments of schedule, which is a YAML or
+    JSON string, a segment or a list of segments. Raise ValueError if it is
+    invalid.
+    """
+    if isinstance(schedule, basestring):
+        try:
+            schedule = yaml.safe_load(schedule)
+        except yaml.YAMLError as exception:
+            raise ValueError('invalid rate schedule: %s' % exception)
+
+    if not isinstance(schedule, list):
+        schedule = [schedule]
+    if not schedule:
+        raise ValueError('rate schedule is empty')
+
+    return [normalize_segment(segment) for segment in schedule]
+
+
+def segment_rates(segment):
+    # rates in Mbit/s of every ms of a segment
+    num_ms = int(round(segment['duration'] * 1000))
+
+    if segment['type'] == 'constant':
+        return np.full(num_ms, segment['rate'])
+
+    if segment['type'] == 'step':
+        # steps fill the whole duration each
+        return np.repeat(segment['rates'], num_ms)
+
+    if segment['type'] == 'ramp':
+        return np.linspace(segment['from'], segment['to'], num_ms)
+
+    # random walk between min and max, reflected at the bounds
+    interval_ms = max(1, int(round(segment['interval'] * 1000)))
+    num_steps = -(-num_ms // interval_ms)
+
+    rng = np.random.RandomState(segment['seed'])
+    steps = rng.choice([-segment['step'], segment['step']], num_steps - 1)
+
+    low, high = segment['min'], segment['max']
+    rates = np.empty(num_steps)
+    rates[0] = min(max(segment['start'], low), high)
+    for i in xrange(1, num_steps):
+        rate = rates[i - 1] + steps[i - 1]
+        if rate < low or rate > high:
+            rate = rates[i - 1] - steps[i - 1]
+        rates[i] = min(max(rate, low), high)
+
+    return np.repeat(rates, interval_ms)[:num_ms]
+
+
+def schedule_rates(segments):
+    return np.concatenate([segment_rates(s) for s in segments])
+
+
+def delivery_opportunities(rates):
+    """
+    Return the times in ms of delivery opportunities that deliver rates[t]
+    Mbit/s during ms t + 1, carrying over fractions of packets.
+
+    A trace repeats after its last opportunity, so any time without
+    opportunities at the end of rates (e.g., a final outage) is moved to the
+    start of the trace, which keeps the period at len(rates) ms.
+    """
+    if np.any(rates < 0):
+        raise ValueError('rates cannot be negative')
+
+    packets = np.floor(np.cumsum(rates * BYTES_PER_MS_PER_MBPS) / MTU)
+    counts = np.diff(np.append(0, packets)).astype(np.int64)
+
+    timestamps = np.repeat(np.arange(1, len(rates) + 1), counts)
+    if len(timestamps) == 0:
+        raise ValueError('rate schedule has no delivery opportunities')
+
+    return timestamps + (len(rates) - timestamps[-1])
+
+
+def write_trace(timestamps, trace_path):
+    with open(trace_path, 'w') as trace:
+        trace.write('\n'.join(map(str, timestamps.tolist())) + '\n')
+
+
+def read_trace(trace_path):
+    timestamps = np.loadtxt(trace_path, dtype=np.int64, ndmin=1)
+    if len(timestamps) == 0 or timestamps[-1] <= 0:
+        raise ValueError('invalid trace %s' % trace_path)
+
+    return timestamps
+
+
+def opportunities_per_ms(timestamps, end_ms):
+    """
+    Return the number of delivery opportunities in each ms from 0 to end_ms
+    of a link that replays the trace timestamps (see read_trace), repeating
+    it every timestamps[-1] ms as mm-link does.
+    """
+    period = int(timestamps[-1])
+    per_period = np.bincount(timestamps, minlength=period + 1)
+
+    counts = np.zeros(max(0, int(end_ms)) + 1, dtype=np.int64)
+    counts[0] = per_period[0]
+    counts[1:] = per_period[(np.arange(len(counts) - 1) % period) + 1]
+    # opportunities at 0 ms of repetitions coincide with the last ones
+    counts[period::period] += per_period[0]
+
+    return counts
+
+
+def schedule_key(segments):
+    canonical = json.dumps([TRACE_VERSION, segments], sort_keys=True)
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def compile_trace(schedule, cache_dir=TRACE_CACHE_DIR):
+    """
+    Compile the rate schedule (see parse_schedule) into a mahimahi trace and
+    return its path. Traces are cached in cache_dir by the content of their
+    normalized schedules, so each one is generated only once.
+    """
+    segments = parse_schedule(schedule)
+
+    trace_path = path.join(cache_dir, schedule_key(segments) + '.trace')
+    if path.isfile(trace_path):
+        return trace_path
+
+    if not path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not path.isdir(cache_dir):
+                raise
+
+    # write to a temporary file first as other tests may compile it too
+    tmp_path = '%s.%d' % (trace_path, os.getpid())
+    write_trace(delivery_opportunities(schedule_rates(segments)), tmp_path)
+    os.rename(tmp_path, trace_path)
+
+    return trace_path
@@ -0,0 +1,282 @@
+import math
+import numpy as np
+
+
+class CountStore(object):
+    """
+    Counts indexed by integer keys, stored densely between the smallest and
+    the largest key seen so far.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def keys(self):
+        return np.arange(self.offset, self.offset + len(self.counts))
+
+    def extend(self, min_key, max_key):
+        if len(self.counts) == 0:
+            self.offset = min_key
+            self.counts = np.zeros(max_key - min_key + 1, dtype=np.int64)
+            return
+
+        new_offset = min(min_key, self.offset)
+        new_end = max(max_key + 1, self.offset + len(self.counts))
+        if new_offset == self.offset and new_end == self.offset + len(self):
+            return
+
+        counts = np.zeros(new_end - new_offset, dtype=np.int64)
+        start = self.offset - new_offset
+        counts[start:start + len(self.counts)] = self.counts
+        self.offset = new_offset
+        self.counts = counts
+
+    def add(self, keys, weights=None):
+        if len(keys) == 0:
+            return
+
+        min_key = int(keys.min())
+        max_key = int(keys.max())
+        self.extend(min_key, max_key)
+
+        # weights are integers, so their float64 sums are exact
+        counts = np.bincount(keys - min_key, weights=weights)
+        start = min_key - self.offset
+        self.counts[start:start + len(counts)] += counts.astype(np.int64)
+
+    def merge(self, other):
+        if len(other) == 0:
+            return
+
+        self.extend(other.offset, other.offset + len(other) - 1)
+        start = other.offset - self.offset
+        self.counts[start:start + len(other)] += other.counts
+
+    def key_at_rank(self, rank):
+        # the key of the (rank + 1)-th smallest counted item
+        cumsum = np.cumsum(self.counts)
+        return self.offset + int(np.searchsorted(cumsum, rank, side='right'))
+
+
+class SparseCountStore(object):
+    """
+    Counts indexed by integer keys, storing only the keys seen so far in
+    ascending order.
+    """
+
+    def __init__(self):
+        self.sorted_keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.sorted_keys)
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def add_counts(self, keys, counts):
+        all_keys = np.append(self.sorted_keys, keys)
+        all_counts = np.append(self.counts, counts)
+
+        # counts are integers, so their float64 sums are exact
+        self.sorted_keys, inverse = np.unique(all_keys, return_inverse=True)
+        self.counts = np.bincount(inverse,
+                                  weights=all_counts).astype(np.int64)
+
+    def add(self, keys):
+        if len(keys) == 0:
+            return
+
+        keys, counts = np.unique(keys, return_counts=True)
+        self.add_counts(keys, counts)
+
+    def merge(self, other):
+        if len(other) == 0:
+            return
+
+        self.add_counts(other.sorted_keys, other.counts)
+
+    def key_at_rank(self, rank):
+        # the key of the (rank + 1)-th smallest counted item
+        cumsum = np.cumsum(self.counts)
+        return int(self.sorted_keys[np.searchsorted(cumsum, rank,
+                                                    side='right')])
+
+
+def nearest_rank(q, count):
+    # same rank as np.percentile(..., interpolation='nearest')
+    return int(np.around(q / 100.0 * (count - 1)))
+
+
+class Samples(object):
+    """Keep every value to compute quantiles exactly with np.percentile."""
+
+    def __init__(self):
+        self.chunks = []
+        self.count = 0
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+
+        self.chunks.append(values)
+        self.count += len(values)
+
+    def merge(self, other):
+        self.chunks += other.chunks
+        self.count += other.count
+
+    def values(self):
+        if not self.chunks:
+            return np.empty(0)
+
+        if len(self.chunks) > 1:
+            self.chunks = [np.concatenate(self.chunks)]
+        return self.chunks[0]
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        return np.percentile(self.values(), q, interpolation='nearest')
+
+
+class ExactHistogram(object):
+    """
+    Histogram of values rounded to a fixed resolution.
+
+    Quantiles are exact for values that have no more precision than the
+    resolution, e.g. delays written as '%.3f' ms in tunnel logs with the
+    default resolution of 0.001 ms. Bins are stored sparsely, so memory
+    only grows with the number of distinct rounded values, which is at most
+    the range of values divided by the resolution.
+    """
+
+    def __init__(self, resolution=0.001):
+        self.scale = int(round(1.0 / resolution))
+        self.store = SparseCountStore()
+        self.count = 0
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+
+        self.store.add(np.rint(values * self.scale).astype(np.int64))
+        self.count += len(values)
+
+    def merge(self, other):
+        self.store.merge(other.store)
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        key = self.store.key_at_rank(nearest_rank(q, self.count))
+        return key / float(self.scale)
+
+
+class LogSketch(object):
+    """
+    Quantile sketch with a bounded relative error.
+
+    Values are counted in buckets whose boundaries grow geometrically by
+    gamma = (1 + error) / (1 - error), so that any value in a bucket is
+    within `error` (relative) of the bucket's representative value.
+    Negative values are counted by their magnitude in a separate store and
+    values smaller than `min_value` in magnitude are counted as zeros.
+    """
+
+    def __init__(self, error=0.01, min_value=0.001):
+        if not 0 < error < 1:
+            raise ValueError('relative error must be in (0, 1)')
+
+        self.error = error
+        self.gamma = (1.0 + error) / (1.0 - error)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+
+        self.positive = CountStore()
+        self.negative = CountStore()
+        self.zeros = 0
+        self.count = 0
+
+    def bucket_keys(self, magnitudes):
+        return np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64)
+
+    def bucket_value(self, key):
+        return 2.0 * math.pow(self.gamma, key) / (self.gamma + 1.0)
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+
+        positive = values[values >= self.min_value]
+        negative = -values[values <= -self.min_value]
+
+        self.positive.add(self.bucket_keys(positive))
+        self.negative.add(self.bucket_keys(negative))
+        self.zeros += len(values) - len(positive) - len(negative)
+        self.count += len(values)
+
+    def merge(self, other):
+        if (other.gamma, other.min_value) != (self.gamma, self.min_value):
+            raise ValueError('cannot merge sketches with different settings')
+
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        rank = nearest_rank(q, self.count)
+
+        # negative values in ascending order have descending magnitudes
+        num_negative = self.negative.total()
+        if rank < num_negative:
+            key = self.negative.key_at_rank(num_negative - 1 - rank)
+            return -self.bucket_value(key)
+
+        rank -= num_negative
+        if rank < self.zeros:
+            return 0.0
+
+        rank -= self.zeros
+        return self.bucket_value(self.positive.key_at_rank(rank))
+
+
+class DecimatedSeries(object):
+    """
+    Keep a deterministic subset of at most max_points (t, value) points by
+    retaining every stride-th point, doubling stride whenever full.
+    """
+
+    def __init__(self, max_points=100000):
+        self.max_points = max_points
+        self.stride = 1
+        self.seen = 0
+        self.t = np.empty(0)
+        self.values = np.empty(0)
+
+    def add(self, t, values):
+        index = np.arange(self.seen, self.seen + len(values))
+        self.seen += len(values)
+
+        keep = index % self.stride == 0
+        self.t = np.append(self.t, t[keep])
+        self.values = np.append(self.values, values[keep])
+
+        while len(self.t) > self.max_points:
+            self.t = self.t[::2]
+            self.values = self.values[::2]
+            self.stride *= 2
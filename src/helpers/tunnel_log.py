@@ -0,0 +1,410 @@
+import re
+import mmap
+import struct
+import itertools
+from os import path
+from collections import namedtuple
+
+import numpy as np
+
+
+# event types of a tunnel log, stored as small integer codes
+OPPORTUNITY = 0  # '#': delivery opportunity of the emulated link
+ARRIVAL = 1  # '+': packet entering the tunnel
+DEPARTURE = 2  # '-': packet leaving the tunnel
+
+EVENT_SYMBOLS = {'#': OPPORTUNITY, '+': ARRIVAL, '-': DEPARTURE}
+
+# columns of a tunnel log
+#   init_ts: value of "# init timestamp" in ms (None if absent)
+#   ts: event timestamp in ms relative to init_ts (float64)
+#   event: OPPORTUNITY, ARRIVAL or DEPARTURE (uint8)
+#   size: packet or opportunity size in bytes (int64)
+#   delay: one-way delay in ms of departures, NaN otherwise (float64)
+#   flow: flow ID, 0 if the log does not contain flow IDs (int64)
+TunnelLog = namedtuple('TunnelLog',
+                       ['init_ts', 'ts', 'event', 'size', 'delay', 'flow'])
+
+# number of bytes to parse at a time when iterating over a tunnel log
+CHUNK_SIZE = 32 * 1024 * 1024
+
+comment_line_re = re.compile(r'^#[^\n]*\n?', re.M)
+init_ts_re = re.compile(r'^# init timestamp: *(\S+)', re.M)
+
+# text logs merged with --link-trace name the mahimahi trace of the link and
+# the time in ms after init_ts at which the link started, instead of
+# containing delivery opportunities
+link_trace_re = re.compile(r'^# link trace: *(\S+)', re.M)
+link_offset_re = re.compile(r'^# link offset: *(\S+)', re.M)
+
+# placeholders of event symbols that never appear as numbers in a log
+event_placeholders = [('#', 'inf'), ('+', 'nan'), ('-', '-inf')]
+
+# Binary tunnel logs start with a fixed-size header:
+#   magic (8 bytes), init timestamp in ms (float64, NaN if absent),
+#   number of flows (uint32) and 4 bytes of padding,
+# followed by fixed-width little-endian records. Timestamps and delays are
+# stored as integers in microseconds, i.e., the 0.001 ms resolution of
+# text logs, so converting between the two formats is lossless.
+BINARY_MAGIC = '\x93PTLOG1\n'
+BINARY_HEADER = struct.Struct('<8sdI4x')
+RECORD_DTYPE = np.dtype([('ts', '<i8'), ('delay', '<i4'), ('size', '<u4'),
+                         ('flow', '<u2'), ('event', 'u1')])
+
+
+def empty_columns():
+    return (np.empty(0, dtype=np.float64), np.empty(0, dtype=np.uint8),
+            np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+            np.empty(0, dtype=np.int64))
+
+
+def parse_init_ts(text):
+    match = init_ts_re.search(text)
+    if match is None:
+        return None
+
+    return float(match.group(1))
+
+
+def read_link_trace(log_path):
+    """
+    Return (trace_path, offset_ms) of the link named in the header of a text
+    tunnel log, or None if the log does not name a link trace.
+    """
+    if is_binary(log_path):
+        return None
+
+    header = ''
+    with open(log_path) as log:
+        for line in log:
+            if not line.startswith('#'):
+                break
+            header += line
+
+    match = link_trace_re.search(header)
+    if match is None:
+        return None
+
+    offset = link_offset_re.search(header)
+    return match.group(1), float(offset.group(1)) if offset else 0.0
+
+
+def parse_events(text):
+    """
+    Parse the event lines in `text` into the columns
+    (ts, event, size, delay, flow) of a tunnel log.
+
+    Event symbols are replaced with non-finite placeholders so that the
+    whole text is parsed by NumPy into one flat array of numbers. The
+    placeholders then give the start of every line (one value before the
+    symbol) and the number of values on each line, from which all columns
+    are gathered at once.
+    """
+    text = comment_line_re.sub('', text)
+    for symbol, placeholder in event_placeholders:
+        text = text.replace(' %s ' % symbol, ' %s ' % placeholder)
+
+    values = np.fromstring(text, sep=' ')
+    if len(values) == 0:
+        return empty_columns()
+
+    opportunity = np.isposinf(values)
+    arrival = np.isnan(values)
+    departure = np.isneginf(values)
+
+    event_pos = np.flatnonzero(opportunity | arrival | departure)
+    line_start = event_pos - 1
+    line_len = np.diff(np.append(line_start, len(values)))
+
+    event = np.empty(len(event_pos), dtype=np.uint8)
+    event[opportunity[event_pos]] = OPPORTUNITY
+    event[arrival[event_pos]] = ARRIVAL
+    event[departure[event_pos]] = DEPARTURE
+
+    ts = values[line_start]
+    size = values[line_start + 2].astype(np.int64)
+
+    is_departure = event == DEPARTURE
+    delay = np.full(len(event), np.nan)
+    delay[is_departure] = values[line_start[is_departure] + 3]
+
+    # flow IDs are appended as the last column by merge_tunnel_logs.py
+    has_flow = (((event == ARRIVAL) & (line_len == 4)) |
+                (is_departure & (line_len == 5)))
+    flow = np.zeros(len(event), dtype=np.int64)
+    flow[has_flow] = values[line_start[has_flow] + line_len[has_flow] - 1]
+
+    return ts, event, size, delay, flow
+
+
+def map_file(log_path):
+    # return a read-only memory map of the file at log_path, or None if it
+    # cannot be mapped (e.g., it is empty or not a regular file)
+    with open(log_path, 'rb') as log:
+        try:
+            return mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError, mmap.error):
+            return None
+
+
+def can_map(log_path):
+    mapped = map_file(log_path)
+    if mapped is None:
+        return False
+
+    mapped.close()
+    return True
+
+
+def map_text_chunks(mapped, chunk_size):
+    # slice chunks of complete lines out of the memory map, which shares the
+    # pages of the file with other processes reading it; this is not
+    # zero-copy, as each chunk is copied into a string (at most chunk_size
+    # bytes at a time) for parse_events() to rewrite event symbols
+    init_ts = None
+    start = 0
+
+    try:
+        while start < len(mapped):
+            end = mapped.rfind('\n', start, start + chunk_size) + 1
+            if end <= start:  # no complete line within chunk_size bytes
+                end = mapped.find('\n', start) + 1 or len(mapped)
+
+            text = mapped[start:end]
+            start = end
+
+            if init_ts is None:
+                init_ts = parse_init_ts(text)
+
+            yield TunnelLog(init_ts, *parse_events(text))
+    finally:
+        mapped.close()
+
+
+def read_text_chunks(log_path, chunk_size):
+    init_ts = None
+    remainder = ''
+
+    with open(log_path) as log:
+        while True:
+            block = log.read(chunk_size)
+            if not block:
+                break
+
+            text = remainder + block
+            end = text.rfind('\n') + 1
+            text, remainder = text[:end], text[end:]
+
+            if init_ts is None:
+                init_ts = parse_init_ts(text)
+
+            yield TunnelLog(init_ts, *parse_events(text))
+
+    if remainder:
+        if init_ts is None:
+            init_ts = parse_init_ts(remainder)
+        yield TunnelLog(init_ts, *parse_events(remainder))
+
+
+def iter_text_chunks(log_path, chunk_size=CHUNK_SIZE):
+    mapped = map_file(log_path)
+    if mapped is None:
+        # fall back to reading the file in blocks
+        return read_text_chunks(log_path, chunk_size)
+
+    return map_text_chunks(mapped, chunk_size)
+
+
+def concatenate(chunks):
+    init_ts = None
+    columns = [[] for _ in xrange(len(TunnelLog._fields) - 1)]
+
+    for chunk in chunks:
+        init_ts = chunk.init_ts
+        for i, column in enumerate(chunk[1:]):
+            columns[i].append(column)
+
+    if not columns[0]:
+        return TunnelLog(init_ts, *empty_columns())
+
+    return TunnelLog(init_ts, *[np.concatenate(c) for c in columns])
+
+
+def load_text(log_path):
+    return concatenate(iter_text_chunks(log_path))
+
+
+def is_binary(log_path):
+    with open(log_path, 'rb') as log:
+        return log.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def read_binary_header(log_path):
+    with open(log_path, 'rb') as log:
+        header = log.read(BINARY_HEADER.size)
+
+    if len(header) < BINARY_HEADER.size:
+        raise ValueError('%s: truncated binary tunnel log header' % log_path)
+
+    magic, init_ts, num_flows = BINARY_HEADER.unpack(header)
+    if magic != BINARY_MAGIC:
+        raise ValueError('%s is not a binary tunnel log' % log_path)
+
+    if np.isnan(init_ts):
+        init_ts = None
+
+    return init_ts, num_flows
+
+
+def map_records(log_path):
+    # map records into memory without reading them
+    num_bytes = path.getsize(log_path) - BINARY_HEADER.size
+    num_records = num_bytes // RECORD_DTYPE.itemsize
+    if num_records == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+
+    return np.memmap(log_path, dtype=RECORD_DTYPE, mode='r',
+                     offset=BINARY_HEADER.size, shape=(num_records,))
+
+
+def records_to_columns(init_ts, records):
+    event = np.array(records['event'])
+
+    delay = np.full(len(records), np.nan)
+    is_departure = event == DEPARTURE
+    delay[is_departure] = records['delay'][is_departure] / 1000.0
+
+    return TunnelLog(init_ts, records['ts'] / 1000.0, event,
+                     records['size'].astype(np.int64), delay,
+                     records['flow'].astype(np.int64))
+
+
+def load_binary(log_path):
+    init_ts, _ = read_binary_header(log_path)
+    return records_to_columns(init_ts, map_records(log_path))
+
+
+def iter_binary_chunks(log_path, chunk_size=CHUNK_SIZE):
+    init_ts, _ = read_binary_header(log_path)
+    records = map_records(log_path)
+
+    step = max(1, chunk_size // RECORD_DTYPE.itemsize)
+    for start in xrange(0, len(records), step):
+        yield records_to_columns(init_ts, records[start:start + step])
+
+
+def load(log_path):
+    if is_binary(log_path):
+        return load_binary(log_path)
+
+    return load_text(log_path)
+
+
+def iter_chunks(log_path, chunk_size=CHUNK_SIZE):
+    """
+    Yield the text or binary tunnel log at log_path as TunnelLog columns of
+    consecutive chunks, processing about chunk_size bytes at a time.
+    """
+    if is_binary(log_path):
+        return iter_binary_chunks(log_path, chunk_size)
+
+    return iter_text_chunks(log_path, chunk_size)
+
+
+class BinaryWriter(object):
+    """
+    Write events to a binary tunnel log, buffering them in memory. The
+    number of flows in the header is updated to the largest flow ID written
+    when the log is closed.
+    """
+
+    def __init__(self, log_path, init_ts, num_flows=0, buffer_size=65536):
+        self.log = open(log_path, 'wb')
+        self.init_ts = float('nan') if init_ts is None else init_ts
+        self.num_flows = num_flows
+        self.write_header()
+
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write_header(self):
+        self.log.write(BINARY_HEADER.pack(
+            BINARY_MAGIC, self.init_ts, self.num_flows))
+
+    def write_event(self, ts, event, size, delay=0.0, flow=0):
+        self.buffer.append((int(round(ts * 1000)), int(round(delay * 1000)),
+                            size, flow, event))
+        if flow > self.num_flows:
+            self.num_flows = flow
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_columns(self, columns):
+        self.flush()
+
+        records = np.empty(len(columns.ts), dtype=RECORD_DTYPE)
+        records['ts'] = np.rint(columns.ts * 1000)
+        records['delay'] = np.rint(np.nan_to_num(columns.delay) * 1000)
+        records['size'] = columns.size
+        records['flow'] = columns.flow
+        records['event'] = columns.event
+        records.tofile(self.log)
+
+        if len(columns.flow):
+            self.num_flows = max(self.num_flows, int(columns.flow.max()))
+
+    def flush(self):
+        if self.buffer:
+            np.array(self.buffer, dtype=RECORD_DTYPE).tofile(self.log)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.log.seek(0)
+        self.write_header()
+        self.log.close()
+
+
+def format_text_lines(columns):
+    # format events the same way as merge_tunnel_logs.py does
+    lines = []
+    for ts, event, size, delay, flow in itertools.izip(
+            columns.ts.tolist(), columns.event.tolist(),
+            columns.size.tolist(), columns.delay.tolist(),
+            columns.flow.tolist()):
+        if event == OPPORTUNITY:
+            line = '%.3f # %d' % (ts, size)
+        elif event == ARRIVAL:
+            line = '%.3f + %d' % (ts, size)
+        else:
+            line = '%.3f - %d %.3f' % (ts, size, delay)
+
+        if flow and event != OPPORTUNITY:
+            line += ' %d' % flow
+        lines.append(line + '\n')
+
+    return ''.join(lines)
+
+
+def convert_to_binary(text_path, binary_path):
+    writer = None
+    for columns in iter_text_chunks(text_path):
+        if writer is None:
+            writer = BinaryWriter(binary_path, columns.init_ts)
+        writer.write_columns(columns)
+
+    if writer is None:  # empty text log
+        writer = BinaryWriter(binary_path, None)
+    writer.close()
+
+
+def convert_to_text(binary_path, text_path):
+    init_ts, _ = read_binary_header(binary_path)
+
+    with open(text_path, 'w') as text_log:
+        if init_ts is not None:
+            text_log.write('# init timestamp: %.3f\n' % init_ts)
+
+        for columns in iter_binary_chunks(binary_path):
+            text_log.write(format_text_lines(columns))
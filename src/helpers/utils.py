@@ -1,19 +1,26 @@
 import os
 from os import path
 import sys
+import time
 import socket
 import signal
 import errno
+import fcntl
 import itertools
 import json
 import random
+import pipes
 import yaml
 import subprocess
+import ctypes
+import ctypes.util
+import hashlib
+import tempfile
 from collections import OrderedDict
 from datetime import datetime
 
 import context
-from subprocess_wrappers import check_call, check_output, call
+from subprocess_wrappers import Popen, check_call, check_output, call
 
 
 def get_open_port():
@@ -149,6 +156,54 @@ def utc_time():
     return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
 
 
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+CLOCK_MONOTONIC = 1
+
+try:
+    clock_gettime = ctypes.CDLL(ctypes.util.find_library('c')).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+except (OSError, AttributeError):
+    clock_gettime = None
+
+
+def monotonic_time():
+    # seconds on a clock that is not affected by changes of the system time
+    # (e.g., by NTP), as Python 2 has no time.monotonic()
+    if clock_gettime is None:
+        return time.time()
+
+    ts = timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        return time.time()
+
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+def sleep_until(deadline):
+    # deadline is in seconds of monotonic_time()
+    remaining = deadline - monotonic_time()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def wait_for_procs(procs, timeout, interval=0.05):
+    # wait until all procs exit without using signals, which only work in
+    # the main thread; return False if timeout expires first
+    deadline = monotonic_time() + timeout
+
+    while any([proc.poll() is None for proc in procs]):
+        remaining = deadline - monotonic_time()
+        if remaining <= 0:
+            return False
+
+        time.sleep(min(interval, remaining))
+
+    return True
+
+
 def kill_proc_group(proc, signum=signal.SIGTERM):
     if not proc:
         return
@@ -161,6 +216,117 @@ def kill_proc_group(proc, signum=signal.SIGTERM):
         sys.stderr.write('kill_proc_group: %s\n' % exception)
 
 
+def get_descendant_pids(pid):
+    # pid and the pids of all its descendants, found in /proc
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open('/proc/%s/stat' % entry) as stat:
+                # the command name in parentheses may contain spaces
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        pids += children.get(pids[i], [])
+        i += 1
+
+    return pids
+
+
+def kill_proc_tree(proc, signum=signal.SIGTERM, timeout=5):
+    # kill proc and all its descendants without killing its process group,
+    # which may be shared with the caller, and wait for proc to exit
+    if not proc:
+        return
+
+    pids = get_descendant_pids(proc.pid)
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    deadline = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() > deadline:
+            sys.stderr.write('kill_proc_tree: process %s did not exit => '
+                             'sending SIGKILL\n' % proc.pid)
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            proc.wait()
+            break
+
+        time.sleep(0.01)
+
+
+def is_port_bound(pid, port):
+    # check if a TCP socket is listening on, or a UDP socket is bound to,
+    # port in the network namespace of pid
+    for table in ['tcp', 'tcp6', 'udp', 'udp6']:
+        try:
+            with open('/proc/%s/net/%s' % (pid, table)) as sockets:
+                sockets.readline()  # skip the header
+                for line in sockets:
+                    items = line.split()
+                    local_port = int(items[1].rsplit(':', 1)[1], 16)
+                    if local_port != port:
+                        continue
+
+                    # 0A: TCP_LISTEN, 07: TCP_CLOSE (unconnected UDP)
+                    if items[3] == '0A' or table.startswith('udp'):
+                        return True
+        except (IOError, IndexError, ValueError):
+            continue
+
+    return False
+
+
+def wait_for_port(pid, port, timeout, interval=0.01):
+    """
+    Wait until a process in the network namespace of pid or of any of its
+    descendants listens on port, for at most timeout seconds. Returns True
+    if the port is ready or False on timeout.
+    """
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            pids = get_descendant_pids(pid)
+        except OSError:
+            pids = [pid]
+
+        # check each network namespace once
+        namespaces = set()
+        for p in pids:
+            try:
+                namespace = os.readlink('/proc/%s/ns/net' % p)
+            except OSError:
+                namespace = p
+
+            if namespace in namespaces:
+                continue
+            namespaces.add(namespace)
+
+            if is_port_bound(p, port):
+                return True
+
+        if time.time() >= deadline:
+            return False
+
+        time.sleep(interval)
+
+
 def apply_patch(patch_name, repo_dir):
     patch = path.join(context.src_dir, 'wrappers', 'patches', patch_name)
 
@@ -174,8 +340,10 @@ def load_test_metadata(metadata_path):
         return json.load(metadata)
 
 
-def verify_schemes_with_meta(schemes, meta):
-    schemes_config = parse_config()['schemes']
+def verify_schemes_with_meta(schemes, meta, config=None):
+    if config is None:
+        config = parse_config()
+    schemes_config = config['schemes']
 
     all_schemes = meta['cc_schemes']
     if schemes is None:
@@ -209,6 +377,35 @@ def who_runs_first(cc):
     return run_first, run_second
 
 
+# All ssh and scp commands to the same remote host share one connection,
+# which is kept open for a while after the last command exits
+ssh_host_opts = {}  # host_addr -> ssh options
+
+
+def ssh_opts(host_addr):
+    if host_addr in ssh_host_opts:
+        return ssh_host_opts[host_addr]
+
+    # the socket path must be short (about 100 characters at most), and
+    # OpenSSH before 6.7 cannot expand %C to a hash of the connection
+    key = '%d %s %s' % (os.getuid(), tmp_dir, host_addr)
+    control_path = path.join(tempfile.gettempdir(), 'pantheon-ssh-%s'
+                             % hashlib.sha1(key).hexdigest()[:12])
+    opts = ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=' + control_path,
+            '-o', 'ControlPersist=60']
+
+    # start the shared connection, or do without it if it fails to start
+    if call(['ssh', '-n'] + opts + [host_addr, 'true']) != 0:
+        sys.stderr.write('Warning: failed to start a shared ssh connection '
+                         'to %s, running ssh without ControlMaster\n'
+                         % host_addr)
+        opts = []
+
+    ssh_host_opts[host_addr] = opts
+    return opts
+
+
 def parse_remote_path(remote_path, cc=None):
     ret = {}
 
@@ -216,7 +413,8 @@ def parse_remote_path(remote_path, cc=None):
     ret['src_dir'] = path.join(ret['base_dir'], 'src')
     ret['tmp_dir'] = path.join(ret['base_dir'], 'tmp')
     ret['ip'] = ret['host_addr'].split('@')[-1]
-    ret['ssh_cmd'] = ['ssh', ret['host_addr']]
+    ret['ssh_cmd'] = ['ssh'] + ssh_opts(ret['host_addr']) + [
+        ret['host_addr']]
     ret['tunnel_manager'] = path.join(
         ret['src_dir'], 'experiments', 'tunnel_manager.py')
 
@@ -226,6 +424,35 @@ def parse_remote_path(remote_path, cc=None):
     return ret
 
 
+def download_files(r, remote_paths, local_dir):
+    """
+    Download remote_paths on the remote host r (see parse_remote_path) into
+    local_dir through a single compressed tar stream over the shared ssh
+    connection. Return the local paths of the downloaded files.
+    """
+    local_paths = []
+    remote_dirs = OrderedDict()
+    for remote_path in remote_paths:
+        remote_dir, name = path.split(remote_path)
+        remote_dirs.setdefault(remote_dir, []).append(name)
+        local_paths.append(path.join(local_dir, name))
+
+    for remote_dir, names in remote_dirs.iteritems():
+        tar_cmd = 'tar -C %s -czf - %s' % (
+            pipes.quote(remote_dir), ' '.join(map(pipes.quote, names)))
+
+        ssh = Popen(r['ssh_cmd'] + [tar_cmd], stdout=subprocess.PIPE)
+        tar = Popen(['tar', '-C', local_dir, '-xzf', '-'], stdin=ssh.stdout)
+        ssh.stdout.close()  # tar gets SIGPIPE if ssh exits
+
+        if tar.wait() != 0 or ssh.wait() != 0:
+            sys.stderr.write('Warning: failed to download some of %s from '
+                             '%s:%s\n' % (', '.join(names), r['host_addr'],
+                                          remote_dir))
+
+    return local_paths
+
+
 def query_clock_offset(ntp_addr, ssh_cmd):
     local_clock_offset = None
     remote_clock_offset = None
@@ -277,7 +504,7 @@ def get_git_summary(mode='local', remote_path=None):
         git_summary_src = path.join(
             r['src_dir'], 'experiments', 'git_summary.sh')
         ssh_cmd = 'cd %s; %s' % (r['base_dir'], git_summary_src)
-        ssh_cmd = ' '.join(r['ssh_cmd']) + ' "%s"' % ssh_cmd
+        ssh_cmd = ' '.join(map(pipes.quote, r['ssh_cmd'])) + ' "%s"' % ssh_cmd
 
         remote_git_summary = check_output(ssh_cmd, shell=True)
 
@@ -291,7 +518,23 @@ def get_git_summary(mode='local', remote_path=None):
     return local_git_summary
 
 
-def save_test_metadata(meta, metadata_path):
+def merge_test_metadata(old_meta, meta):
+    # metadata of a resumed sweep: options of the last invocation, and the
+    # schemes and records of runs (e.g., flow_starts) of all invocations
+    merged = dict(old_meta)
+    for key, value in meta.iteritems():
+        if key == 'cc_schemes' and key in old_meta:
+            merged[key] = sorted(set(old_meta[key]) | set(value))
+        elif isinstance(value, dict) and isinstance(old_meta.get(key), dict):
+            merged[key] = dict(old_meta[key])
+            merged[key].update(value)
+        else:
+            merged[key] = value
+
+    return merged
+
+
+def save_test_metadata(meta, metadata_path, merge=False):
     meta.pop('all')
     meta.pop('schemes')
     meta.pop('data_dir')
@@ -307,11 +550,35 @@ def save_test_metadata(meta, metadata_path):
     if 'downlink_trace' in meta:
         meta['downlink_trace'] = path.basename(meta['downlink_trace'])
 
+    if merge and path.isfile(metadata_path):
+        meta = merge_test_metadata(load_test_metadata(metadata_path), meta)
+
     with open(metadata_path, 'w') as metadata_fh:
         json.dump(meta, metadata_fh, sort_keys=True, indent=4,
                   separators=(',', ': '))
 
 
+def update_test_metadata(metadata_path, update):
+    """
+    Call update(meta) to modify the metadata saved at metadata_path in place,
+    holding an exclusive lock on the file so that tests running concurrently
+    can update it safely.
+    """
+    with open(metadata_path, 'r+') as metadata_fh:
+        fcntl.flock(metadata_fh, fcntl.LOCK_EX)
+        try:
+            meta = json.load(metadata_fh)
+            update(meta)
+
+            metadata_fh.seek(0)
+            metadata_fh.truncate()
+            json.dump(meta, metadata_fh, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+            metadata_fh.flush()
+        finally:
+            fcntl.flock(metadata_fh, fcntl.LOCK_UN)
+
+
 def get_sys_info():
     sys_info = ''
     sys_info += check_output(['uname', '-sr'])
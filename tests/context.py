@@ -4,3 +4,5 @@ import sys
 base_dir = path.abspath(path.join(path.dirname(__file__), os.pardir))
 src_dir = path.join(base_dir, 'src')
 sys.path.append(src_dir)
+experiments_dir = path.join(src_dir, 'experiments')
+sys.path.append(experiments_dir)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import context
+from helpers import link_trace
+
+
+def compile_rates(schedule):
+    segments = link_trace.parse_schedule(schedule)
+    return link_trace.delivery_opportunities(
+        link_trace.schedule_rates(segments))
+
+
+class TestParseSchedule(unittest.TestCase):
+    def test_defaults(self):
+        segments = link_trace.parse_schedule(
+            '[{type: constant, rate: 12}, '
+            '{type: step, rates: [1, 2], duration: 0.5}]')
+
+        self.assertEqual(segments, [
+            {'type': 'constant', 'rate': 12.0, 'duration': 1.0},
+            {'type': 'step', 'rates': [1.0, 2.0], 'duration': 0.5}])
+
+    def test_invalid(self):
+        for schedule in [
+                '[]', '{type: square, rate: 1}', '{type: constant}',
+                '{type: constant, rate: 1, extra: 2}',
+                '{type: constant, rate: x}',
+                '{type: constant, rate: 1, duration: 0}',
+                '{type: constant, rate: -5}',
+                '{type: step, rates: [1, -2], duration: 1}',
+                '{type: ramp, from: 1, to: -1, duration: 1}',
+                '{type: random-walk, start: 1, step: 1, min: 3, max: 2, '
+                'duration: 1}',
+                '{type: constant, rate: [1}']:
+            with self.assertRaises(ValueError):
+                link_trace.parse_schedule(schedule)
+
+
+class TestDeliveryOpportunities(unittest.TestCase):
+    def test_constant_rate(self):
+        # 12 Mbit/s is exactly one MTU-sized packet per ms
+        timestamps = compile_rates('{type: constant, rate: 12}')
+        self.assertTrue(np.array_equal(timestamps, np.arange(1, 1001)))
+
+    def test_fractions_carry_over(self):
+        # 6 Mbit/s delivers a packet every other ms
+        timestamps = compile_rates('{type: constant, rate: 6, duration: 0.01}')
+        self.assertTrue(np.array_equal(timestamps, [2, 4, 6, 8, 10]))
+
+    def test_trailing_outage(self):
+        timestamps = compile_rates(
+            '[{type: constant, rate: 12}, {type: constant, rate: 0}]')
+
+        # the outage moves to the start so that the period stays 2000 ms
+        self.assertEqual(timestamps[-1], 2000)
+        self.assertTrue(np.array_equal(timestamps, np.arange(1001, 2001)))
+
+    def test_no_opportunities(self):
+        with self.assertRaises(ValueError):
+            compile_rates('{type: constant, rate: 0}')
+
+    def test_random_walk_bounds(self):
+        segments = link_trace.parse_schedule(
+            '{type: random-walk, start: 5, step: 3, min: 1, max: 10, '
+            'interval: 0.01, duration: 5, seed: 1}')
+        rates = link_trace.schedule_rates(segments)
+
+        self.assertEqual(len(rates), 5000)
+        self.assertTrue(np.all((rates >= 1) & (rates <= 10)))
+        self.assertTrue(np.array_equal(
+            rates, link_trace.schedule_rates(segments)))
+
+
+class TestOpportunitiesPerMs(unittest.TestCase):
+    def test_repeats_trace(self):
+        timestamps = np.array([0, 1, 1, 3])
+        counts = link_trace.opportunities_per_ms(timestamps, 7)
+
+        # the opportunity at 0 ms of each repetition coincides with the last
+        # one of the previous repetition
+        self.assertEqual(counts.tolist(), [1, 2, 0, 2, 2, 0, 2, 2])
+
+    def test_total(self):
+        timestamps = compile_rates(
+            '{type: ramp, from: 0, to: 24, duration: 1}')
+        counts = link_trace.opportunities_per_ms(timestamps, 3000)
+
+        self.assertEqual(counts.sum(), 3 * len(timestamps))
+
+
+class TestCompileTrace(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cached_by_content(self):
+        first = link_trace.compile_trace('{type: constant, rate: 12}',
+                                         self.cache_dir)
+        second = link_trace.compile_trace(
+            {'type': 'constant', 'rate': 12.0, 'duration': 1},
+            self.cache_dir)
+        other = link_trace.compile_trace('{type: constant, rate: 24}',
+                                         self.cache_dir)
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertTrue(np.array_equal(link_trace.read_trace(first),
+                                       np.arange(1, 1001)))
+
+
+if __name__ == '__main__':
+    unittest.main()
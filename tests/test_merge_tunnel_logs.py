@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+from os import path
+import shutil
+import tempfile
+import unittest
+
+import context
+import merge_tunnel_logs
+
+
+def write_raw_log(log_path, packets):
+    with open(log_path, 'w') as log:
+        log.write('# init timestamp: 1000.000\n')
+        for packet in packets:
+            log.write('%.3f-%d-%d\n' % packet)
+
+
+class TestInFlightPackets(unittest.TestCase):
+    def test_spill_round_trip(self):
+        sent = [(float(uid), uid, 100 + uid) for uid in xrange(10)]
+        packets = merge_tunnel_logs.InFlightPackets(iter(sent), 5.0, 3)
+
+        # read all packets so that all but the last 3 are spilled to disk
+        for packet in sent:
+            self.assertEqual(packets.next_sent(), packet)
+        self.assertIsNone(packets.next_sent())
+        self.assertEqual(len(packets.packets), 3)
+        self.assertTrue(path.isfile(packets.spill_path))
+
+        for uid in [0, 9, 4, 7]:
+            self.assertEqual(tuple(packets.pop(uid)), (uid + 5.0, 100 + uid))
+        self.assertIsNone(packets.pop(4))
+
+        spill_path = packets.spill_path
+        packets.close()
+        self.assertFalse(path.exists(spill_path))
+
+    def test_read_ahead(self):
+        sent = [(float(uid), uid, 100) for uid in xrange(5)]
+        packets = merge_tunnel_logs.InFlightPackets(iter(sent), 0.0, 100)
+
+        # a departure read before its packet is returned by next_sent()
+        self.assertEqual(packets.pop(3), (3.0, 100))
+        self.assertEqual([packets.next_sent() for _ in xrange(6)],
+                         sent + [None])
+        self.assertIsNone(packets.pop(10))
+        packets.close()
+
+    def test_read_ahead_spill(self):
+        sent = [(float(uid), uid, 100) for uid in xrange(10)]
+        packets = merge_tunnel_logs.InFlightPackets(iter(sent), 0.0, 2)
+
+        # reading ahead to the last packet keeps only 2 of them in memory
+        self.assertEqual(packets.pop(9), (9.0, 100))
+        self.assertEqual(len(packets.read_ahead), 2)
+        self.assertEqual(packets.spilled_ahead, 8)
+
+        self.assertEqual([packets.next_sent() for _ in xrange(11)],
+                         sent + [None])
+        self.assertEqual(tuple(packets.pop(0)), (0.0, 100))
+        packets.close()
+
+
+class TestMergeSingle(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        sent = []
+        received = []
+        for uid in xrange(2000):
+            sent.append((uid * 0.5, uid, 1000 + uid % 100))
+            if uid % 10 != 3:  # lost packets
+                delay = 5 + (uid * 7919) % 40  # reordered departures
+                received.append((uid * 0.5 + delay, uid, 1000 + uid % 100))
+        received.sort()
+
+        self.egress_log = path.join(self.tmp_dir, 'egress.log')
+        self.ingress_log = path.join(self.tmp_dir, 'ingress.log')
+        write_raw_log(self.egress_log, sent)
+        write_raw_log(self.ingress_log, received)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def merge(self, egress_log, **kwargs):
+        output_log = path.join(self.tmp_dir, 'output.log')
+        merge_tunnel_logs.merge_single(self.ingress_log, egress_log,
+                                       output_log, **kwargs)
+        with open(output_log) as output:
+            return output.read()
+
+    def test_streaming(self):
+        # negative clock offsets make departures precede their packets
+        for offset in [None, -20.0]:
+            expected = self.merge(self.egress_log, i_clock_offset=offset)
+
+            for window in [100000, 4]:
+                self.assertEqual(self.merge(
+                    self.egress_log, i_clock_offset=offset, streaming=True,
+                    window=window), expected)
+
+    def test_compact(self):
+        compact_log = self.egress_log + merge_tunnel_logs.COMPACT_SUFFIX
+        merge_tunnel_logs.compact_raw_log(self.egress_log, compact_log)
+
+        expected = self.merge(self.egress_log)
+        self.assertEqual(self.merge(compact_log), expected)
+        self.assertEqual(self.merge(compact_log, streaming=True, window=4),
+                         expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
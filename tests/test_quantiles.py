@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy as np
+
+import context
+from helpers import quantiles
+
+
+PERCENTILES = [0, 1, 25, 50, 90, 95, 99, 100]
+
+
+def exact_percentile(values, q):
+    return np.percentile(values, q, interpolation='nearest')
+
+
+class TestQuantiles(unittest.TestCase):
+    def setUp(self):
+        # delays in ms as written by merge_tunnel_logs.py, with a long tail
+        rng = np.random.RandomState(0)
+        self.delays = np.round(rng.exponential(40, 100000) + 20, 3)
+        self.delays[::100] += rng.uniform(0, 10000, 1000).round(3)
+
+    def add_in_chunks(self, stats, values):
+        for chunk in np.array_split(values, 7):
+            stats.add(chunk)
+        return stats
+
+    def test_exact_histogram(self):
+        histogram = self.add_in_chunks(quantiles.ExactHistogram(),
+                                       self.delays)
+
+        for q in PERCENTILES:
+            self.assertEqual(histogram.quantile(q),
+                             exact_percentile(self.delays, q))
+
+    def test_exact_histogram_is_sparse(self):
+        histogram = quantiles.ExactHistogram()
+        histogram.add(np.array([0.001, 10000.0, 10000.0]))
+
+        self.assertEqual(len(histogram.store), 2)
+        self.assertEqual(histogram.quantile(50), 10000.0)
+
+    def test_exact_histogram_merge(self):
+        first, second = self.delays[:30000], self.delays[30000:]
+        histogram = self.add_in_chunks(quantiles.ExactHistogram(), first)
+        histogram.merge(self.add_in_chunks(quantiles.ExactHistogram(),
+                                           second))
+
+        for q in PERCENTILES:
+            self.assertEqual(histogram.quantile(q),
+                             exact_percentile(self.delays, q))
+
+    def test_log_sketch(self):
+        for error in [0.01, 0.05]:
+            sketch = self.add_in_chunks(quantiles.LogSketch(error),
+                                        self.delays)
+
+            for q in PERCENTILES:
+                exact = exact_percentile(self.delays, q)
+                self.assertLessEqual(abs(sketch.quantile(q) - exact),
+                                     error * exact + 1e-9)
+
+    def test_log_sketch_signs(self):
+        values = np.array([-5.0, -1.0, 0.0, 0.0, 2.0, 8.0])
+        sketch = quantiles.LogSketch(0.01)
+        sketch.add(values)
+
+        for q in [0, 20, 50, 100]:
+            exact = exact_percentile(values, q)
+            self.assertLessEqual(abs(sketch.quantile(q) - exact),
+                                 0.01 * abs(exact) + 1e-9)
+
+    def test_log_sketch_merge_settings(self):
+        with self.assertRaises(ValueError):
+            quantiles.LogSketch(0.01).merge(quantiles.LogSketch(0.02))
+
+    def test_empty(self):
+        for stats in [quantiles.Samples(), quantiles.ExactHistogram(),
+                      quantiles.LogSketch()]:
+            stats.add(np.empty(0))
+            self.assertIsNone(stats.quantile(95))
+
+
+if __name__ == '__main__':
+    unittest.main()
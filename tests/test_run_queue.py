@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import os
+from os import path
+import json
+import shutil
+import tempfile
+import unittest
+
+import context
+import run_queue
+
+
+class FakeTime(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TestRunQueue(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.real_time = run_queue.time
+        self.clock = FakeTime(1000.0)
+        run_queue.time = self.clock
+
+    def tearDown(self):
+        run_queue.time = self.real_time
+        shutil.rmtree(self.data_dir)
+
+    def new_queue(self, keys, retries=2, backoff=10):
+        queue = run_queue.RunQueue(self.data_dir, retries, backoff)
+        queue.load()
+        queue.reset(keys)
+        return queue
+
+    def test_backoff(self):
+        queue = self.new_queue(['cubic_run1'])
+
+        waits = []
+        for _ in xrange(3):
+            key, wait = queue.next_ready()
+            self.assertEqual(key, 'cubic_run1')
+            waits.append(wait)
+
+            self.clock.now += wait
+            queue.start(key)
+            self.assertEqual(queue.state(key), 'running')
+            queue.finish(key, False, 'tunnel failed')
+
+        # retried twice after 10 and 20 seconds, then given up on
+        self.assertEqual(waits, [0, 10, 20])
+        self.assertEqual(queue.state('cubic_run1'), 'failed')
+        self.assertEqual(queue.runs['cubic_run1']['attempts'], 3)
+        self.assertEqual(queue.runs['cubic_run1']['error'], 'tunnel failed')
+        self.assertEqual(queue.next_ready(), (None, None))
+        self.assertTrue(queue.is_finished())
+
+    def test_ready_order(self):
+        queue = self.new_queue(['cubic_run1', 'bbr_run1', 'vegas_run1'])
+
+        queue.start('cubic_run1')
+        self.assertEqual(queue.finish('cubic_run1', False), 'pending')
+        self.assertEqual(queue.runs['cubic_run1']['error'], 'test failed')
+
+        # runs that wait for a retry go after the ready ones
+        self.assertEqual(queue.next_ready(), ('bbr_run1', 0))
+        queue.start('bbr_run1')
+        self.assertEqual(queue.finish('bbr_run1', True), 'done')
+        self.assertIsNone(queue.runs['bbr_run1']['error'])
+
+        self.assertEqual(queue.next_ready(), ('vegas_run1', 0))
+        queue.start('vegas_run1')
+        queue.finish('vegas_run1', True)
+
+        self.assertEqual(queue.next_ready(), ('cubic_run1', 10))
+        self.assertFalse(queue.is_finished())
+
+    def test_saved(self):
+        queue = self.new_queue(['cubic_run1', 'bbr_run1'])
+        queue.start('bbr_run1')
+        queue.finish('bbr_run1', True)
+
+        with open(queue.queue_path) as saved:
+            runs = json.load(saved)
+        self.assertEqual(runs['bbr_run1']['state'], 'done')
+
+        loaded = run_queue.RunQueue(self.data_dir)
+        loaded.load()
+        self.assertEqual(loaded.runs, queue.runs)
+        self.assertEqual(loaded.runs.keys(), ['cubic_run1', 'bbr_run1'])
+
+    def test_reset_keeps_order(self):
+        self.new_queue(['vegas_run1', 'cubic_run1'])
+
+        queue = self.new_queue(['bbr_run1', 'cubic_run1', 'vegas_run1'])
+        self.assertEqual(queue.runs.keys(),
+                         ['vegas_run1', 'cubic_run1', 'bbr_run1'])
+        self.assertEqual(queue.pending(), queue.runs.keys())
+
+    def test_reset_done(self):
+        queue = self.new_queue(['cubic_run1', 'bbr_run1'])
+        queue.start('cubic_run1')
+        queue.finish('cubic_run1', True)
+
+        # a resumed sweep keeps the attempts of runs that are done
+        queue.load()
+        queue.reset(['cubic_run1', 'bbr_run1'],
+                    is_done=lambda key: key == 'cubic_run1')
+        self.assertEqual(queue.state('cubic_run1'), 'done')
+        self.assertEqual(queue.runs['cubic_run1']['attempts'], 1)
+        self.assertEqual(queue.pending(), ['bbr_run1'])
+
+    def test_load_invalid(self):
+        with open(path.join(self.data_dir, run_queue.QUEUE_NAME), 'w') as f:
+            f.write('{"cubic_run1": {"state": "running"')
+
+        queue = run_queue.RunQueue(self.data_dir)
+        queue.load()
+        self.assertEqual(queue.runs, {})
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+        for log_name in ['cubic_datalink_run1.log', 'cubic_stats_run1.log']:
+            self.write_log(log_name, 'log of %s\n' % log_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def write_log(self, log_name, contents):
+        with open(path.join(self.data_dir, log_name), 'w') as log:
+            log.write(contents)
+
+    def append_run1(self, finished):
+        run_queue.append_finished(
+            self.data_dir, 'cubic_run1', finished,
+            ['cubic_datalink_run1.log'], ['cubic_stats_run1.log'])
+
+    def test_last_entry_wins(self):
+        self.append_run1('first')
+        self.append_run1('second')
+
+        # a line that was being written in a crash is skipped
+        manifest_path = path.join(self.data_dir, run_queue.MANIFEST_NAME)
+        with open(manifest_path, 'a') as manifest:
+            manifest.write('{"run": "cubic_run2", "fin')
+
+        finished = run_queue.load_finished(self.data_dir)
+        self.assertEqual(finished.keys(), ['cubic_run1'])
+        self.assertEqual(finished['cubic_run1']['finished'], 'second')
+        self.assertEqual(finished['cubic_run1']['logs'], {
+            'cubic_datalink_run1.log': run_queue.checksum(
+                path.join(self.data_dir, 'cubic_datalink_run1.log')),
+            'cubic_stats_run1.log': None})
+
+    def test_verify(self):
+        self.append_run1('now')
+        entry = run_queue.load_finished(self.data_dir)['cubic_run1']
+        self.assertTrue(run_queue.verify_finished(self.data_dir, entry))
+
+        # unchecked logs may change but must exist
+        self.write_log('cubic_stats_run1.log', 'analyzed\n')
+        self.assertTrue(run_queue.verify_finished(self.data_dir, entry))
+
+        self.write_log('cubic_datalink_run1.log', 'truncated')
+        self.assertFalse(run_queue.verify_finished(self.data_dir, entry))
+
+    def test_verify_missing(self):
+        self.append_run1('now')
+        entry = run_queue.load_finished(self.data_dir)['cubic_run1']
+
+        os.remove(path.join(self.data_dir, 'cubic_stats_run1.log'))
+        self.assertFalse(run_queue.verify_finished(self.data_dir, entry))
+
+    def test_no_manifest(self):
+        self.assertEqual(run_queue.load_finished(self.data_dir), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,6 @@
 import os
 from os import path
 import sys
-import time
 import signal
 import argparse
 
@@ -33,8 +32,8 @@ def test_schemes(args):
         cmd = [src, run_first, port]
         first_proc = Popen(cmd, preexec_fn=os.setsid)
 
-        # wait for 'run_first' to be ready
-        time.sleep(3)
+        # wait for 'run_first' to be ready for at most 3 seconds
+        utils.wait_for_port(first_proc.pid, int(port), 3)
 
         # run second to run
         cmd = [src, run_second, '127.0.0.1', port]
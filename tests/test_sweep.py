@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import context
+import sweep
+
+
+class TestParseSpace(unittest.TestCase):
+    def test_lists_and_ranges(self):
+        scheme, space = sweep.parse_space(
+            'mvfst_rl{cwnd=10..1000;factor=0.1..0.5;mode=a,b}')
+
+        self.assertEqual(scheme, 'mvfst_rl')
+        self.assertEqual(space, OrderedDict([
+            ('cwnd', (10, 1000)), ('factor', (0.1, 0.5)),
+            ('mode', ['a', 'b'])]))
+        self.assertIsInstance(space['cwnd'][0], int)
+        self.assertIsInstance(space['factor'][0], float)
+
+    def test_invalid(self):
+        for spec in ['mvfst_rl', 'mvfst_rl{cwnd}', 'mvfst_rl{cwnd=1..x}',
+                     'mvfst_rl{cwnd=5..1}', 'mvfst_rl{cwnd=1;cwnd=2}']:
+            with self.assertRaises(ValueError):
+                sweep.parse_space(spec)
+
+
+class TestSampleConfigs(unittest.TestCase):
+    def test_grid(self):
+        space = OrderedDict([('a', ['1', '2']), ('b', ['x', 'y', 'z'])])
+        configs = sweep.sample_configs('cc', space, 0, 'grid')
+
+        self.assertEqual(configs.keys()[:2], ['cc{1;x}', 'cc{1;y}'])
+        self.assertEqual(len(configs), 6)
+        self.assertEqual(configs['cc{2;z}'], {'a': '2', 'b': 'z'})
+
+        with self.assertRaises(ValueError):
+            sweep.sample_configs('cc', OrderedDict([('a', (1, 2))]), 0,
+                                 'grid')
+
+    def test_lhs_strata(self):
+        space = OrderedDict([('cwnd', (0, 99)), ('gain', (0.0, 1.0))])
+        configs = sweep.sample_configs('cc', space, 10, 'lhs', seed=3)
+        self.assertEqual(len(configs), 10)
+
+        # each tenth of each range is sampled exactly once
+        cwnd_strata = sorted([int(c['cwnd']) // 10
+                              for c in configs.values()])
+        gain_strata = sorted([int(float(c['gain']) * 10)
+                              for c in configs.values()])
+        self.assertEqual(cwnd_strata, range(10))
+        self.assertEqual(gain_strata, range(10))
+
+    def test_seeded(self):
+        space = OrderedDict([('cwnd', (1, 1000)), ('mode', ['a', 'b'])])
+
+        for sampler in ['random', 'lhs']:
+            configs = sweep.sample_configs('cc', space, 8, sampler, seed=7)
+            self.assertEqual(
+                configs, sweep.sample_configs('cc', space, 8, sampler, 7))
+
+            for config in configs.values():
+                self.assertTrue(1 <= int(config['cwnd']) <= 1000)
+                self.assertIn(config['mode'], ['a', 'b'])
+
+    def test_duplicates(self):
+        space = OrderedDict([('mode', ['a'])])
+        configs = sweep.sample_configs('cc', space, 5, 'random')
+        self.assertEqual(configs.keys(), ['cc{a}'])
+
+
+class TestSchedule(unittest.TestCase):
+    def test_round_runtime(self):
+        self.assertEqual([sweep.round_runtime(30, i, 3, 2)
+                          for i in xrange(3)], [8, 15, 30])
+        self.assertEqual([sweep.round_runtime(10, i, 4, 3)
+                          for i in xrange(4)], [1, 2, 4, 10])
+
+    def test_select_best(self):
+        scores = OrderedDict([('a', 1.0), ('b', None), ('c', 3.0),
+                              ('d', 2.0)])
+        self.assertEqual(sweep.select_best(scores, 2), ['c', 'd'])
+        self.assertEqual(sweep.select_best(scores, 5), ['c', 'd', 'a'])
+
+
+class TestScoreRun(unittest.TestCase):
+    def setUp(self):
+        fd, self.log_path = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(fd, 'w') as log:
+            log.write('# init timestamp: 1000.000\n')
+            for i in xrange(1, 101):
+                log.write('%d + 1500 1\n' % i)
+                # 1500 bytes per ms is 12 Mbit/s with delays of 1..100 ms
+                log.write('%d - 1500 %d.000 1\n' % (i + 100, i))
+
+    def tearDown(self):
+        os.remove(self.log_path)
+
+    def test_metrics(self):
+        tput = 100 * 1500 * 8 / (1000.0 * 99)
+
+        self.assertAlmostEqual(sweep.score_run(self.log_path, 'tput'), tput)
+        self.assertAlmostEqual(sweep.score_run(self.log_path, 'delay'), -95)
+        self.assertAlmostEqual(sweep.score_run(self.log_path, 'power'),
+                               tput / 95)
+
+    def test_missing_log(self):
+        self.assertIsNone(sweep.score_run(self.log_path + '.missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import sys
+import unittest
+from StringIO import StringIO
+
+import context
+import tunnel_manager
+
+
+class RecordingTunnelManager(tunnel_manager.TunnelManager):
+    # keep replies instead of writing them to stdout
+    def __init__(self):
+        super(RecordingTunnelManager, self).__init__()
+        self.output = []
+
+    def write(self, output):
+        self.output.append(output)
+
+
+class FakeProc(object):
+    def __init__(self, replies):
+        self.pid = 0
+        self.stdin = StringIO()
+        self.stdout = StringIO(replies)
+
+    def poll(self):
+        return None
+
+
+class TestTunnelManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = RecordingTunnelManager()
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        # kill_tunnels() would kill the process group of the test as well
+        self.manager.run_cmd(['reset'])
+        sys.stderr = self.stderr
+
+    def test_framed_replies(self):
+        self.manager.run_framed('7', ['prompt', '[tunnel', 'server]'])
+        self.manager.run_framed('8', ['unknown'])
+        self.manager.run_framed('9', ['tunnel', 'x', 'poll'])
+
+        self.assertEqual(self.manager.output, [
+            '@7 error usage: prompt PROMPT\n',
+            '@8 error unknown command: unknown\n',
+            '@9 error usage: tunnel ID CMD...\n'])
+
+    def test_poll(self):
+        self.assertEqual(self.manager.run_cmd(['tunnel', '1', 'poll']),
+                         ('error', 'run tunnel client or server first'))
+
+        self.manager.run_tunnel(1, 'sleep 30')
+        self.manager.run_tunnel(2, 'true')
+        self.manager.procs[2].wait()
+
+        self.assertEqual(self.manager.run_cmd(['tunnel', '1', 'poll']),
+                         ('ok', 'running'))
+        self.assertEqual(self.manager.run_cmd(['tunnel', '2', 'poll']),
+                         ('ok', 'exited 0'))
+        self.assertEqual(self.manager.run_cmd(['tunnel', '1', 'poll', 'x']),
+                         ('error', 'usage: tunnel ID poll'))
+
+    def test_readline(self):
+        self.manager.run_tunnel(1, 'echo ready')
+        self.manager.run_tunnel(2, 'sleep 30')
+
+        self.assertEqual(self.manager.run_cmd(['tunnel', '1', 'readline']),
+                         ('ok', 'ready'))
+        for _ in xrange(2):
+            self.assertEqual(
+                self.manager.run_cmd(['tunnel', '1', 'readline']),
+                ('eof', ''))
+        self.assertEqual(
+            self.manager.run_cmd(['tunnel', '2', 'readline', '0.2']),
+            ('timeout', ''))
+
+    def test_reset(self):
+        self.manager.run_tunnel(1, 'sleep 30')
+        proc = self.manager.procs[1]
+
+        self.assertEqual(self.manager.run_cmd(['reset']),
+                         ('ok', 'tunnels are reset'))
+        self.assertEqual(self.manager.procs, {})
+        self.assertEqual(self.manager.lines, {})
+
+        self.assertIsNotNone(proc.poll())
+
+        self.assertEqual(self.manager.run_cmd(['reset', 'now']),
+                         ('error', 'usage: reset'))
+
+
+class TestTunnelManagerClient(unittest.TestCase):
+    def setUp(self):
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def test_out_of_order_replies(self):
+        proc = FakeProc('@3 error failed\n'
+                        'not a reply\n'
+                        '\n'
+                        '@ ok\n'
+                        '@x1 ok\n'
+                        '@2 ok ready to go\n'
+                        '@1 timeout\n')
+        client = tunnel_manager.TunnelManagerClient(proc)
+
+        self.assertEqual(client.send('tunnel 1 wait 5000 1'), 1)
+        self.assertEqual(client.send('tunnel 1 readline  '), 2)
+        client.send('tunnel 2 python x', wait_reply=False)
+
+        self.assertEqual(proc.stdin.getvalue(),
+                         '@1 tunnel 1 wait 5000 1\n'
+                         '@2 tunnel 1 readline\n'
+                         '@3 tunnel 2 python x\n')
+
+        self.assertEqual(client.recv(2), ('ok', 'ready to go'))
+        self.assertEqual(client.recv(1), ('timeout', ''))
+        self.assertEqual(client.recv(4), ('eof', ''))
+
+        warnings = sys.stderr.getvalue()
+        self.assertIn('unexpected output from tunnel manager: not a reply',
+                      warnings)
+        self.assertIn('tunnel manager: failed', warnings)
+
+
+if __name__ == '__main__':
+    unittest.main()